@@ -97,6 +97,21 @@ CFG_DEFAULTS = [
         "Replication retries_per_request parameter",
     ),
     ("proxy", None, "REP_PROXY", "Replication proxy"),
+    (
+        "profile",
+        None,
+        "REP_PROFILE",
+        "Time phases of replicate_*_and_compare runs and write them to files"
+        " starting with this path prefix",
+    ),
+    ("cprofile", False, "REP_CPROFILE", "With profile also run cProfile"),
+    (
+        "metrics_file",
+        None,
+        "REP_METRICS_FILE",
+        "Write replication timing metrics in Prometheus text format to this"
+        " file after each replicate_*_and_compare cycle",
+    ),
     #  Settings below apply when using a locally running cluster
     #  This cluster can be controlled from the test framework, nodes can be
     #  stopped, its data directory can be modified, and so on.
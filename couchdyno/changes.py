@@ -0,0 +1,125 @@
+"""
+_changes feed consumers for couchdyno-execute. They follow the db's
+_changes feed with include_docs=true while cycles run, like application
+listeners do, and measure how long changes take to reach them.
+
+Example of usage:
+
+  consumers = ChangesConsumers.start(db, 4, "continuous")
+  ... update cycle ...
+  latencies, received, errors, behind = consumers.collect(seq)
+"""
+
+import time
+import threading
+import couchdb
+from .histogram import Histogram
+from .util import seq_num
+
+CHANGES_FEEDS = ["continuous", "longpoll"]
+CHANGES_HEARTBEAT = 10000
+CHANGES_GRACE = 30
+CHANGES_POLL = 0.05
+
+
+class ChangesConsumers(object):
+    """
+    Threads following the db _changes feed with include_docs=true, like
+    application listeners do. Consumers record the delay between a doc's
+    `ts_ms` and the time its change was received. Each uses its own HTTP
+    session and runs in a daemon thread so it doesn't block the writer.
+    Counters are collected and reset after every cycle, once consumers
+    have caught up with the cycle's writes.
+    """
+
+    def __init__(self, db, n, feed):
+        self.db = db
+        self.n = n
+        self.feed = feed
+        self.lock = threading.Lock()
+        self.latencies = Histogram()
+        self.received = 0
+        self.errors = 0
+        self.since = db.info()["update_seq"]
+        self.seqs = [seq_num(self.since)] * n
+        self.threads = []
+
+    @classmethod
+    def start(cls, db, n, feed):
+        if n <= 0:
+            return None
+        consumers = cls(db, n, feed)
+        for i in range(n):
+            thread = threading.Thread(target=consumers.consume, args=(i,), daemon=True)
+            thread.start()
+            consumers.threads.append(thread)
+        return consumers
+
+    def consume(self, i):
+        cdb = couchdb.Database(self.db.resource.url, session=couchdb.Session())
+        cdb.resource.credentials = self.db.resource.credentials
+        since = self.since
+        while True:
+            try:
+                since = self._follow(cdb, i, since)
+            except (couchdb.http.HTTPError, OSError):
+                with self.lock:
+                    self.errors += 1
+                time.sleep(1)
+
+    def _follow(self, cdb, i, since):
+        """
+        Read changes from a single _changes request. Return the sequence to
+        continue from.
+        """
+        opts = dict(since=since, include_docs=True, heartbeat=CHANGES_HEARTBEAT)
+        if self.feed == "continuous":
+            for change in cdb.changes(feed="continuous", **opts):
+                if "last_seq" in change:
+                    return change["last_seq"]
+                self.observe(change)
+                since = self._seen(i, change["seq"])
+            return since
+        res = cdb.changes(feed="longpoll", **opts)
+        for change in res["results"]:
+            self.observe(change)
+        return self._seen(i, res["last_seq"])
+
+    def _seen(self, i, seq):
+        with self.lock:
+            self.seqs[i] = max(self.seqs[i], seq_num(seq))
+        return seq
+
+    def observe(self, change):
+        now = time.time()
+        doc = change.get("doc") or {}
+        with self.lock:
+            self.received += 1
+            latencies = self.latencies
+        # Only couchdyno docs have ts_ms
+        if "ts_ms" in doc:
+            latencies.record(now - doc["ts_ms"] / 1000.0)
+
+    def behind(self, seq):
+        """
+        Number of updates up to `seq` the slowest consumer hasn't received.
+        """
+        with self.lock:
+            return max(0, seq - min(self.seqs))
+
+    def collect(self, seq, grace=CHANGES_GRACE):
+        """
+        Wait up to `grace` seconds for all consumers to reach update
+        sequence `seq`. Then return the latency histogram, received
+        changes and errors since the last call, and reset them, followed
+        by how many updates the slowest consumer is still behind.
+        """
+        till = time.time() + grace
+        while self.behind(seq) > 0 and time.time() < till:
+            time.sleep(CHANGES_POLL)
+        behind = self.behind(seq)
+        with self.lock:
+            latencies, self.latencies = self.latencies, Histogram()
+            received, self.received = self.received, 0
+            errors, self.errors = self.errors, 0
+        return latencies, received, errors, behind
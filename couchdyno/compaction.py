@@ -0,0 +1,182 @@
+"""
+Compaction trigger-and-measure workflow for couchdyno-execute. The db
+and couchdyno view indexes are compacted every few cycles or when db
+fragmentation gets too high, while the dyno keeps writing, and the time
+taken, space reclaimed and write rate during compaction are measured.
+
+Example of usage:
+
+  compactor = Compactor.open(db, every=10, fragmentation=0, wait=False)
+  compactor.start(metadoc)
+  ... update cycle ...
+  result = compactor.collect()
+"""
+
+import time
+import threading
+import couchdb
+from .util import db_tasks, db_sizes, has_sizes, fragmentation_pct
+
+COMPACT_TASKS = ["database_compaction", "view_compaction"]
+COMPACT_SAMPLE = 1.0
+
+
+class Compactor(object):
+    """
+    Compact the db and the couchdyno design docs' view indexes every
+    `every` cycles, or when db fragmentation reaches `fragmentation`
+    percent. Cycles are counted in the meta doc, which also records the
+    cycle compaction was last started in, so this works across
+    couchdyno-execute runs started from cron. Compaction is started before
+    a cycle's writes and followed by a background thread, which polls
+    _active_tasks and compact_running flags until it's done, so writes
+    carry on while it runs. Results are collected after the cycle in which
+    it finished. With `wait`, the cycle waits for compaction to finish
+    instead, for single runs.
+    """
+
+    def __init__(self, db, every=0, fragmentation=0, wait=False):
+        self.db = db
+        self.every = every
+        self.fragmentation = fragmentation
+        self.wait = wait
+        self.thread = None
+        self.run = None
+
+    @classmethod
+    def open(cls, db, every, fragmentation, wait):
+        if every <= 0 and fragmentation <= 0:
+            return None
+        return cls(db, every, fragmentation, wait)
+
+    def start(self, metadoc):
+        """
+        Start compaction if it's due and none is running. Return why it was
+        started, or None.
+        """
+        if self.thread is not None:
+            return None
+        cycle = metadoc.get("cycles", 0) + 1
+        sizes = db_sizes(self.db)
+        frag = fragmentation_pct(sizes) if has_sizes(sizes) else 0.0
+        if self.every > 0 and cycle - metadoc.get("compacted_cycle", 0) >= self.every:
+            reason = "every %d cycles" % self.every
+        elif self.fragmentation > 0 and frag >= self.fragmentation:
+            reason = "fragmentation %.1f%%" % frag
+        else:
+            return None
+        metadoc["compacted_cycle"] = cycle
+        views = self._views()
+        self.run = dict(
+            reason=reason,
+            t0=time.time(),
+            sizes=sizes,
+            frag=frag,
+            views=views,
+            view_sizes=self._view_sizes(views),
+            tasks=0,
+            progress=0,
+            result=None,
+            error=None,
+        )
+        self.db.compact()
+        for name in views:
+            self.db.compact(name)
+        self.thread = threading.Thread(target=self._follow, daemon=True)
+        self.thread.start()
+        return reason
+
+    def collect(self, out=None):
+        """
+        Return results of a finished compaction and reset, or None if none
+        finished. Progress is printed to `out`, by default stdout, while
+        waiting.
+        """
+        if self.thread is None:
+            return None
+        while self.wait and self.thread.is_alive():
+            self.thread.join(COMPACT_SAMPLE)
+            if self.thread.is_alive():
+                run = self.run
+                print(
+                    "... compacting, tasks:",
+                    run["tasks"],
+                    "progress (%):",
+                    run["progress"],
+                    file=out,
+                )
+        if self.thread.is_alive():
+            return None
+        self.thread, run = None, self.run
+        if run["error"] is not None:
+            print("(!)compaction failed:", run["error"], file=out)
+            return None
+        return run["result"]
+
+    def _follow(self):
+        run = self.run
+        try:
+            while self._running():
+                time.sleep(COMPACT_SAMPLE)
+            before, after = run["sizes"], db_sizes(self.db)
+            dt = time.time() - run["t0"]
+            views_before = run["view_sizes"]
+            views_after = self._view_sizes(run["views"])
+            writes = after["update_seq"] - before["update_seq"]
+            run["result"] = dict(
+                reason=run["reason"],
+                dt=dt,
+                frag=run["frag"],
+                reclaimed=before.get("file_bytes", 0) - after.get("file_bytes", 0),
+                views_reclaimed=sum(
+                    views_before[name] - views_after[name]
+                    for name in views_before
+                    if name in views_after
+                ),
+                writes=writes,
+                rate=writes / dt if dt > 0 else 0.0,
+            )
+        except Exception as ex:
+            run["error"] = ex
+
+    def _running(self):
+        tasks = db_tasks(self.db, COMPACT_TASKS)
+        self.run["tasks"] = len(tasks)
+        if tasks:
+            progress = [t.get("progress", 0) for t in tasks]
+            self.run["progress"] = int(sum(progress) / len(progress))
+            return True
+        if self.db.info().get("compact_running"):
+            return True
+        for name in self.run["views"]:
+            info = self._view_info(name)
+            if info is not None and info.get("compact_running"):
+                return True
+        return False
+
+    def _views(self):
+        """
+        Names of couchdyno design docs in the db.
+        """
+        rows = self.db.view(
+            "_all_docs", startkey="_design/couchdyno", endkey="_design/couchdyno\ufff0"
+        )
+        return [row.id[len("_design/") :] for row in rows]
+
+    def _view_info(self, name):
+        try:
+            _, _, res = self.db.resource("_design", name, "_info").get_json()
+        except couchdb.http.HTTPError:
+            return None
+        return res.get("view_index")
+
+    def _view_sizes(self, views):
+        res = {}
+        for name in views:
+            info = self._view_info(name)
+            if info is None:
+                continue
+            size = (info.get("sizes") or {}).get("file", info.get("disk_size"))
+            if size is not None:
+                res[name] = size
+        return res
@@ -1,11 +1,56 @@
+import sys
+import json
 import time
 import random
-import string
+import os
+import math
+import hashlib
+import fnmatch
 import argparse
+import functools
 import datetime
+import threading
+import collections
 import urllib.parse
+import concurrent.futures
 import couchdb
 from couchdb.design import ViewDefinition
+from .profiling import NO_TIMERS, PhaseTimers, Profiler, format_phases
+from .metrics import Metrics, LATENCY_BUCKETS
+from .util import (
+    PicklableLock,
+    server_resource,
+    seq_num,
+    is_timeout,
+    db_sizes,
+    has_sizes,
+    fragmentation_pct,
+)
+from .compaction import Compactor
+from .changes import ChangesConsumers, CHANGES_FEEDS, CHANGES_GRACE
+from .indexlag import IndexLag, DEFAULT_LAG_TIMEOUT
+from .histogram import Histogram
+from .workload import (
+    WORKLOAD_OPS,
+    READ_OPS,
+    parse_workload,
+    format_workload,
+    workload_ops,
+    run_op,
+)
+from .payload import (
+    Payload,
+    Attachments,
+    put_attachments,
+    max_doc_size,
+    DOC_OVERHEAD,
+    MAX_DOCUMENT_SIZE,
+    SIZE_DISTRIBUTIONS,
+    DEFAULT_SIZE_SIGMA,
+    DOC_SHAPES,
+    DEFAULT_FIELDS,
+    DEFAULT_ATTACHMENT_SIZE,
+)
 
 DEFAULT_TOTAL = 1000
 DEFAULT_SIZE = 1000
@@ -13,7 +58,55 @@ DEFAULT_UPDATES = 10
 VERSION = 1
 IDPAT = "cdyno_%012d"
 HISTORY_MAX = 1000
+HISTORY_PREFIX = "couchdyno_history_"
 FILL_BATCH = 100000
+KEYS_BATCH = 2000
+REVS_CHUNK = 20000
+CONFLICTS_MAX = 100000
+DISTRIBUTIONS = ["sequential", "uniform", "zipf", "hotspot"]
+DEFAULT_ZIPF_SKEW = 0.99
+DEFAULT_HOT_OPS_PCT = 80
+DEFAULT_HOT_KEYS_PCT = 20
+REV_RECORD = 48
+BLIND_REVS_MAX = 1000
+BLIND_LAG_MAX = 10000
+BATCH_MAX = 10000
+MAX_HTTP_REQUEST_SIZE = 4294967296
+TREND_ROWS = 10
+DEFAULT_CHECKPOINT_EVERY = 10
+DEFAULT_DB_CONCURRENCY = 8
+METRIC_FAMILIES = [
+    #  name, type, help
+    ("cycles", "counter", "Update cycles run"),
+    ("updates", "counter", "Documents updated"),
+    ("update_errors", "counter", "Document updates which failed"),
+    ("update_rate", "gauge", "Documents updated per second in the last cycle"),
+    ("cycle_duration_seconds", "gauge", "Duration of the last cycle"),
+    ("last_cycle_timestamp_seconds", "gauge", "When the last cycle ended"),
+    ("batch_latency_seconds", "histogram", "Latency of _bulk_docs requests"),
+    ("operations", "counter", "Mixed workload operations run"),
+    ("operation_errors", "counter", "Mixed workload operations which failed"),
+    ("operation_latency_seconds", "histogram", "Latency of workload operations"),
+    ("revs_fetched", "counter", "Document revisions fetched before updating"),
+    ("revs_cached", "counter", "Document revisions read from the rev cache"),
+    ("revs_fetch_rate", "gauge", "Revisions fetched per second in the last cycle"),
+    ("attachments", "counter", "Attachments written"),
+    ("attachment_bytes", "counter", "Attachment bytes written"),
+    ("attachment_errors", "counter", "Attachment writes which failed"),
+    ("index_lag_seconds", "gauge", "Time until an index included the last cycle"),
+    ("changes_received", "counter", "Changes received by _changes consumers"),
+    ("changes_errors", "counter", "Errors of _changes consumers"),
+    ("db_file_bytes", "gauge", "Database file size"),
+    ("db_active_bytes", "gauge", "Size of live data in the database file"),
+    ("db_external_bytes", "gauge", "Uncompressed size of database contents"),
+    ("db_doc_count", "gauge", "Documents in the database"),
+    ("db_doc_del_count", "gauge", "Deleted documents in the database"),
+    ("db_update_seq", "gauge", "Numeric part of the database update sequence"),
+    ("compactions", "counter", "Compactions run"),
+    ("compaction_duration_seconds", "gauge", "Duration of the last compaction"),
+    ("compaction_reclaimed_bytes", "gauge", "Bytes reclaimed by the last compaction"),
+    ("compaction_write_rate", "gauge", "Db writes per second during compaction"),
+]
 
 # Command Line Entry Points
 
@@ -51,30 +144,180 @@ def setup():
         default=False,
         help="Fill database until total number of docs",
     )
+    p.add_argument(
+        "--seed",
+        default=None,
+        help="Random seed for document data. Makes runs reproducible",
+    )
+    p.add_argument(
+        "-b",
+        "--blind-writes",
+        action="store_true",
+        default=False,
+        help="Write client generated revisions with new_edits=false"
+        " instead of reading current revisions first",
+    )
+    p.add_argument(
+        "-k",
+        "--distribution",
+        choices=DISTRIBUTIONS,
+        default="sequential",
+        help="Which docs to update on each run. sequential updates the next"
+        " docs round-robin. Others pick docs at random",
+    )
+    p.add_argument(
+        "--zipf-skew",
+        type=float,
+        default=DEFAULT_ZIPF_SKEW,
+        help="Skew exponent for the zipf distribution",
+    )
+    p.add_argument(
+        "--hot-ops-pct",
+        type=float,
+        default=DEFAULT_HOT_OPS_PCT,
+        help="Percent of updates going to hot docs in hotspot distribution",
+    )
+    p.add_argument(
+        "--hot-keys-pct",
+        type=float,
+        default=DEFAULT_HOT_KEYS_PCT,
+        help="Percent of docs which are hot in hotspot distribution",
+    )
+    p.add_argument(
+        "-m",
+        "--workload",
+        type=parse_workload,
+        default=None,
+        help="Run a mixed workload instead of only updates. Specified as"
+        " op=ratio,... where op is one of: %s. Ex.: read=50,update=50"
+        % ",".join(WORKLOAD_OPS),
+    )
+    p.add_argument(
+        "--size-dist",
+        choices=SIZE_DISTRIBUTIONS,
+        default="fixed",
+        help="Distribution of document sizes, --size is the mean size",
+    )
+    p.add_argument(
+        "--size-sigma",
+        type=float,
+        default=DEFAULT_SIZE_SIGMA,
+        help="Sigma parameter of the lognormal size distribution",
+    )
+    p.add_argument(
+        "--doc-shape",
+        choices=DOC_SHAPES,
+        default="flat",
+        help="flat docs have a single data string. nested docs have a data"
+        " object with --fields small string fields in nested objects",
+    )
+    p.add_argument(
+        "--fields",
+        type=int,
+        default=DEFAULT_FIELDS,
+        help="Number of fields in nested documents",
+    )
+    p.add_argument(
+        "--entropy",
+        type=float,
+        default=1.0,
+        help="Fraction of document data which is random. The rest repeats a"
+        " few short words so it compresses well",
+    )
+    p.add_argument(
+        "--attachment-pct",
+        type=float,
+        default=0,
+        help="Percent of docs which get an attachment written or replaced"
+        " each time they are updated",
+    )
+    p.add_argument(
+        "--attachment-size",
+        type=int,
+        default=DEFAULT_ATTACHMENT_SIZE,
+        help="Mean attachment size in bytes",
+    )
+    p.add_argument(
+        "--attachment-size-dist",
+        choices=SIZE_DISTRIBUTIONS,
+        default="fixed",
+        help="Distribution of attachment sizes",
+    )
+    _add_concurrency_arg(p)
+    _add_rev_cache_arg(p)
+    _add_batch_args(p)
+    _add_progress_args(p)
+    _add_profile_args(p)
     args = p.parse_args()
-    if not args.force:
+    if args.blind_writes and args.attachment_pct > 0:
+        print("ERROR: --blind-writes can't be used with attachments")
+        exit(1)
+    if not 0 <= args.entropy <= 1:
+        print("ERROR: --entropy should be between 0 and 1")
+        exit(1)
+    if args.fields < 1:
+        print("ERROR: --fields should be at least 1")
+        exit(1)
+    if args.blind_writes and args.distribution != "sequential":
+        print("ERROR: --blind-writes only works with sequential distribution")
+        exit(1)
+    if args.blind_writes and args.workload:
+        print("ERROR: --blind-writes can't be used with a mixed --workload")
+        exit(1)
+    if args.workload and args.attachment_pct > 0:
+        print("ERROR: attachments can't be used with a mixed --workload")
+        exit(1)
+    if args.resume:
+        db = _get_db(args.dburl, create=False)
+        if db is None:
+            print("ERROR: db:", args.dburl, "not found, nothing to resume")
+            exit(1)
+        metadoc = MetaDoc().load(db)
+    elif not args.force:
         db = _get_db(args.dburl, create=False)
         if db is not None:
             print("ERROR: db:", args.dburl, "already exists")
             print(" To force reset it, use -f|--force")
             exit(1)
         db = _get_db(args.dburl, create=True)
+        metadoc = MetaDoc.from_args(args).save(db)
     else:
         db = _get_db(args.dburl, create=True, reset_db=True)
-    metadoc = MetaDoc.from_args(args).save(db)
+        metadoc = MetaDoc.from_args(args).save(db)
     print("dyno_config:")
     metadoc.pprint()
+    revcache = _RevCache.open(args.rev_cache, reset=not args.resume)
+    sizer = _open_sizer(db, metadoc, args)
+    progress = _Progress.open(db, args.checkpoint_every)
+    profiler = Profiler.open(args.profile, "setup", args.cprofile)
+    pool = _WorkerPool(args.concurrency)
     if args.wait_to_fill:
         print()
         print("Filling up database...")
         print()
-        left = args.total
-        while left > FILL_BATCH:
-            left -= FILL_BATCH
-            _update_docs(db, metadoc, updates=FILL_BATCH)
+        # writes counts docs written by completed fill cycles
+        while metadoc.get("writes", 0) < metadoc["total"]:
+            left = metadoc["total"] - metadoc.get("writes", 0)
+            t0 = time.time()
+            _update_docs(
+                db,
+                metadoc,
+                updates=min(left, FILL_BATCH),
+                concurrency=args.concurrency,
+                revcache=revcache,
+                sizer=sizer,
+                progress=progress,
+                resume=args.resume,
+                fill=True,
+                timers=_timers(profiler),
+                pool=pool,
+            )
+            _profile_cycle(profiler, time.time() - t0)
             print()
-        _update_docs(db, metadoc, updates=left)
         print("Database filled")
+    pool.close()
+    if profiler is not None:
+        profiler.stop()
     print()
     print("Run 'couchdyno-execute' periodically to update documents.")
     exit(0)
@@ -99,26 +342,321 @@ def execute():
         default=0,
         help="Overrides # of updates for this particular execution",
     )
+    p.add_argument(
+        "--rate",
+        type=float,
+        default=0,
+        help="Run continuously and pace updates to these many docs per second",
+    )
+    p.add_argument(
+        "-p",
+        "--processes",
+        type=int,
+        default=1,
+        help="Split each cycle in these many contiguous shards and update"
+        " them from separate processes",
+    )
+    p.add_argument(
+        "--index-lag",
+        action="store_true",
+        default=False,
+        help="After each cycle measure how long until a view and a Mango"
+        " index on ts_ms include the cycle's updates",
+    )
+    p.add_argument(
+        "--lag-view",
+        action="append",
+        default=None,
+        help="Also measure how long until this ddoc/view catches up with the"
+        " db update sequence. Can be repeated",
+    )
+    p.add_argument(
+        "--lag-timeout",
+        type=int,
+        default=DEFAULT_LAG_TIMEOUT,
+        help="Stop waiting for indexes to catch up after these many seconds",
+    )
+    p.add_argument(
+        "--changes-consumers",
+        type=int,
+        default=0,
+        help="Run these many _changes feed consumers while updating docs",
+    )
+    p.add_argument(
+        "--changes-feed",
+        choices=CHANGES_FEEDS,
+        default="continuous",
+        help="Type of _changes feed used by consumers",
+    )
+    p.add_argument(
+        "--dbs-file",
+        default=None,
+        help="Update all dbs listed in this file, one name per line, on the"
+        " server in dburl. dburl db name can also be a pattern, ex.: tenant_*",
+    )
+    p.add_argument(
+        "--db-concurrency",
+        type=int,
+        default=DEFAULT_DB_CONCURRENCY,
+        help="With multiple dbs, update these many dbs at a time",
+    )
+    p.add_argument(
+        "--compact-every",
+        type=int,
+        default=0,
+        help="Compact the db and couchdyno views every these many cycles",
+    )
+    p.add_argument(
+        "--compact-fragmentation",
+        type=float,
+        default=0,
+        help="Compact the db and couchdyno views when db fragmentation is"
+        " at least this percent",
+    )
+    _add_concurrency_arg(p)
+    _add_rev_cache_arg(p)
+    _add_batch_args(p)
+    _add_progress_args(p)
+    _add_profile_args(p)
+    _add_metrics_args(p)
     args = p.parse_args()
+    if args.metrics_port and args.continuous <= 0 and args.rate <= 0:
+        print("ERROR: --metrics-port only works with --continuous or --rate")
+        exit(1)
+    dbs = _get_dbs(args.dburl, args.dbs_file)
+    if dbs is not None:
+        for (arg, val) in [
+            ("--processes", args.processes > 1),
+            ("--rev-cache", args.rev_cache),
+            ("--changes-consumers", args.changes_consumers > 0),
+        ]:
+            if val:
+                print("ERROR:", arg, "can't be used with multiple dbs")
+                exit(1)
+        _execute_dbs(args, dbs)
+        exit(0)
     db = _get_db(args.dburl, create=False)
     if db is None:
         print("ERROR: DB not found. Did you run couchdyno-setup first?")
         exit(3)
     metadoc = MetaDoc().load(db)
+    try:
+        _check_workload(metadoc, args)
+    except ValueError as ex:
+        print("ERROR:", ex)
+        exit(1)
+    revcache = _RevCache.open(args.rev_cache)
+    sizer = _open_sizer(db, metadoc, args)
+    limiter = _RateLimiter.open(args.rate)
+    progress = _Progress.open(db, args.checkpoint_every)
+    if progress is not None and args.processes > 1:
+        print("WARNING: progress isn't saved within cycles split with --processes")
+    indexes = IndexLag.open(db, args.index_lag, args.lag_view, args.lag_timeout)
+    consumers = ChangesConsumers.start(db, args.changes_consumers, args.changes_feed)
+    compactor = _open_compactor(db, args)
+    profiler = Profiler.open(args.profile, "execute", args.cprofile)
+    metrics = _open_metrics(args)
+    pool = _WorkerPool(args.concurrency)
     c = 0
     while True:
-        new_metadoc = _update_docs(db, metadoc, args.updates_per_run)
-        if args.continuous <= 0:
+        t0 = time.time()
+        new_metadoc = _update_docs(
+            db,
+            metadoc,
+            args.updates_per_run,
+            concurrency=args.concurrency,
+            revcache=revcache,
+            sizer=sizer,
+            limiter=limiter,
+            processes=args.processes,
+            progress=progress,
+            resume=args.resume and c == 0,
+            indexes=indexes,
+            consumers=consumers,
+            timers=_timers(profiler),
+            metrics=metrics,
+            compactor=compactor,
+            pool=pool,
+        )
+        _profile_cycle(profiler, time.time() - t0)
+        _write_metrics(metrics, args)
+        if args.continuous <= 0 and limiter is None:
             break
         c += 1
-        print("Sleeping", args.continuous, "seconds before next run", c)
-        time.sleep(args.continuous)
+        if args.continuous > 0:
+            print("Sleeping", args.continuous, "seconds before next run", c)
+            _sleep(limiter, args.continuous)
         print()
+    pool.close()
+    if profiler is not None:
+        profiler.stop()
     print("new_state:")
     new_metadoc.pprint()
     exit(0)
 
 
+def _execute_dbs(args, dbs):
+    """
+    Run execute cycles for many dbs from one process. Dbs are updated by a
+    pool of `db_concurrency` threads, all using the same HTTP session so
+    connections are pooled. With `concurrency` > 1 their batches are sent
+    by one worker pool shared by all dbs and kept across rounds. Each db
+    keeps its own meta doc cursor, batch sizer and progress checkpoint.
+    The rate limit applies to all dbs together. Output lines of each db
+    start with its name and each round ends with aggregate throughput.
+    """
+    limiter = _RateLimiter.open(args.rate)
+    profiler = Profiler.open(args.profile, "execute", args.cprofile)
+    metrics = _open_metrics(args)
+    workers = max(1, args.db_concurrency)
+    pool = _WorkerPool(args.concurrency, workers * args.concurrency)
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        opened = executor.map(
+            functools.partial(_call_safely, _open_tenant, args=args), dbs
+        )
+        tenants = []
+        for (db, (tenant, error)) in zip(dbs, opened):
+            if error is not None:
+                print("ERROR: db:", db.name, "skipped:", error)
+                continue
+            tenants.append(tenant)
+        print("dbs:", len(tenants))
+        print()
+        c = 0
+        while tenants:
+            resume = args.resume and c == 0
+            t0 = time.time()
+            _execute_round(
+                args,
+                executor,
+                pool,
+                tenants,
+                limiter,
+                resume,
+                _timers(profiler),
+                metrics,
+            )
+            _profile_cycle(profiler, time.time() - t0)
+            _write_metrics(metrics, args)
+            if args.continuous <= 0 and limiter is None:
+                break
+            c += 1
+            if args.continuous > 0:
+                print("Sleeping", args.continuous, "seconds before next run", c)
+                _sleep(limiter, args.continuous)
+            print()
+    pool.close()
+    if profiler is not None:
+        profiler.stop()
+
+
+def _call_safely(fun, *args, **kwargs):
+    """
+    Call fun and return (result, error). Errors are returned rather than
+    raised, so one failing db doesn't stop the others.
+    """
+    try:
+        return fun(*args, **kwargs), None
+    except Exception as ex:
+        return None, ex
+
+
+def _open_sizer(db, metadoc, args):
+    try:
+        return _BatchSizer.from_db(db, metadoc, args.target_latency)
+    except ValueError as ex:
+        print("ERROR:", ex)
+        exit(1)
+
+
+def _check_workload(metadoc, args):
+    """
+    Raise ValueError if an execute option isn't supported by mixed
+    workload cycles, which run one op per request from a single process.
+    """
+    if not metadoc.get("workload"):
+        return
+    for (arg, val) in [
+        ("--index-lag", args.index_lag or args.lag_view),
+        ("--processes", args.processes > 1),
+        ("--rev-cache", args.rev_cache),
+    ]:
+        if val:
+            raise ValueError(arg + " can't be used with a mixed workload")
+
+
+def _open_tenant(db, args):
+    out = _PrefixedOutput(db.name + ": ")
+    metadoc = MetaDoc().load(db)
+    _check_workload(metadoc, args)
+    return dict(
+        db=db,
+        out=out,
+        metadoc=metadoc,
+        sizer=_BatchSizer.from_db(db, metadoc, args.target_latency, out),
+        progress=_Progress.open(db, args.checkpoint_every),
+        indexes=IndexLag.open(db, args.index_lag, args.lag_view, args.lag_timeout),
+        compactor=_open_compactor(db, args),
+    )
+
+
+def _open_compactor(db, args):
+    """
+    Single runs wait for compaction to finish, continuous runs don't.
+    """
+    wait = args.continuous <= 0 and args.rate <= 0
+    return Compactor.open(db, args.compact_every, args.compact_fragmentation, wait)
+
+
+def _execute_round(
+    args, executor, pool, tenants, limiter, resume, timers=None, metrics=None
+):
+    """
+    Run one execute cycle for each tenant db and print aggregate stats.
+    Cycles print to their tenant's output.
+    """
+
+    def cycle(tenant):
+        return _update_docs(
+            tenant["db"],
+            tenant["metadoc"],
+            args.updates_per_run,
+            concurrency=args.concurrency,
+            sizer=tenant["sizer"],
+            limiter=limiter,
+            progress=tenant["progress"],
+            resume=resume,
+            indexes=tenant["indexes"],
+            timers=timers,
+            metrics=metrics,
+            compactor=tenant["compactor"],
+            pool=pool,
+            out=tenant["out"],
+        )
+
+    t0 = time.time()
+    updates, errors, failed = 0, 0, 0
+    results = executor.map(functools.partial(_call_safely, cycle), tenants)
+    for (tenant, (metadoc, error)) in zip(tenants, results):
+        if error is not None:
+            print("(!)failed:", error, file=tenant["out"])
+            failed += 1
+            continue
+        updates += metadoc["last_updates"]
+        errors += metadoc["last_errors"]
+    dt = time.time() - t0
+    print("all_dbs:")
+    print("  dbs:", len(tenants))
+    print("  updates:", updates)
+    print("  dt (sec): %.3f" % dt)
+    print("  rate (/sec):", int(updates / dt))
+    if errors > 0:
+        print("(!)errors:", errors)
+    if failed > 0:
+        print("(!)failed dbs:", failed)
+    print()
+
+
 def info():
     """
     Script endpoint to show setup and run statistics for couchdyno.
@@ -129,7 +667,7 @@ def info():
         "--daily-census",
         action="store_true",
         default=False,
-        help="Print a daily census (which days had updates)",
+        help="Print a daily census (docs and updates per day)",
     )
     p.add_argument(
         "-c",
@@ -138,6 +676,13 @@ def info():
         default=False,
         help="Print a conflicts report",
     )
+    p.add_argument(
+        "-l",
+        "--history-limit",
+        type=int,
+        default=HISTORY_MAX,
+        help="How many of the most recent runs to load from history",
+    )
     args = p.parse_args()
     db = _get_db(args.dburl, create=False)
     if db is None:
@@ -156,9 +701,9 @@ def info():
     metadoc.pprint()
     print()
 
-    history = metadoc["history"]
+    history = metadoc.history(db, limit=args.history_limit)
     print("update_history:")
-    print("  updates", len(history), "/ max kept", HISTORY_MAX)
+    print("  updates", len(history), "/ max loaded", args.history_limit)
     if len(history) > 1:
         t0, tl = history[0][0], history[-1][0]
         t = int(tl - t0)
@@ -169,15 +714,25 @@ def info():
         print("  interval (sec/hours/days):", t, "/", t_hours, "/", t_days)
         max_errors = 0
         rates = []
-        for _, dt, _, updates, errors in history:
+        batches = []
+        for hline in history:
+            dt, updates, errors = hline[1], hline[3], hline[4]
             if dt > 0:
                 rates.append(updates / float(dt))
             max_errors = max(max_errors, errors)
+            if len(hline) > 5 and "batch" in hline[5]:
+                batches.append(hline[5]["batch"][1])
         if max_errors:
             print("  max errors seen:", max_errors)
         if len(rates) > 0:
             avg_rate = int(sum(rates) / len(rates))
             print("  avg doc update rate:", avg_rate, "/ sec")
+        if len(batches) > 0:
+            print("  avg batch size:", int(sum(batches) / len(batches)))
+        _info_latency_trend(history)
+        _info_index_lag(history)
+        _info_db_sizes(history)
+        _info_compactions(history)
     if args.conflicts:
         _info_conflicts(db)
     if args.daily_census:
@@ -196,14 +751,7 @@ def _wait_for_view(db, view, maxwait=100000):
                 pass
             return
         except couchdb.http.ServerError as ex:
-            ex_args = ex.args[0]
-            if (
-                isinstance(ex_args, tuple)
-                and len(ex_args) == 2
-                and ex_args[0] == 500
-                and isinstance(ex_args[1], tuple)
-                and ex_args[1][0] == "timeout"
-            ):
+            if is_timeout(ex):
                 time_left = int(till - time.time())
                 if time_left <= 0:
                     print("ERROR: view", view.name, "took >", maxwait)
@@ -214,6 +762,138 @@ def _wait_for_view(db, view, maxwait=100000):
                 raise
 
 
+def _info_latency_trend(history):
+    """
+    Split history in up to TREND_ROWS consecutive chunks and print
+    request latency percentiles for each. p50, p90, p99 are the median
+    of the per-run values in the chunk, max is the largest seen.
+    """
+    history = [h for h in history if len(h) > 5 and "lat" in h[5]]
+    if not history:
+        return
+    print("latency_trend (sec):")
+    chunk = max(1, -(-len(history) // TREND_ROWS))
+    for i in range(0, len(history), chunk):
+        lats = [h[5]["lat"] for h in history[i : i + chunk]]
+        p50, p90, p99 = [_median([lat[j] for lat in lats]) for j in range(3)]
+        lmax = max(lat[3] for lat in lats)
+        print(
+            "  %s runs: %d p50: %.3f p90: %.3f p99: %.3f max: %.3f"
+            % (_ts_to_iso(history[i][0]), len(lats), p50, p90, p99, lmax)
+        )
+
+
+def _info_index_lag(history):
+    """
+    Print average and max index lag for each index measured in history,
+    and how many times waiting for it timed out.
+    """
+    lags = collections.defaultdict(list)
+    for hline in history:
+        if len(hline) > 5:
+            for name, lag in hline[5].get("lag", {}).items():
+                lags[name].append(lag)
+    if not lags:
+        return
+    print("index_lag (sec):")
+    for name in sorted(lags):
+        vals = [v for v in lags[name] if v is not None]
+        timeouts = len(lags[name]) - len(vals)
+        line = "  %s runs: %d" % (name, len(lags[name]))
+        if vals:
+            line += " avg: %.3f max: %.3f" % (sum(vals) / len(vals), max(vals))
+        if timeouts:
+            line += " timed out: %d" % timeouts
+        print(line)
+
+
+def _info_db_sizes(history):
+    """
+    Split history in up to TREND_ROWS consecutive chunks and print db sizes
+    sampled at the last checkpoint of each. Fragmentation is the percent of
+    the file not used by live data, as in the compaction daemon's
+    db_fragmentation setting. Growth rates are since the previous row.
+    """
+    history = [h for h in history if len(h) > 5 and has_sizes(h[5].get("db"))]
+    if not history:
+        return
+    print("db_size_trend (MB):")
+    chunk = max(1, -(-len(history) // TREND_ROWS))
+    prev = history[0]
+    for i in range(0, len(history), chunk):
+        last = history[min(i + chunk, len(history)) - 1]
+        sizes = last[5]["db"]
+        print(
+            "  %s runs: %d file: %.1f active: %.1f external: %.1f frag (%%): %.1f"
+            % (
+                _ts_to_iso(last[0]),
+                min(chunk, len(history) - i),
+                sizes["file_bytes"] / 1e6,
+                sizes["active_bytes"] / 1e6,
+                sizes.get("external_bytes", 0) / 1e6,
+                fragmentation_pct(sizes),
+            )
+        )
+        print(
+            "    growth file/active (MB/hour): %.1f / %.1f deleted docs: %d"
+            % (_growth(prev, last) + (sizes.get("doc_del_count", 0),))
+        )
+        prev = last
+    if len(history) > 1:
+        print(
+            "  overall growth file/active (MB/hour): %.1f / %.1f"
+            % _growth(history[0], history[-1])
+        )
+
+
+def _info_compactions(history):
+    """
+    Print compaction durations, bytes reclaimed and the db write rate seen
+    while compactions ran.
+    """
+    history = [h for h in history if len(h) > 5 and "compact" in h[5]]
+    if not history:
+        return
+    runs = [h[5]["compact"] for h in history]
+    dts = [r["dt"] for r in runs]
+    print("compactions:")
+    print("  count:", len(runs))
+    print("  last finished in run (utc):", _ts_to_iso(history[-1][0]))
+    print("  dt avg/max (sec): %.3f / %.3f" % (sum(dts) / len(dts), max(dts)))
+    print(
+        "  reclaimed db/views (MB): %.3f / %.3f"
+        % (
+            sum(r["reclaimed"] for r in runs) / 1e6,
+            sum(r["views_reclaimed"] for r in runs) / 1e6,
+        )
+    )
+    if sum(dts) > 0:
+        print(
+            "  avg db write rate during compaction (/sec): %.1f"
+            % (sum(r["writes"] for r in runs) / sum(dts))
+        )
+
+
+def _growth(h0, h1):
+    """
+    Return file and active size growth in MB/hour between two history
+    lines. Checkpoint timestamps are the start of the cycle, so the end of
+    each cycle is used.
+    """
+    dt = (h1[0] + h1[1]) - (h0[0] + h0[1])
+    if dt <= 0:
+        return (0.0, 0.0)
+    s0, s1 = h0[5]["db"], h1[5]["db"]
+    return tuple(
+        (s1[k] - s0[k]) / 1e6 / (dt / 3600.0) for k in ("file_bytes", "active_bytes")
+    )
+
+
+def _median(vals):
+    vals = sorted(vals)
+    return vals[len(vals) // 2]
+
+
 def _info_conflicts(db):
     view = _conflicts_view()
     view.sync(db)
@@ -226,29 +906,51 @@ def _info_conflicts(db):
 
 
 def _info_days(db):
-    view = _times_view()
-    view.sync(db)
-    _wait_for_view(db, view)
-    days = set()
-    for r in db.iterview(view.design + "/" + view.name, batch=100000):
-        dinst = datetime.datetime.utcfromtimestamp(int(r.key))
-        days.add(dinst.strftime("%Y-%m-%d"))
+    """
+    Print a per day census. Both views are reduced on the server and
+    grouped by day, so only one row per day is downloaded.
+    """
+    docs_view, updates_view = _days_view(), _updates_view()
+    ViewDefinition.sync_many(db, [docs_view, updates_view])
+    _wait_for_view(db, docs_view)
+    _wait_for_view(db, updates_view)
+    docs = dict((r.key, r.value) for r in docs_view(db, group=True))
+    updates = dict((r.key, r.value) for r in updates_view(db, group=True))
     print("Doc update census (per day):")
-    for d in sorted(days):
-        print(" ->", d)
+    print("  docs: docs last updated that day, updates: doc updates that day")
+    for d in sorted(set(docs) | set(updates)):
+        print(" ->", d, "docs:", docs.get(d, 0), "updates:", updates.get(d, 0))
 
 
-def _times_view():
+def _days_view():
     return ViewDefinition(
-        "couchdyno_times",
-        "times",
+        "couchdyno_census",
+        "days",
         """
 function(doc) {
-      if(doc._id.indexOf("couchdyno_") === 0 &&  doc.ts) {
-         emit(doc.ts, null);
+      if(doc._id.indexOf("%s") === 0 && doc.ts) {
+         emit(new Date(doc.ts * 1000).toISOString().slice(0, 10), null);
       }
 }
-""",
+"""
+        % IDPAT.split("%")[0],
+        reduce_fun="_count",
+    )
+
+
+def _updates_view():
+    return ViewDefinition(
+        "couchdyno_census",
+        "updates",
+        """
+function(doc) {
+      if(doc._id.indexOf("%s") === 0 && doc.ts) {
+         emit(new Date(doc.ts * 1000).toISOString().slice(0, 10), doc.updates);
+      }
+}
+"""
+        % HISTORY_PREFIX,
+        reduce_fun="_sum",
     )
 
 
@@ -294,7 +996,22 @@ class MetaDoc(dict):
             last_ts=0,
             last_dt=0,
             last_errors=0,
-            history=[],  # [[ts,dt,start,updates,errors],...]
+            seed=args.seed,
+            blind_writes=args.blind_writes,
+            writes=0,
+            distribution=args.distribution,
+            zipf_skew=args.zipf_skew,
+            hot_ops_pct=args.hot_ops_pct,
+            hot_keys_pct=args.hot_keys_pct,
+            workload=args.workload,
+            size_dist=args.size_dist,
+            size_sigma=args.size_sigma,
+            doc_shape=args.doc_shape,
+            fields=args.fields,
+            entropy=args.entropy,
+            attachment_pct=args.attachment_pct,
+            attachment_size=args.attachment_size,
+            attachment_size_dist=args.attachment_size_dist,
         )
 
     def load(self, db):
@@ -307,19 +1024,59 @@ class MetaDoc(dict):
         self.update(metadoc)
         return self
 
-    def checkpoint(self, db, start, ts, dt, updates, errors):
+    def checkpoint(self, db, start, ts, dt, updates, errors, stats=None, reads=0):
         """
-        Update current metadata and save to db.
+        Update current metadata and save to db. A separate history
+        doc is written for each run. Optional stats dict is kept as
+        the last element of the history line. Reads of mixed workloads
+        are kept out of updates, so rates and the census only count
+        writes, but they still advance the write counter so each run
+        gets new history ids and payload salts.
         """
-        hline = [ts, dt, self["start"], updates, errors]
+        hline = [ts, dt, self["start"], updates, errors, stats or {}]
+        self._migrate_history(db)
+        hdoc = _history_doc(hline, self.get("writes", 0))
+        if reads:
+            hdoc["reads"] = reads
+        db.save(hdoc)
         self["start"] = start
         self["last_ts"] = ts
         self["last_dt"] = dt
         self["last_updates"] = updates
         self["last_errors"] = errors
-        self["history"] = self["history"][-HISTORY_MAX:] + [hline]
+        self["writes"] = self.get("writes", 0) + updates + reads
+        self["cycles"] = self.get("cycles", 0) + 1
         return self.save(db)
 
+    def history(self, db, limit=HISTORY_MAX):
+        """
+        Return up to `limit` most recent history lines, oldest first, as
+        [[ts,dt,start,updates,errors,stats],...]. History docs are read
+        with an _all_docs range query. Older versions kept history inside
+        the meta doc, so those lines are included until migrated.
+        """
+        rows = db.view(
+            "_all_docs",
+            startkey=HISTORY_PREFIX + "\ufff0",
+            endkey=HISTORY_PREFIX,
+            descending=True,
+            include_docs=True,
+            limit=limit,
+        )
+        history = [_history_line(r.doc) for r in rows]
+        history.reverse()
+        legacy = self.get("history", [])
+        return (legacy + history)[-limit:] if limit > 0 else []
+
+    def _migrate_history(self, db):
+        """
+        Move history lines kept in the meta doc by older versions to
+        separate history docs.
+        """
+        legacy = self.pop("history", None)
+        if legacy:
+            db.update([_history_doc(hline, i) for i, hline in enumerate(legacy)])
+
     def save(self, db):
         db.save(self)
         return self
@@ -330,11 +1087,122 @@ class MetaDoc(dict):
                 continue
             elif k == "last_ts":
                 v = "%s (%s)" % (v, _ts_to_iso(v))
+            elif k == "blind_lag":
+                v = "%d docs" % len(v)
             elif k == "created" and isinstance(v, int):
                 v = "%s (%s)" % (v, _ts_to_iso(v))
             print("  %s: %s" % (str(k), str(v)))
 
 
+def _history_doc(hline, writes):
+    """
+    Build a history doc for one run. Ids start with the run's timestamp so
+    they sort by time, `writes` (the write counter before the run) makes
+    them unique.
+    """
+    ts, dt, start, updates, errors = hline[:5]
+    stats = hline[5] if len(hline) > 5 else {}
+    _id = HISTORY_PREFIX + "%012d_%015d" % (ts, writes)
+    return dict(
+        _id=_id, ts=ts, dt=dt, start=start, updates=updates, errors=errors, stats=stats
+    )
+
+
+def _history_line(doc):
+    return [doc[k] for k in ("ts", "dt", "start", "updates", "errors", "stats")]
+
+
+class _Progress(object):
+    """
+    Progress of the current update cycle, saved to a _local doc every
+    `every` batches so a cycle interrupted by a crash or a restart can be
+    resumed. Batch results are acknowledged in the order the batches were
+    generated, so `done` always covers a prefix of the cycle's docs.
+    """
+
+    ID = "_local/couchdyno_progress"
+
+    def __init__(self, db, every):
+        self.db = db
+        self.every = every
+        self.doc = db.get(self.ID) or {"_id": self.ID}
+        self.batches = 0
+
+    @classmethod
+    def open(cls, db, every):
+        return cls(db, every) if every > 0 else None
+
+    def saved(self, metadoc, fill):
+        """
+        Return saved progress if it was left by an unfinished run of the
+        metadoc's current cycle, otherwise None.
+        """
+        doc = self.doc
+        if doc.get("writes") != metadoc.get("writes", 0):
+            return None
+        if doc.get("fill") != fill:
+            return None
+        return doc
+
+    def begin(self, metadoc, fill, start, updates, ts, done=0, ok=0, key_seed=None):
+        self.doc.update(
+            writes=metadoc.get("writes", 0),
+            fill=fill,
+            start=start,
+            updates=updates,
+            ts=ts,
+            done=done,
+            ok=ok,
+            key_seed=key_seed,
+        )
+        self.batches = 0
+
+    def ack(self, n, ok):
+        self.doc["done"] += n
+        self.doc["ok"] += ok
+        self.batches += 1
+        if self.batches % self.every == 0:
+            self.db.save(self.doc)
+
+
+def _key_seed(metadoc, saved):
+    """
+    Seed for picking a cycle's doc keys. Without a --seed a random one is
+    used, and kept with the cycle's progress so a resumed cycle picks the
+    same keys.
+    """
+    if metadoc.get("seed") is not None:
+        return "%s-keys-%s" % (metadoc["seed"], metadoc.get("writes", 0))
+    if saved is not None and saved.get("key_seed") is not None:
+        return saved["key_seed"]
+    return "%016x" % random.getrandbits(64)
+
+
+def _get_dbs(dburl, dbs_file=None):
+    """
+    Return db handles for multi-db mode, or None if dburl is a single db.
+    Db names are read from dbs_file, or the db name in dburl is a pattern
+    matched against _all_dbs. The server is checked once and all handles
+    share its session, so dbs aren't checked one by one.
+    """
+    sres = urllib.parse.urlsplit(dburl)
+    # The pattern is taken from the raw url, as urlsplit would take a "?"
+    # in it as the start of a query string
+    parts = dburl.split("/", 3)
+    pattern = parts[3] if len(parts) > 3 else ""
+    if dbs_file is None and not any(c in pattern for c in "*?["):
+        return None
+    srvurl = urllib.parse.urlunsplit(sres._replace(path="", query="", fragment=""))
+    srv = couchdb.Server(srvurl)
+    srv.version()  # throws if can't connect to server
+    if dbs_file is not None:
+        with open(dbs_file) as f:
+            names = [line.strip() for line in f if line.strip()]
+    else:
+        names = sorted(fnmatch.filter(srv, pattern))
+    return [couchdb.Database(srv.resource(name), name) for name in names]
+
+
 def _get_db(dburl, create=True, reset_db=False):
     """
     Get a db handle. Optionally reset / create.
@@ -369,125 +1237,1544 @@ def _batch_size(docsize):
     return 1
 
 
-def _intervals(start, updates, total):
+def _request_limits(db):
     """
-    Calculate 2 intervals based on wrap-around.
-    So start+updates could point past end of docs,
-    in that case go back to start.
+    Return (max_document_size, max_http_request_size) from the server
+    config. If config is not readable (not an admin, or an older server)
+    return CouchDB defaults.
     """
-    updates = min(updates, total)
-    wrap = max(0, start + updates - total)
-    if wrap > 0:
-        return range(start, total), range(0, wrap)
-    else:
-        return range(start, start + updates), range(0, 0)
+    res = server_resource(db)
+    limits = []
+    for (section, key, default) in [
+        ("couchdb", "max_document_size", MAX_DOCUMENT_SIZE),
+        ("chttpd", "max_http_request_size", MAX_HTTP_REQUEST_SIZE),
+    ]:
+        try:
+            _, _, val = res.get_json("_node/_local/_config/%s/%s" % (section, key))
+            limits.append(int(val))
+        except (couchdb.http.HTTPError, ValueError, TypeError):
+            limits.append(default)
+    return tuple(limits)
 
 
-def _docrevs(db, *intervals):
+class _BatchSizer(PicklableLock):
     """
-    Given a db and *args of intervals,
-    where an interval is a sorted list
-    of doc ids, fetches revisions for those docs
-    using an efficient range query (_all_docs).
+    Bulk docs batch size controller. With a target latency, after each
+    request the batch size is moved toward the size which would have taken
+    target_latency seconds, at most halving or doubling it at a time. Request
+    bytes are kept under max_http_request_size, using the largest bytes per
+    doc seen in a request body so far. Without a target latency the batch
+    size stays fixed at the _batch_size() guess.
     """
-    revs = {}
-    for interval in intervals:
-        if not interval:
-            continue
-        for r in db.iterview(
-            "_all_docs",
-            startkey=interval[0],
-            endkey=interval[-1],
-            inclusive_end=True,
-            batch=2000,
-        ):
-            revs[str(r.id)] = str(r.value["rev"])
-    return revs
 
+    def __init__(
+        self, docsize, target_latency=0, max_request_size=MAX_HTTP_REQUEST_SIZE
+    ):
+        self.docbytes = docsize + DOC_OVERHEAD
+        self.target_latency = target_latency
+        self.max_request_size = max_request_size
+        self.max_size = self._max_size()
+        self.size = min(_batch_size(docsize), self.max_size)
+        self.lock = threading.Lock()
+        self.sizes = []
+        self.sent = 0
 
-def _random_data(size):
-    return "".join(random.choice(string.ascii_lowercase) for _ in range(size))
-
+    @classmethod
+    def from_db(cls, db, metadoc, target_latency=0, out=None):
+        """
+        Raise ValueError if every doc would be above max_document_size.
+        A warning is printed to `out` if only some docs would be.
+        """
+        docsize = metadoc["size"]
+        if target_latency <= 0:
+            return cls(docsize)
+        max_doc, max_request = _request_limits(db)
+        size_dist = metadoc.get("size_dist", "fixed")
+        largest = max_doc_size(docsize, size_dist) + DOC_OVERHEAD
+        if size_dist == "fixed" and largest > max_doc:
+            raise ValueError("doc size is above max_document_size %d" % max_doc)
+        if largest > max_doc:
+            print(
+                "WARNING: largest docs are above max_document_size", max_doc, file=out
+            )
+        return cls(docsize, target_latency, max_request)
 
-def _bulk_update(db, docrevs, size, ts, docids):
-    """
-    Update one batch using bulk docs updates. Return
-    number of successfully updated docs.
-    """
-    docs = []
-    for _id in docids:
-        doc = dict(_id=_id, ts=ts, data=_random_data(size))
-        _rev = docrevs.get(_id)
-        if _rev is not None:
-            doc["_rev"] = _rev
-        docs.append(doc)
-    res = db.update(docs)
-    ok = 0
-    for resdoc in res:
-        if resdoc[0]:
-            ok += 1
-    return ok
+    def _max_size(self):
+        return max(1, min(BATCH_MAX, self.max_request_size // self.docbytes))
 
+    def reset(self):
+        self.sizes = []
+        self.sent = 0
 
-def _ts_to_iso(ts):
-    return datetime.datetime.utcfromtimestamp(ts).isoformat()
+    def next(self):
+        """
+        Return size of the next batch to send.
+        """
+        return self.size
 
+    def observe(self, n, dt, nbytes):
+        """
+        Record that a batch of n docs with a nbytes long body took dt
+        seconds.
+        """
+        with self.lock:
+            self.sizes.append(n)
+            self.sent += nbytes
+            if n > 0 and nbytes > n * self.docbytes:
+                self.docbytes = -(-nbytes // n)
+                self.max_size = self._max_size()
+                self.size = min(self.size, self.max_size)
+            if self.target_latency <= 0 or dt <= 0:
+                return
+            ratio = min(2.0, max(0.5, self.target_latency / dt))
+            size = int(round((self.size + n * ratio) / 2.0))
+            self.size = max(1, min(self.max_size, size))
 
-def _update_docs(db, metadoc, updates=0):
+    def merge(self, sizers):
+        """
+        Merge sizers used by other processes during the cycle.
+        """
+        for sizer in sizers:
+            self.sizes.extend(sizer.sizes)
+            self.sent += sizer.sent
+            self.docbytes = max(self.docbytes, sizer.docbytes)
+        self.max_size = self._max_size()
+        if sizers:
+            self.size = int(sum(sizer.size for sizer in sizers) / len(sizers))
+
+    def stats(self):
+        """
+        Return [min, avg, max] batch size of batches sent since last reset.
+        """
+        if not self.sizes:
+            return [0, 0, 0]
+        avg = int(sum(self.sizes) / len(self.sizes))
+        return [min(self.sizes), avg, max(self.sizes)]
+
+
+class _RateLimiter(PicklableLock):
     """
-    Main logic. Start at metadoc['start'] and
-    update next metadoc['updates'] documents (can be
-    overriden by optional updates parameters). If needed
-    wrap around back to start. When done, checkpoint
-    meta document to db.
+    Paces doc updates to `rate` docs per second. Send times follow a fixed
+    schedule which carries over from one cycle to the next. acquire()
+    returns the time a batch was meant to be sent, so latency can be
+    measured from that instead of from when the request actually went
+    out. That way a server stall shows up as latency rather than only as
+    lower throughput (coordinated omission).
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.next = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def open(cls, rate):
+        if rate <= 0:
+            return None
+        return cls(rate)
+
+    def split(self, n):
+        """
+        Return a limiter for one of n processes sharing this rate.
+        """
+        limiter = _RateLimiter(self.rate / n)
+        limiter.next = self.next
+        return limiter
+
+    def acquire(self, n):
+        """
+        Wait until n docs can be sent. Return intended send time.
+        """
+        now = time.time()
+        with self.lock:
+            if self.next is None:
+                self.next = now
+            intended = self.next
+            self.next += n / self.rate
+        if intended > now:
+            time.sleep(intended - now)
+        return intended
+
+    def pause(self, dt):
+        """
+        Move the schedule forward by dt seconds, after an intentional pause.
+        """
+        with self.lock:
+            if self.next is not None:
+                self.next += dt
+
+
+def _sleep(limiter, seconds):
+    """
+    Sleep between cycles. The rate limiter schedule is paused meanwhile,
+    so the next cycle isn't sent in a burst to catch up with the sleep and
+    the sleep isn't counted as latency.
     """
     t0 = time.time()
+    time.sleep(seconds)
+    if limiter is not None:
+        limiter.pause(time.time() - t0)
+
+
+def _intervals(start, updates, total):
+    """
+    Calculate 2 intervals based on wrap-around.
+    So start+updates could point past end of docs,
+    in that case go back to start.
+    """
+    updates = min(updates, total)
+    wrap = max(0, start + updates - total)
+    if wrap > 0:
+        return range(start, total), range(0, wrap)
+    else:
+        return range(start, start + updates), range(0, 0)
+
+
+class _Zipf(object):
+    """
+    Zipf distributed ranks in [1, n] with P(k) ~ 1 / k^skew. Uses the
+    rejection-inversion method of Hormann and Derflinger, so sampling
+    takes constant time and memory regardless of n.
+    """
+
+    def __init__(self, n, skew):
+        self.n = n
+        self.skew = skew
+        self.hx1 = self._hint(1.5) - 1.0
+        self.hn = self._hint(n + 0.5)
+        self.s = 2.0 - self._hint_inv(self._hint(2.5) - self._h(2.0))
+
+    def _h(self, x):
+        return math.exp(-self.skew * math.log(x))
+
+    def _hint(self, x):
+        logx = math.log(x)
+        return _expm1_div((1.0 - self.skew) * logx) * logx
+
+    def _hint_inv(self, x):
+        t = max(-1.0, x * (1.0 - self.skew))
+        return math.exp(_log1p_div(t) * x)
+
+    def sample(self, rng):
+        while True:
+            u = self.hn + rng.random() * (self.hx1 - self.hn)
+            x = self._hint_inv(u)
+            k = min(self.n, max(1, int(x + 0.5)))
+            if k - x <= self.s or u >= self._hint(k + 0.5) - self._h(k):
+                return k
+
+
+def _log1p_div(x):
+    if abs(x) > 1e-8:
+        return math.log1p(x) / x
+    return 1.0 - x * (0.5 - x * (1.0 / 3.0 - 0.25 * x))
+
+
+def _expm1_div(x):
+    if abs(x) > 1e-8:
+        return math.expm1(x) / x
+    return 1.0 + x * 0.5 * (1.0 + x / 3.0 * (1.0 + 0.25 * x))
+
+
+def _picker(metadoc, rng):
+    """
+    Return a function which picks a random doc index according to the
+    metadoc key distribution. sequential picks uniformly.
+    """
+    total = metadoc["total"]
+    distribution = metadoc.get("distribution", "sequential")
+    if distribution in ("uniform", "sequential"):
+        return lambda: rng.randrange(total)
+    elif distribution == "zipf":
+        zipf = _Zipf(total, metadoc.get("zipf_skew", DEFAULT_ZIPF_SKEW))
+        return lambda: zipf.sample(rng) - 1
+    elif distribution == "hotspot":
+        hot_ops = metadoc.get("hot_ops_pct", DEFAULT_HOT_OPS_PCT) / 100.0
+        hot_keys = metadoc.get("hot_keys_pct", DEFAULT_HOT_KEYS_PCT) / 100.0
+        hot = min(total, max(1, int(total * hot_keys)))
+
+        def pick():
+            if hot == total or rng.random() < hot_ops:
+                return rng.randrange(hot)
+            return rng.randrange(hot, total)
+
+        return pick
+    raise ValueError("Unknown distribution %s" % distribution)
+
+
+class _Keys(object):
+    """
+    Random doc indices for a cycle, picked according to the metadoc key
+    distribution. Iterating yields sorted lists of the indices picked by
+    up to REVS_CHUNK picks at a time, after skipping the first `skip`
+    ones. Hot docs may be picked more than once, those are updated only
+    once per run, so there can be fewer than `picks` indices. Picked docs
+    are tracked in a bitmap of `total` bits, so memory use doesn't depend
+    on the number of picks. `count` is the number of indices picked so
+    far, including skipped ones.
+    """
+
+    def __init__(self, metadoc, picks, rng, skip=0):
+        self.pick = _picker(metadoc, rng)
+        self.picks = picks
+        self.skip = skip
+        self.seen = bytearray(metadoc["total"] // 8 + 1)
+        self.count = 0
+
+    def __iter__(self):
+        seen, pick = self.seen, self.pick
+        for i in range(0, self.picks, REVS_CHUNK):
+            chunk = []
+            for _ in range(min(REVS_CHUNK, self.picks - i)):
+                idx = pick()
+                byte, bit = idx >> 3, 1 << (idx & 7)
+                if not seen[byte] & bit:
+                    seen[byte] |= bit
+                    chunk.append(idx)
+            chunk.sort()
+            n = min(len(chunk), max(0, self.skip - self.count))
+            self.count += len(chunk)
+            if len(chunk) > n:
+                yield chunk[n:]
+
+
+def _skip(intervals, n):
+    """
+    Drop the first n doc indices from a list of ranges.
+    """
+    remaining = []
+    for interval in intervals:
+        if n >= len(interval):
+            n -= len(interval)
+            continue
+        remaining.append(interval[n:])
+        n = 0
+    return remaining
+
+
+def _contiguous(interval):
+    return _docidx(interval[-1]) - _docidx(interval[0]) + 1 == len(interval)
+
+
+def _docrevs(db, *intervals):
+    """
+    Given a db and *args of intervals,
+    where an interval is a sorted list
+    of doc ids, fetches revisions for those docs
+    using an efficient range query (_all_docs).
+    Scattered ids are fetched by key in batches.
+    """
+    revs = {}
+    for interval in intervals:
+        if not interval:
+            continue
+        if not _contiguous(interval):
+            revs.update(_docrevs_keys(db, interval))
+            continue
+        for r in db.iterview(
+            "_all_docs",
+            startkey=interval[0],
+            endkey=interval[-1],
+            inclusive_end=True,
+            batch=2000,
+        ):
+            revs[str(r.id)] = str(r.value["rev"])
+    return revs
+
+
+def _docrevs_keys(db, docids):
+    """
+    Fetch revisions for a scattered list of doc ids with
+    _all_docs keys=[...] requests of up to KEYS_BATCH ids
+    each. Missing docs are skipped.
+    """
+    revs = {}
+    docids = list(docids)
+    for i in range(0, len(docids), KEYS_BATCH):
+        for r in db.view("_all_docs", keys=docids[i : i + KEYS_BATCH]):
+            if r.id is not None and r.value is not None:
+                revs[str(r.id)] = str(r.value["rev"])
+    return revs
+
+
+def _docidx(_id):
+    return int(_id.rsplit("_", 1)[1])
+
+
+class _RevCache(object):
+    """
+    Local on-disk cache of revisions couchdyno wrote itself. Revisions are
+    stored in fixed-width records indexed by doc number, so a contiguous
+    interval of ids is read with a single pread() call. Workers write their
+    results with pwrite() so no locking is needed.
+    """
+
+    def __init__(self, path, reset=False):
+        flags = os.O_RDWR | os.O_CREAT
+        if reset:
+            flags |= os.O_TRUNC
+        self.path = path
+        self.fd = os.open(path, flags, 0o644)
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    @classmethod
+    def open(cls, path, reset=False):
+        if not path:
+            return None
+        return cls(path, reset=reset)
+
+    def get(self, interval):
+        """
+        Return a {docid: rev} dict of cached revisions for a
+        sorted list of doc ids. If ids are not too scattered
+        their whole span is read with a single pread() call.
+        """
+        revs = {}
+        if not interval:
+            return revs
+        lo, hi = _docidx(interval[0]), _docidx(interval[-1])
+        if hi - lo + 1 > 16 * len(interval):
+            for _id in interval:
+                revs.update(self.get([_id]))
+            return revs
+        buf = os.pread(self.fd, (hi - lo + 1) * REV_RECORD, lo * REV_RECORD)
+        for _id in interval:
+            i = _docidx(_id) - lo
+            rev = buf[i * REV_RECORD : (i + 1) * REV_RECORD].rstrip(b"\0 ")
+            if rev:
+                revs[_id] = rev.decode("ascii")
+        return revs
+
+    def put(self, _id, rev):
+        record = rev.encode("ascii").ljust(REV_RECORD, b" ")[:REV_RECORD]
+        os.pwrite(self.fd, record, _docidx(_id) * REV_RECORD)
+
+
+def _cached_docrevs(db, revcache, *intervals):
+    """
+    Like _docrevs but first look in the local revision cache. If the cache
+    has nothing for these intervals fall back to an _all_docs range scan,
+    otherwise only fetch the few missing ids by key.
+    """
+    if revcache is None:
+        return _docrevs(db, *intervals), 0
+    revs = {}
+    for interval in intervals:
+        revs.update(revcache.get(interval))
+    cached = len(revs)
+    if not cached:
+        return _docrevs(db, *intervals), 0
+    missing = [_id for interval in intervals for _id in interval if _id not in revs]
+    revs.update(_docrevs_keys(db, missing))
+    return revs, cached
+
+
+def _post_bulk_docs(db, parts, timers=NO_TIMERS):
+    """
+    POST a _bulk_docs request body given as a list of bytes-like parts.
+    The parts are joined in a single copy. Return the decoded response and
+    the body length. Joining is timed as the encode phase, and sending the
+    request and reading the response as the http phase.
+    """
+    headers = {"Content-Type": "application/json"}
+    body = b"".join(parts)
+    timers.lap("encode")
+    _, _, data = db.resource.post("_bulk_docs", body=body, headers=headers)
+    data = data.read()
+    timers.lap("http")
+    return json.loads(data.decode("utf-8")), len(body)
+
+
+def _ts_slot(ts):
+    """
+    Timestamps part of the doc template: the cycle's `ts` in seconds, and
+    `ts_ms`, when the batch was built in milliseconds, which _changes
+    consumers measure delays from.
+    """
+    return b'"ts":%d,"ts_ms":%d,"data":' % (ts, int(time.time() * 1000))
+
+
+def _doc_parts(parts, _id, ts_slot, payload, extra=None):
+    """
+    Append the JSON encoding of a couchdyno doc to parts using a fixed
+    template: {"_id":"..",<extra>"ts":..,"ts_ms":..,"data":..}. Ids,
+    revisions and data are plain ASCII which never needs escaping, so
+    they are written as is instead of building a dict and JSON encoding
+    it.
+    """
+    parts.append(b'{"_id":"')
+    parts.append(_id.encode("ascii"))
+    parts.append(b'",')
+    if extra is not None:
+        parts.append(extra)
+    parts.append(ts_slot)
+    payload.data_parts(parts, _id)
+    parts.append(b"},")
+
+
+def _bulk_update(
+    db, docrevs, payload, ts, docids, revcache=None, newrevs=None, timers=NO_TIMERS
+):
+    """
+    Update one batch using bulk docs updates. Return
+    number of successfully updated docs, a list of
+    doc ids which failed with a conflict and the
+    request body length. New revisions are recorded
+    in the optional revision cache and the optional
+    newrevs dict.
+    """
+    timers.start()
+    ts_slot = _ts_slot(ts)
+    parts = [b'{"docs":[']
+    for _id in docids:
+        _rev = docrevs.get(_id)
+        extra = None if _rev is None else b'"_rev":"%s",' % _rev.encode("ascii")
+        _doc_parts(parts, _id, ts_slot, payload, extra)
+    parts[-1] = parts[-1].rstrip(b",")
+    parts.append(b"]}")
+    timers.lap("payload")
+    ok, conflicts = 0, []
+    results, nbytes = _post_bulk_docs(db, parts, timers)
+    for res in results:
+        if "error" not in res:
+            ok += 1
+            if revcache is not None:
+                revcache.put(res["id"], res["rev"])
+            if newrevs is not None:
+                newrevs[res["id"]] = res["rev"]
+        elif res["error"] == "conflict":
+            conflicts.append(res["id"])
+    timers.lap("parse")
+    return ok, conflicts, nbytes
+
+
+class _PrefixedOutput(object):
+    """
+    File for print(file=...) which writes each line to stdout starting
+    with prefix. Dbs updated in parallel print through their own one, so
+    their lines can be told apart and are written whole.
+    """
+
+    lock = threading.Lock()
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.buf = ""
+
+    def write(self, data):
+        self.buf += data
+        if "\n" in self.buf:
+            lines, self.buf = self.buf.rsplit("\n", 1)
+            with self.lock:
+                for line in lines.split("\n"):
+                    sys.stdout.write((self.prefix + line).rstrip() + "\n")
+        return len(data)
+
+    def flush(self):
+        sys.stdout.flush()
+
+
+class _WorkerPool(object):
+    """
+    Bounded pool of threads sending _bulk_docs batches. Each worker thread
+    lazily opens its own HTTP session, with a db handle per db it sends
+    batches to, so requests don't contend for a single connection. Threads
+    and sessions are kept until close(), so a pool can be reused across
+    cycles and shared by dbs updated in parallel. `threads` defaults to
+    `concurrency`, the number of workers each map() call uses.
+    """
+
+    def __init__(self, concurrency, threads=None):
+        self.concurrency = max(1, concurrency)
+        self.threads = max(self.concurrency, threads or 0)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def worker_db(self, db):
+        """
+        Return handle for db private to the calling worker thread.
+        """
+        if getattr(self.local, "session", None) is None:
+            self.local.session = couchdb.Session()
+            self.local.dbs = {}
+        wdb = self.local.dbs.get(db.resource.url)
+        if wdb is None:
+            wdb = couchdb.Database(db.resource.url, session=self.local.session)
+            wdb.resource.credentials = db.resource.credentials
+            self.local.dbs[db.resource.url] = wdb
+        return wdb
+
+    def map(self, db, fun, batches):
+        """
+        Call fun(db, batch) for each batch and yield results in order. At
+        most 2 * concurrency batches are in flight at any time, so batches
+        can be a lazy iterable.
+        """
+        if self.concurrency <= 1:
+            for batch in batches:
+                yield fun(db, batch)
+            return
+
+        def call(batch):
+            return fun(self.worker_db(db), batch)
+
+        with self.lock:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(self.threads)
+            executor = self.executor
+        pending = collections.deque()
+        try:
+            for batch in batches:
+                if len(pending) >= 2 * self.concurrency:
+                    yield pending.popleft().result()
+                pending.append(executor.submit(call, batch))
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            concurrent.futures.wait(pending)
+
+    def close(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+
+def _revid(_id, gen):
+    return hashlib.md5(("%s-%d" % (_id, gen)).encode("ascii")).hexdigest()
+
+
+def _blind_revisions(_id, gen, since=None):
+    """
+    Revision path for the gen-th write of a document. Revision ids are
+    derived from the doc id and generation, so the current leaf revision
+    is known without reading it from the db. The path goes back to the
+    previous generation, or to `since`, the last generation known to be
+    written, for docs whose earlier writes failed.
+    """
+    oldest = gen - 1 if since is None else since
+    oldest = max(1, oldest, gen - BLIND_REVS_MAX + 1)
+    ids = [_revid(_id, g) for g in range(gen, oldest - 1, -1)]
+    return {"start": gen, "ids": ids}
+
+
+def _blind_gen(writes, total, _id):
+    """
+    Documents are always written in order, wrapping around at total, so
+    after `writes` doc writes, doc number i was written (writes - i + total
+    - 1) // total times. Return the generation of its next write.
+    """
+    return (writes - _docidx(_id) + total - 1) // total + 1
+
+
+def _blind_update(db, writes, total, payload, ts, docids, timers=NO_TIMERS, lag=None):
+    """
+    Update one batch using new_edits=false bulk docs updates. `lag` is a
+    {doc id: last written generation} dict of docs whose earlier writes
+    failed. Return number of successfully updated docs, ids of docs which
+    failed and the request body length.
+    """
+    timers.start()
+    ts_slot = _ts_slot(ts)
+    parts = [b'{"new_edits":false,"docs":[']
+    for _id in docids:
+        gen = _blind_gen(writes, total, _id)
+        revisions = _blind_revisions(_id, gen, lag.get(_id) if lag else None)
+        extra = b'"_revisions":{"start":%d,"ids":["%s"]},' % (
+            gen,
+            '","'.join(revisions["ids"]).encode("ascii"),
+        )
+        _doc_parts(parts, _id, ts_slot, payload, extra)
+    parts[-1] = parts[-1].rstrip(b",")
+    parts.append(b"]}")
+    timers.lap("payload")
+    res, nbytes = _post_bulk_docs(db, parts, timers)
+    failed = [resdoc["id"] for resdoc in res if "error" in resdoc]
+    timers.lap("parse")
+    return len(docids) - len(failed), failed, nbytes
+
+
+def _track_blind_lag(metadoc, failed, intervals, total, out=None):
+    """
+    Keep metadoc['blind_lag'], a {doc id: last written generation} dict of
+    docs whose blind writes failed, up to date after a cycle. Their next
+    write sends the revision path back to that generation, so it extends
+    the doc's leaf instead of adding a conflicting branch. Print and
+    return the number of lagging docs.
+    """
+    lag = metadoc.get("blind_lag", {})
+    failed = set(failed)
+    for _id in list(lag):
+        idx = _docidx(_id)
+        if _id not in failed and any(idx in interval for interval in intervals):
+            del lag[_id]
+    dropped = 0
+    for _id in sorted(failed):
+        if _id in lag:
+            continue
+        if len(lag) >= BLIND_LAG_MAX:
+            dropped += 1
+            continue
+        lag[_id] = _blind_gen(metadoc.get("writes", 0), total, _id) - 1
+    metadoc["blind_lag"] = lag
+    if failed or lag:
+        print("blind_writes:", file=out)
+        print("  failed:", len(failed), file=out)
+        print("  lagging docs:", len(lag), file=out)
+        if dropped:
+            print("(!)not tracked, will add conflicting branches:", dropped, file=out)
+        print(file=out)
+    return len(lag)
+
+
+def _ts_to_iso(ts):
+    return datetime.datetime.utcfromtimestamp(ts).isoformat()
+
+
+def _print_revs(revcache, count, cached, dt, out=None):
+    """
+    Print how many revisions were fetched and how long it took.
+    """
+    if not count:
+        return
+    print("revs:", file=out)
+    print("  count:", count, file=out)
+    if revcache is not None:
+        print("  cached:", cached, file=out)
+    print("  dt (sec): %.3f" % dt, file=out)
+    if dt > 0:
+        print("  rate (/sec):", int(count / dt), file=out)
+    print(file=out)
+
+
+def _update_intervals(
+    db, cycle, intervals, pool, revcache, sizer, limiter, latencies, progress, out=None
+):
+    """
+    Fetch revisions for and update docs in a list of doc index
+    ranges. `cycle` holds settings shared by all the ranges of
+    a cycle (total, blind, writes, ts, payload, attachments and
+    phase timers). Return the number of successfully updated docs,
+    attachment [count, bytes, dt, errors] stats and revision fetch
+    [count, cached, dt] stats. Batches are sent by the `pool`
+    _WorkerPool. Completed batches are acknowledged to the optional
+    progress checkpoint.
+
+    This is a generator pipeline: ids are generated and their
+    revisions fetched REVS_CHUNK docs at a time, then split in
+    batches, so memory use doesn't depend on the number of
+    updates.
+    """
+    total, ts, payload = cycle["total"], cycle["ts"], cycle["payload"]
+    blind, writes = cycle["blind"], cycle["writes"]
+    attachments = cycle.get("attachments")
+    timers = cycle.get("timers", NO_TIMERS)
+    revstats = {"count": 0, "cached": 0, "dt": 0.0}
+
+    def chunks():
+        for interval in intervals:
+            for i in range(0, len(interval), REVS_CHUNK):
+                docids = [IDPAT % idx for idx in interval[i : i + REVS_CHUNK]]
+                if blind:
+                    yield docids, {}
+                    continue
+                trev0 = time.time()
+                timers.start()
+                docrevs, cached = _cached_docrevs(db, revcache, docids)
+                timers.lap("revs")
+                revstats["dt"] += time.time() - trev0
+                revstats["count"] += len(docrevs)
+                revstats["cached"] += cached
+                yield docids, docrevs
+
+    def batches(chunks):
+        for docids, docrevs in chunks:
+            i = 0
+            while i < len(docids):
+                docid_batch = docids[i : i + sizer.next()]
+                intended = None
+                if limiter is not None:
+                    timers.start()
+                    intended = limiter.acquire(len(docid_batch))
+                    timers.lap("rate_wait")
+                yield intended, docid_batch, docrevs
+                i += len(docid_batch)
+
+    def update_batch(bdb, batch):
+        intended, docid_batch, docrevs = batch
+        newrevs = {} if attachments is not None else None
+        bt0 = time.time()
+        if blind:
+            res = _blind_update(
+                bdb, writes, total, payload, ts, docid_batch, timers, cycle["lag"]
+            )
+        else:
+            res = _bulk_update(
+                bdb, docrevs, payload, ts, docid_batch, revcache, newrevs, timers
+            )
+        bt1 = time.time()
+        batch_ok, conflicts, nbytes = res
+        sizer.observe(len(docid_batch), bt1 - bt0, nbytes)
+        latencies.record(bt1 - (bt0 if intended is None else intended))
+        att = [0, 0, 0.0, 0]
+        if newrevs:
+            timers.start()
+            att = put_attachments(bdb, attachments, newrevs, revcache)
+            timers.lap("attachments")
+        return batch_ok, conflicts, len(docid_batch), att
+
+    # Conflicts are only kept to be retried with a revision cache or tracked
+    # for blind writes, up to CONFLICTS_MAX of them
+    keep = CONFLICTS_MAX if blind or revcache is not None else 0
+    ok, conflicts, dropped, attstats = 0, [], 0, [0, 0, 0.0, 0]
+    for (batch_ok, batch_conflicts, n, att) in pool.map(
+        db, update_batch, batches(chunks())
+    ):
+        ok += batch_ok
+        room = max(0, keep - len(conflicts))
+        conflicts.extend(batch_conflicts[:room])
+        if keep:
+            dropped += max(0, len(batch_conflicts) - room)
+        attstats = [a + b for (a, b) in zip(attstats, att)]
+        if progress is not None:
+            timers.start()
+            progress.ack(n, batch_ok)
+            timers.lap("checkpoint")
+    _print_revs(revcache, revstats["count"], revstats["cached"], revstats["dt"], out)
+    if dropped:
+        what = "tracked" if blind else "retried"
+        print("(!)conflicts not %s:" % what, dropped, file=out)
+    if blind:
+        cycle["failed"].extend(conflicts)
+    elif conflicts and revcache is not None:
+        print("  refetching revs for conflicts:", len(conflicts), file=out)
+        docrevs = _docrevs_keys(db, conflicts)
+        for batch in batches([(conflicts, docrevs)]):
+            res = update_batch(db, batch)
+            ok += res[0]
+            attstats = [a + b for (a, b) in zip(attstats, res[3])]
+    return ok, attstats, [revstats["count"], revstats["cached"], revstats["dt"]]
+
+
+def _update_shard(shard):
+    """
+    Process pool entry point for multi-process updates. Opens its
+    own db handle, updates one shard and returns counters for the
+    parent process to merge.
+    """
+    url, credentials, cycle, intervals, concurrency = shard[:5]
+    revcache, sizer, limiter = shard[5:]
+    db = couchdb.Database(url)
+    db.resource.credentials = credentials
+    latencies = Histogram()
+    timers = None
+    if isinstance(cycle.get("timers"), PhaseTimers):
+        timers = cycle["timers"] = PhaseTimers()
+    pool = _WorkerPool(concurrency)
+    ok, attstats, revstats = _update_intervals(
+        db, cycle, intervals, pool, revcache, sizer, limiter, latencies, None
+    )
+    pool.close()
+    failed = cycle.get("failed")
+    return ok, sizer, limiter, latencies, attstats, timers, revstats, failed
+
+
+def _shards(intervals, n):
+    """
+    Split a list of ranges into up to n lists of ranges. Each covers a
+    contiguous part of the same sequence of doc indices, so together they
+    update exactly the same docs as the original ranges, including when
+    they wrap around.
+    """
+    count = sum(len(interval) for interval in intervals)
+    per = max(1, -(-count // n))
+    shards, shard, left = [], [], per
+    for interval in intervals:
+        while len(interval) > 0:
+            part, interval = interval[:left], interval[left:]
+            shard.append(part)
+            left -= len(part)
+            if left == 0:
+                shards.append(shard)
+                shard, left = [], per
+    if shard:
+        shards.append(shard)
+    return shards
+
+
+def _update_docs_multiprocess(
+    db, cycle, intervals, processes, concurrency, revcache, sizer, limiter, latencies
+):
+    """
+    Update intervals using a pool of processes, each handling a contiguous
+    shard of the intervals, and merge their counters. Return the number of
+    successfully updated docs and merged attachment and revision fetch
+    stats. Revisions are fetched in parallel, so dt is the longest one.
+    """
+    shards = _shards(intervals, processes)
+    nshards = len(shards)
+    if nshards == 0:
+        return 0, [0, 0, 0.0, 0], [0, 0, 0.0]
+    shard_limiter = limiter.split(nshards) if limiter is not None else None
+    specs = [
+        (
+            db.resource.url,
+            db.resource.credentials,
+            cycle,
+            shard,
+            concurrency,
+            revcache,
+            sizer,
+            shard_limiter,
+        )
+        for shard in shards
+    ]
+    ok, attstats, revstats = 0, [0, 0, 0.0, 0], [0, 0, 0.0]
+    with concurrent.futures.ProcessPoolExecutor(nshards) as executor:
+        results = list(executor.map(_update_shard, specs))
+    for (shard_ok, _, _, shard_latencies, att, timers, revs, failed) in results:
+        ok += shard_ok
+        if failed:
+            cycle["failed"].extend(failed)
+        latencies.merge(shard_latencies)
+        attstats = [a + b for (a, b) in zip(attstats, att)]
+        count, cached, dt = revstats
+        revstats = [count + revs[0], cached + revs[1], max(dt, revs[2])]
+        if timers is not None:
+            cycle["timers"].merge(timers)
+    sizer.merge([r[1] for r in results])
+    if limiter is not None:
+        limiter.next = max(r[2].next for r in results)
+    return ok, attstats, revstats
+
+
+def _update_docs(
+    db,
+    metadoc,
+    updates=0,
+    concurrency=1,
+    revcache=None,
+    sizer=None,
+    limiter=None,
+    processes=1,
+    progress=None,
+    resume=False,
+    indexes=None,
+    consumers=None,
+    fill=False,
+    timers=None,
+    metrics=None,
+    compactor=None,
+    pool=None,
+    out=None,
+):
+    """
+    Main logic. Start at metadoc['start'] and update next
+    metadoc['updates'] documents (can be overriden by optional
+    updates parameter). If needed wrap around back to start. When
+    done, checkpoint meta document to db. Key distribution, blind
+    writes and attachments are set in the meta doc. If a mixed
+    workload is configured, run that instead. Optional parameters:
+
+      * concurrency : number of workers sending batches in parallel
+      * revcache : read revisions from it instead of the db.
+        Conflicted docs are refetched and retried once
+      * sizer, limiter : pick batch sizes and pace batches
+      * processes : update contiguous shards of the cycle's docs
+        from these many processes
+      * progress, resume : save progress within the cycle, and
+        continue an interrupted cycle after the last acknowledged
+        batch
+      * indexes : measure index lag after the cycle
+      * consumers : collect _changes consumer stats after the cycle
+      * fill : force sequential updates, to initially fill the db
+      * timers : accumulate time spent in each phase of the cycle
+      * metrics : add the cycle's results to metrics
+      * compactor : start compaction before the cycle when due, and
+        save its results after the cycle it finished in
+      * pool : _WorkerPool sending the batches, so its threads and
+        sessions are reused across cycles. By default one is created
+        for this cycle
+      * out : file the cycle's output is printed to, by default stdout
+    """
+    if pool is None:
+        pool = _WorkerPool(concurrency)
+    if metadoc.get("workload") and not fill:
+        return _workload_cycle(
+            db,
+            metadoc,
+            updates,
+            concurrency,
+            limiter,
+            consumers=consumers,
+            timers=timers,
+            metrics=metrics,
+            compactor=compactor,
+            pool=pool,
+            out=out,
+        )
+    t0 = time.time()
     total = metadoc["total"]
     size = metadoc["size"]
-    updates = updates if updates else metadoc["updates"]
+    updates = min(updates if updates else metadoc["updates"], total)
     start = metadoc["start"]
-    batchsize = _batch_size(size)
-    int1, int2 = _intervals(start, updates, total)
-    docint1, docint2 = [IDPAT % i for i in int1], [IDPAT % i for i in int2]
-    print("before:")
-    print("  total:", total)
-    print("  size:", size)
-    print("  start:", start)
-    print("  updating:", updates)
-    print()
-    trev0 = time.time()
-    docrevs = _docrevs(db, docint1, docint2)
-    trevdt = time.time() - trev0
-    revcount = len(docrevs)
-    trevrate = int(revcount / trevdt)
-    if docrevs:
-        print("revs:")
-        print("  count:", revcount)
-        print("  dt (sec): %.3f" % trevdt)
-        print("  rate (/sec):", trevrate)
-        print()
-    docint1.extend(docint2)
-    ok = 0
-    for i in range(0, len(docint1), batchsize):
-        docid_batch = docint1[i : i + batchsize]
-        ok += _bulk_update(db, docrevs, size, int(t0), docid_batch)
-    errors = updates - ok
+    ts = int(t0)
+    done = resumed_ok = 0
+    saved = progress.saved(metadoc, fill) if resume and progress else None
+    if saved is not None:
+        start, updates, ts = saved["start"], saved["updates"], saved["ts"]
+        done, resumed_ok = saved["done"], saved["ok"]
+    if sizer is None:
+        sizer = _BatchSizer(size)
+    if timers is None:
+        timers = NO_TIMERS
+    sizer.reset()
+    cycle = dict(
+        total=total,
+        blind=metadoc.get("blind_writes", False),
+        lag=metadoc.get("blind_lag", {}),
+        failed=[],
+        writes=metadoc.get("writes", 0),
+        ts=ts,
+        payload=Payload.from_metadoc(metadoc, metadoc.get("writes", 0)),
+        attachments=Attachments.from_metadoc(metadoc, metadoc.get("writes", 0)),
+        timers=timers,
+    )
+    distribution = "sequential"
+    if not fill:
+        distribution = metadoc.get("distribution", "sequential")
+    key_seed = keys = None
+    if distribution == "sequential":
+        intervals = _skip(_intervals(start, updates, total), done)
+    else:
+        key_seed = _key_seed(metadoc, saved)
+        keys = _Keys(metadoc, updates, random.Random(key_seed), skip=done)
+        intervals = keys
+    # Random keys are saved as the seed and count of picks, so a resumed
+    # cycle picks them again
+    if progress is not None:
+        progress.begin(metadoc, fill, start, updates, ts, done, resumed_ok, key_seed)
+    print("before:", file=out)
+    print("  total:", total, file=out)
+    print("  size:", size, file=out)
+    print("  start:", start, file=out)
+    print("  updating:", updates, file=out)
+    if saved is not None:
+        print("  resuming after:", done, file=out)
+    if concurrency > 1:
+        print("  concurrency:", concurrency, file=out)
+    if processes > 1:
+        print("  processes:", processes, file=out)
+    if distribution != "sequential":
+        print("  distribution:", distribution, file=out)
+    if cycle["blind"]:
+        print("  blind writes:", cycle["blind"], file=out)
+    if limiter is not None:
+        print("  target rate (/sec):", limiter.rate, file=out)
+    if cycle["attachments"] is not None:
+        print("  attachments (%):", metadoc["attachment_pct"], file=out)
+    timers.start()
+    _start_compaction(compactor, metadoc, out)
+    timers.lap("compact")
+    print(file=out)
+    latencies = Histogram()
+    if processes > 1:
+        ok, attstats, revstats = _update_docs_multiprocess(
+            db,
+            cycle,
+            intervals,
+            processes,
+            concurrency,
+            revcache,
+            sizer,
+            limiter,
+            latencies,
+        )
+    else:
+        ok, attstats, revstats = _update_intervals(
+            db,
+            cycle,
+            intervals,
+            pool,
+            revcache,
+            sizer,
+            limiter,
+            latencies,
+            progress,
+            out,
+        )
+    if keys is not None:
+        updates = keys.count
+    errors = updates - resumed_ok - ok
     dt = time.time() - t0
-    rate = int(updates / dt)
-    print("after:")
-    print("  updates:", updates)
-    print("  dt (sec): %.3f" % dt)
-    print("  rate (/sec):", rate)
+    rate = int((updates - done) / dt)
+    print("after:", file=out)
+    print("  updates:", updates, file=out)
+    print("  dt (sec): %.3f" % dt, file=out)
+    print("  rate (/sec):", rate, file=out)
+    batch_stats = sizer.stats()
+    print("  batch size (min/avg/max): %d / %d / %d" % tuple(batch_stats), file=out)
+    if sizer.target_latency > 0 or cycle["attachments"] is not None:
+        print("  sent (MB/sec): %.3f" % (sizer.sent / dt / 1e6), file=out)
+    lat_stats = latencies.stats()
+    print(
+        "  latency p50/p90/p99/max (sec): %.3f / %.3f / %.3f / %.3f" % tuple(lat_stats),
+        file=out,
+    )
     if errors > 0:
-        print("(!)errors:", errors)
+        print("(!)errors:", errors, file=out)
+    print(file=out)
+    stats = {"batch": batch_stats, "lat": lat_stats}
+    if cycle["blind"]:
+        lagging = _track_blind_lag(metadoc, cycle["failed"], intervals, total, out)
+        if lagging:
+            stats["blind_lag"] = lagging
+    if revstats[0] > 0:
+        stats["revs"] = revstats
+    if cycle["attachments"] is not None:
+        _print_attachments(attstats, dt, out)
+        stats["att"] = attstats
+    if indexes is not None and ok == 0:
+        print("index_lag: skipped, no docs were updated", file=out)
+        print(file=out)
+    elif indexes is not None:
+        timers.start()
+        lags, indexer = indexes.measure(int(t0 * 1000), t0 + dt, out)
+        timers.lap("index_lag")
+        _print_index_lag(lags, indexer, out)
+        stats["lag"], stats["indexer"] = lags, indexer
+    if consumers is not None:
+        stats["changes"] = _print_changes(consumers, db, out)
+    timers.start()
+    _collect_compaction(compactor, stats, out)
+    timers.lap("compact")
+    if distribution == "sequential":
+        start = (start + updates) % total
+    timers.start()
+    stats["db"] = db_sizes(db)
+    timers.lap("db_info")
+    new_metadoc = metadoc.checkpoint(
+        db,
+        start=start,
+        ts=ts,
+        dt=int(dt),
+        updates=updates,
+        errors=errors,
+        stats=stats,
+    )
+    timers.lap("metadoc")
+    if metrics is not None:
+        timers.start()
+        _record_metrics(metrics, db, updates - done, errors, dt, latencies, stats)
+        timers.lap("metrics")
+    return new_metadoc
+
+
+def _print_attachments(attstats, dt, out=None):
+    """
+    Print attachment counts and throughput. Attachment writes are timed
+    separately from _bulk_docs requests.
+    """
+    count, nbytes, att_dt, errors = attstats
+    print("attachments:", file=out)
+    print("  count:", count, file=out)
+    print("  bytes:", nbytes, file=out)
+    print("  dt (sec): %.3f" % att_dt, file=out)
+    if att_dt > 0:
+        print("  rate (MB/sec): %.3f" % (nbytes / att_dt / 1e6), file=out)
+    if dt > 0:
+        print("  rate per cycle (MB/sec): %.3f" % (nbytes / dt / 1e6), file=out)
+    if errors > 0:
+        print("(!)errors:", errors, file=out)
+    print(file=out)
+
+
+def _print_index_lag(lags, indexer, out=None):
+    print("index_lag:", file=out)
+    for name in sorted(lags):
+        if lags[name] is None:
+            print("  %s: (!)timed out" % name, file=out)
+        else:
+            print("  %s (sec): %.3f" % (name, lags[name]), file=out)
+    print("  indexer tasks (peak):", indexer[1], file=out)
+    print(file=out)
+
+
+def _print_changes(consumers, db, out=None):
+    """
+    Print and return [received, errors, p50, p90, p99, max, behind] stats
+    of _changes consumers since the last cycle. Consumers are first given
+    a grace period to catch up with the db update sequence at the end of
+    the cycle. `behind` is how many updates the slowest one was still
+    missing.
+    """
+    seq = seq_num(db.info()["update_seq"])
+    latencies, received, errors, behind = consumers.collect(seq)
+    lat_stats = latencies.stats()
+    print("changes:", file=out)
+    print("  consumers:", consumers.n, "(%s)" % consumers.feed, file=out)
+    print("  received:", received, file=out)
+    print(
+        "  delay p50/p90/p99/max (sec): %.3f / %.3f / %.3f / %.3f" % tuple(lat_stats),
+        file=out,
+    )
+    if errors > 0:
+        print("(!)errors:", errors, file=out)
+    if behind > 0:
+        print(
+            "(!)behind: updates not received after %d sec:" % CHANGES_GRACE,
+            behind,
+            file=out,
+        )
+    print(file=out)
+    return [received, errors] + lat_stats + [behind]
+
+
+def _start_compaction(compactor, metadoc, out=None):
+    if compactor is None:
+        return
+    reason = compactor.start(metadoc)
+    if reason is not None:
+        print("  compaction started:", reason, file=out)
+    elif compactor.thread is not None:
+        running = time.time() - compactor.run["t0"]
+        print("  compaction running (sec): %d" % running, file=out)
+
+
+def _collect_compaction(compactor, stats, out=None):
+    """
+    Print and add to stats results of a compaction which finished.
+    """
+    res = compactor.collect(out) if compactor is not None else None
+    if res is None:
+        return
+    print("compaction:", file=out)
+    print("  reason:", res["reason"], file=out)
+    print("  dt (sec): %.3f" % res["dt"], file=out)
+    print("  fragmentation before (%%): %.1f" % res["frag"], file=out)
+    print(
+        "  reclaimed db/views (MB): %.3f / %.3f"
+        % (res["reclaimed"] / 1e6, res["views_reclaimed"] / 1e6),
+        file=out,
+    )
+    print("  db writes during compaction:", res["writes"], file=out)
+    print("  db write rate during compaction (/sec): %.1f" % res["rate"], file=out)
+    print(file=out)
+    stats["compact"] = res
+
+
+def _open_metrics(args):
+    """
+    Return a metrics registry if metrics are exported, and start serving
+    them if a port is specified.
+    """
+    if not args.metrics_file and not args.metrics_port:
+        return None
+    metrics = Metrics("couchdyno")
+    for (name, kind, help) in METRIC_FAMILIES:
+        metrics.family(name, kind, help, bounds=LATENCY_BUCKETS)
+    if args.metrics_port:
+        port = metrics.serve(args.metrics_host, args.metrics_port)
+        print("Serving metrics at http://%s:%d/metrics" % (args.metrics_host, port))
+    return metrics
+
+
+def _write_metrics(metrics, args):
+    if metrics is not None and args.metrics_file:
+        metrics.write(args.metrics_file)
+
+
+def _record_metrics(metrics, db, updates, errors, dt, latencies, stats):
+    """
+    Add a cycle's results to metrics, labeled with the db name. Db sizes
+    come from the db info sampled at the cycle's checkpoint.
+    """
+    labels = {"db": db.name}
+    metrics.inc("cycles", **labels)
+    metrics.inc("updates", updates, **labels)
+    metrics.inc("update_errors", errors, **labels)
+    metrics.set("update_rate", updates / dt if dt > 0 else 0.0, **labels)
+    metrics.set("cycle_duration_seconds", dt, **labels)
+    metrics.set("last_cycle_timestamp_seconds", int(time.time()), **labels)
+    if latencies is not None:
+        buckets = latencies.buckets(LATENCY_BUCKETS)
+        metrics.observe("batch_latency_seconds", buckets, latencies.sum / 1e6, **labels)
+    if "revs" in stats:
+        count, cached, revs_dt = stats["revs"]
+        metrics.inc("revs_fetched", count, **labels)
+        metrics.inc("revs_cached", cached, **labels)
+        if revs_dt > 0:
+            metrics.set("revs_fetch_rate", count / revs_dt, **labels)
+    if "att" in stats:
+        count, nbytes, _, att_errors = stats["att"]
+        metrics.inc("attachments", count, **labels)
+        metrics.inc("attachment_bytes", nbytes, **labels)
+        metrics.inc("attachment_errors", att_errors, **labels)
+    for (name, lag) in stats.get("lag", {}).items():
+        if lag is not None:
+            metrics.set("index_lag_seconds", lag, index=name, **labels)
+    if "changes" in stats:
+        metrics.inc("changes_received", stats["changes"][0], **labels)
+        metrics.inc("changes_errors", stats["changes"][1], **labels)
+    if "compact" in stats:
+        res = stats["compact"]
+        metrics.inc("compactions", **labels)
+        metrics.set("compaction_duration_seconds", res["dt"], **labels)
+        metrics.set("compaction_reclaimed_bytes", res["reclaimed"], file="db", **labels)
+        metrics.set(
+            "compaction_reclaimed_bytes", res["views_reclaimed"], file="views", **labels
+        )
+        metrics.set("compaction_write_rate", res["rate"], **labels)
+    for (name, value) in stats.get("db", {}).items():
+        metrics.set("db_" + name, value, **labels)
+
+
+def _record_op_metrics(metrics, db, op, latencies, errors):
+    """
+    Add results of one mixed workload operation type to metrics.
+    """
+    labels = {"db": db.name, "op": op}
+    metrics.inc("operations", latencies.count, **labels)
+    metrics.inc("operation_errors", errors, **labels)
+    buckets = latencies.buckets(LATENCY_BUCKETS)
+    metrics.observe("operation_latency_seconds", buckets, latencies.sum / 1e6, **labels)
+
+
+def _timers(profiler):
+    return profiler.timers if profiler is not None else None
+
+
+def _profile_cycle(profiler, dt):
+    """
+    Print time spent in each phase of the last cycle and update the
+    profile files. Phases are timed in every thread and process, so with
+    concurrency their total can be more than the cycle's time.
+    """
+    if profiler is None:
+        return
+    phases = profiler.cycle(dt, ts=int(time.time()))
+    print("profile:")
+    for line in format_phases(phases):
+        print("  " + line)
     print()
-    return metadoc.checkpoint(
+    profiler.write()
+
+
+def _workload_cycle(
+    db,
+    metadoc,
+    count=0,
+    concurrency=1,
+    limiter=None,
+    consumers=None,
+    timers=None,
+    metrics=None,
+    compactor=None,
+    pool=None,
+    out=None,
+):
+    """
+    Run one cycle of a mixed workload of `count` (by default
+    metadoc['updates']) operations, then checkpoint. Each operation
+    is a separate request. Latency and throughput are tracked per
+    operation type. Inserts grow metadoc['total'] up to the last one
+    which succeeded. Reads and scans are recorded apart from updates, so
+    update rates and the census only count writes. Changes consumers,
+    timers, metrics, compaction, the worker pool and output are handled
+    like in _update_docs, with request time of each operation type timed
+    as a phase.
+    """
+    if timers is None:
+        timers = NO_TIMERS
+    if pool is None:
+        pool = _WorkerPool(concurrency)
+    t0 = time.time()
+    count = count if count else metadoc["updates"]
+    writes = metadoc.get("writes", 0)
+    rng = random.Random()
+    if metadoc.get("seed") is not None:
+        rng.seed("%s-ops-%s" % (metadoc["seed"], writes))
+    pick = _picker(metadoc, rng)
+    ops = workload_ops(metadoc["workload"], metadoc["total"], pick, count, rng)
+    payload = Payload.from_metadoc(metadoc, writes)
+    print("before:", file=out)
+    print("  total:", metadoc["total"], file=out)
+    print("  size:", metadoc["size"], file=out)
+    print("  operations:", count, file=out)
+    print("  workload:", format_workload(metadoc["workload"]), file=out)
+    if concurrency > 1:
+        print("  concurrency:", concurrency, file=out)
+    if limiter is not None:
+        print("  target rate (/sec):", limiter.rate, file=out)
+    _start_compaction(compactor, metadoc, out)
+    print(file=out)
+    latencies = dict((op, Histogram()) for op in metadoc["workload"])
+    errors = collections.Counter()
+
+    def paced(ops):
+        for op in ops:
+            intended = limiter.acquire(1) if limiter is not None else None
+            yield intended, op
+
+    def run(rdb, item):
+        intended, (op, idx) = item
+        bt0 = time.time()
+        ok = run_op(rdb, op, IDPAT % idx, int(t0), payload)
+        bt1 = time.time()
+        timers.add(op, bt1 - bt0)
+        latencies[op].record(bt1 - (bt0 if intended is None else intended))
+        return op, idx, ok
+
+    # Results are counted here rather than in workers, so counters aren't
+    # shared between threads. Total only grows past inserts which succeeded.
+    inserted = metadoc["total"]
+    for (op, idx, ok) in pool.map(db, run, paced(ops)):
+        if not ok:
+            errors[op] += 1
+        elif op == "insert":
+            inserted = max(inserted, idx + 1)
+    dt = time.time() - t0
+    reads = sum(latencies[op].count for op in READ_OPS if op in latencies)
+    updates = count - reads
+    print("after:", file=out)
+    print("  operations:", count, file=out)
+    print("  reads:", reads, file=out)
+    print("  updates:", updates, file=out)
+    print("  dt (sec): %.3f" % dt, file=out)
+    print("  rate (/sec):", int(count / dt), file=out)
+    stats = {}
+    for op in sorted(latencies):
+        hist = latencies[op]
+        stats[op] = [hist.count, errors[op]] + hist.stats()
+        print(
+            "  %s: %d ops, %d / sec, errors: %d, latency p50/p99/max (sec):"
+            " %.3f / %.3f / %.3f"
+            % (
+                op,
+                hist.count,
+                int(hist.count / dt),
+                errors[op],
+                stats[op][2],
+                stats[op][4],
+                stats[op][5],
+            ),
+            file=out,
+        )
+    print(file=out)
+    metadoc["total"] = inserted
+    stats = {"ops": stats}
+    if consumers is not None:
+        stats["changes"] = _print_changes(consumers, db, out)
+    timers.start()
+    _collect_compaction(compactor, stats, out)
+    timers.lap("compact")
+    stats["db"] = db_sizes(db)
+    timers.lap("db_info")
+    new_metadoc = metadoc.checkpoint(
         db,
-        start=(start + updates) % total,
+        start=metadoc["start"],
         ts=int(t0),
         dt=int(dt),
         updates=updates,
-        errors=errors,
+        errors=sum(errors.values()),
+        stats=stats,
+        reads=reads,
+    )
+    timers.lap("metadoc")
+    if metrics is not None:
+        _record_metrics(metrics, db, updates, sum(errors.values()), dt, None, stats)
+        for op in sorted(latencies):
+            _record_op_metrics(metrics, db, op, latencies[op], errors[op])
+        timers.lap("metrics")
+    return new_metadoc
+
+
+def _add_concurrency_arg(p):
+    p.add_argument(
+        "-n",
+        "--concurrency",
+        type=int,
+        default=1,
+        help="Number of parallel workers sending bulk update batches",
+    )
+
+
+def _add_batch_args(p):
+    p.add_argument(
+        "-l",
+        "--target-latency",
+        type=float,
+        default=0,
+        help="Adapt bulk update batch size so each request takes about"
+        " these many seconds. By default batch size is fixed",
+    )
+
+
+def _add_progress_args(p):
+    p.add_argument(
+        "--checkpoint-every",
+        type=int,
+        default=DEFAULT_CHECKPOINT_EVERY,
+        help="Save progress within a cycle every these many batches, 0 disables",
+    )
+    p.add_argument(
+        "--resume",
+        action="store_true",
+        default=False,
+        help="Continue an interrupted cycle after its last saved batch",
+    )
+
+
+def _add_profile_args(p):
+    p.add_argument(
+        "--profile",
+        default=None,
+        metavar="PREFIX",
+        help="Time each phase of update cycles and write a breakdown to"
+        " PREFIX.json and collapsed stacks to PREFIX.folded",
+    )
+    p.add_argument(
+        "--cprofile",
+        action="store_true",
+        default=False,
+        help="With --profile also run cProfile, saved to PREFIX.pstats and"
+        " PREFIX.cprofile.folded. Only the main thread is profiled",
+    )
+
+
+def _add_metrics_args(p):
+    p.add_argument(
+        "--metrics-file",
+        default=None,
+        help="Write metrics in Prometheus text format to this file after each"
+        " cycle, for example for the node_exporter textfile collector",
+    )
+    p.add_argument(
+        "--metrics-port",
+        type=int,
+        default=0,
+        help="Serve metrics at /metrics on this port while running"
+        " with --continuous or --rate",
+    )
+    p.add_argument(
+        "--metrics-host",
+        default="0.0.0.0",
+        help="Address to serve metrics from",
+    )
+
+
+def _add_rev_cache_arg(p):
+    p.add_argument(
+        "-r",
+        "--rev-cache",
+        default=None,
+        help="Local file used to cache document revisions between runs",
     )
 
 
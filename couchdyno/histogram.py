@@ -0,0 +1,98 @@
+"""
+Latency histograms shared by couchdyno workers. Histograms from
+separate processes are pickled back to the parent and merged there.
+
+Example of usage:
+
+  hist = Histogram()
+  hist.record(0.0123)
+  hist.stats()  # [p50, p90, p99, max] in seconds
+"""
+
+import bisect
+import threading
+import collections
+from .util import PicklableLock
+
+HIST_SUB_BITS = 4
+
+
+class Histogram(PicklableLock):
+    """
+    Compact log-linear histogram of latencies. Values are recorded in
+    microseconds. Each power of 2 range is split into 2^HIST_SUB_BITS
+    linear buckets, so percentiles are within about 6% of the real value
+    while only a few hundred buckets are ever used.
+    """
+
+    SUB = 1 << HIST_SUB_BITS
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+        self.lock = threading.Lock()
+
+    def merge(self, other):
+        with self.lock:
+            self.counts.update(other.counts)
+            self.count += other.count
+            self.sum += other.sum
+            self.max = max(self.max, other.max)
+
+    def record(self, seconds):
+        v = max(0, int(seconds * 1e6))
+        if v < self.SUB:
+            idx = v
+        else:
+            shift = v.bit_length() - HIST_SUB_BITS - 1
+            idx = shift * self.SUB + (v >> shift)
+        with self.lock:
+            self.counts[idx] += 1
+            self.count += 1
+            self.sum += v
+            self.max = max(self.max, v)
+
+    def _value(self, idx):
+        """
+        Midpoint of a bucket in microseconds.
+        """
+        if idx < self.SUB:
+            return idx
+        shift = idx // self.SUB - 1
+        low = (idx - shift * self.SUB) << shift
+        return low + (1 << shift) / 2.0
+
+    def percentile(self, pct):
+        """
+        Return pct-th percentile in seconds.
+        """
+        if not self.count:
+            return 0.0
+        want = max(1, pct / 100.0 * self.count)
+        seen = 0
+        for idx in sorted(self.counts):
+            seen += self.counts[idx]
+            if seen >= want:
+                return min(self._value(idx), self.max) / 1e6
+        return self.max / 1e6
+
+    def stats(self):
+        """
+        Return [p50, p90, p99, max] in seconds.
+        """
+        pcts = [self.percentile(p) for p in (50, 90, 99)]
+        return [round(v, 6) for v in pcts + [self.max / 1e6]]
+
+    def buckets(self, bounds):
+        """
+        Return counts of values up to each of the sorted bounds (in
+        seconds), followed by the count of larger values. Values are
+        placed by their bucket's midpoint.
+        """
+        res = [0] * (len(bounds) + 1)
+        for (idx, count) in self.counts.items():
+            value = self._value(idx) / 1e6
+            res[bisect.bisect_left(bounds, value)] += count
+        return res
@@ -0,0 +1,150 @@
+"""
+Secondary index lag measurement for couchdyno cycles. After a cycle
+couchdyno waits until a view and a Mango index include the cycle's
+updates, and until other views catch up with the db update sequence.
+
+Example of usage:
+
+  lag = IndexLag.open(db, True, ["ddoc/view"])
+  lags, indexer = lag.measure(ts, since)
+"""
+
+import time
+import functools
+import concurrent.futures
+import couchdb
+from couchdb.design import ViewDefinition
+from .util import db_tasks, seq_num, retry_timeout
+
+LAG_DDOC = "couchdyno_lag"
+LAG_MANGO_DDOC = "couchdyno_lag_mango"
+LAG_SAMPLE = 1.0
+DEFAULT_LAG_TIMEOUT = 3600
+
+
+class IndexLag(object):
+    """
+    Measure secondary index lag after a cycle: the time from the cycle's
+    last write until its updates show up in a view and a Mango index on
+    `ts_ms`, and until extra views catch up with the db update sequence
+    seen at the end of the cycle. Indexer tasks are sampled while waiting.
+    Indexes which don't catch up within `timeout` seconds are reported as
+    timed out.
+    """
+
+    def __init__(self, db, ts_index=True, views=None, timeout=DEFAULT_LAG_TIMEOUT):
+        self.db = db
+        self.ts_index = ts_index
+        self.views = views or []
+        self.timeout = timeout
+
+    @classmethod
+    def open(cls, db, ts_index, views, timeout=DEFAULT_LAG_TIMEOUT):
+        if not ts_index and not views:
+            return None
+        lag = cls(db, ts_index, views, timeout)
+        if ts_index:
+            ts_view().sync(db)
+            index = {
+                "index": {"fields": ["ts_ms"]},
+                "ddoc": LAG_MANGO_DDOC,
+                "name": "ts_ms",
+                "type": "json",
+            }
+            db.resource.post_json("_index", body=index)
+        return lag
+
+    def measure(self, ts_ms, since, out=None):
+        """
+        Wait for all indexes to include updates made since `ts_ms`, the
+        cycle start in milliseconds. Docs written by an earlier cycle
+        have older ts_ms values, even if it ran in the same second. Return
+        ({index: seconds since `since`}, [samples, peak indexer tasks]).
+        Lags of indexes which timed out are None. If _active_tasks can't
+        be read, for example by a non-admin user, indexer tasks are not
+        sampled. Indexing progress is printed to `out`, by default stdout.
+        """
+        till = time.time() + self.timeout
+        waits = {}
+        if self.ts_index:
+            waits["view"] = functools.partial(self._wait_view, ts_ms, till)
+            waits["mango"] = functools.partial(self._wait_mango, ts_ms, till)
+        if self.views:
+            seq = seq_num(self.db.info()["update_seq"])
+            for name in self.views:
+                waits[name] = functools.partial(self._wait_seq, name, seq, till)
+        samples, peak, sample = 0, 0, True
+        with concurrent.futures.ThreadPoolExecutor(len(waits)) as executor:
+            futures = {}
+            for (name, fun) in waits.items():
+                futures[name] = executor.submit(retry_timeout, fun, self.timeout)
+            pending = set(futures.values())
+            while pending:
+                if sample:
+                    try:
+                        tasks = db_tasks(self.db, ["indexer"])
+                    except couchdb.http.HTTPError as ex:
+                        print("(!)not sampling indexer tasks:", ex, file=out)
+                        sample, tasks = False, []
+                    else:
+                        samples += 1
+                    peak = max(peak, len(tasks))
+                    if tasks:
+                        done = sum(t.get("changes_done", 0) for t in tasks)
+                        todo = sum(t.get("total_changes", 0) for t in tasks)
+                        progress = "%d / %d" % (done, todo)
+                        print("... indexing, tasks:", len(tasks), progress, file=out)
+                _, pending = concurrent.futures.wait(pending, timeout=LAG_SAMPLE)
+        lags = {}
+        for (name, f) in futures.items():
+            t = f.result()
+            lags[name] = None if t is None else t - since
+        return lags, [samples, peak]
+
+    def _wait_view(self, ts_ms, till):
+        view = ts_view()
+        while time.time() < till:
+            rows = list(view(self.db, descending=True, limit=1))
+            if rows and rows[0].key >= ts_ms:
+                return time.time()
+            time.sleep(LAG_SAMPLE / 10)
+        return None
+
+    def _wait_mango(self, ts_ms, till):
+        query = {
+            "selector": {"ts_ms": {"$gte": ts_ms}},
+            "use_index": [LAG_MANGO_DDOC, "ts_ms"],
+            "fields": ["_id"],
+            "limit": 1,
+        }
+        while time.time() < till:
+            _, _, res = self.db.resource.post_json("_find", body=query)
+            if res["docs"]:
+                return time.time()
+            time.sleep(LAG_SAMPLE / 10)
+        return None
+
+    def _wait_seq(self, name, seq, till):
+        while time.time() < till:
+            res = self.db.view(name, limit=0, update_seq=True)
+            if seq_num(res.update_seq) >= seq:
+                return time.time()
+            time.sleep(LAG_SAMPLE / 10)
+        return None
+
+
+def ts_view():
+    """
+    View of dyno docs by ts_ms, which only they have.
+    """
+    return ViewDefinition(
+        LAG_DDOC,
+        "ts_ms",
+        """
+function(doc) {
+      if(doc.ts_ms) {
+         emit(doc.ts_ms, null);
+      }
+}
+""",
+    )
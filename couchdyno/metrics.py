@@ -0,0 +1,218 @@
+"""
+Metrics for couchdyno and rep runs, in the Prometheus text exposition
+format. Metrics can be exported in two ways:
+
+  * write(path) : a file for the node_exporter textfile collector,
+    written atomically so the collector never sees a partial file
+  * serve(host, port) : an embedded /metrics HTTP endpoint, served from a
+    background thread. It also speaks OpenMetrics if the scraper asks
+    for it in the Accept header.
+
+Example of usage:
+
+  metrics = Metrics("couchdyno")
+  metrics.family("updates", "counter", "Documents updated")
+  metrics.inc("updates", 100, db="db1")
+  metrics.write("/var/lib/node_exporter/couchdyno.prom")
+"""
+
+import os
+import math
+import threading
+import http.server
+
+LATENCY_BUCKETS = [
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+]
+TYPES = ["counter", "gauge", "histogram"]
+TEXT_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+class Metrics(object):
+    """
+    Registry of metric families. Metrics are declared with family() and
+    updated by name with keyword arguments as labels. Histograms have
+    fixed bucket bounds and are updated with already bucketed counts.
+    """
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.families = {}
+        self.lock = threading.Lock()
+        self.httpd = None
+
+    def family(self, name, kind, help, bounds=None):
+        if kind not in TYPES:
+            raise ValueError("Invalid metric type %s" % kind)
+        with self.lock:
+            if name not in self.families:
+                self.families[name] = dict(
+                    kind=kind, help=help, bounds=bounds, samples={}
+                )
+        return self
+
+    def _sample(self, name, kind, labels, default):
+        fam = self.families[name]
+        if fam["kind"] != kind:
+            raise ValueError("%s is a %s" % (name, fam["kind"]))
+        key = tuple(sorted(labels.items()))
+        return fam, key, fam["samples"].setdefault(key, default)
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            fam, key, cur = self._sample(name, "counter", labels, 0)
+            fam["samples"][key] = cur + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            fam, key, _ = self._sample(name, "gauge", labels, 0)
+            fam["samples"][key] = value
+
+    def observe(self, name, buckets, total, **labels):
+        """
+        Add to a histogram. buckets are counts of values less than or
+        equal to each of the family's bounds, not cumulative, followed
+        by the count of larger values. total is the sum of all values.
+        """
+        with self.lock:
+            fam = self.families[name]
+            nbounds = len(fam["bounds"]) + 1
+            if len(buckets) != nbounds:
+                raise ValueError("%s needs %d buckets" % (name, nbounds))
+            default = [[0] * nbounds, 0.0]
+            _, _, cur = self._sample(name, "histogram", labels, default)
+            cur[0] = [a + b for (a, b) in zip(cur[0], buckets)]
+            cur[1] += total
+
+    def render(self, openmetrics=False):
+        """
+        Return metrics as text. Counter families are named with a _total
+        suffix in the Prometheus text format, but not in OpenMetrics.
+        """
+        lines = []
+        with self.lock:
+            for name in sorted(self.families):
+                fam = self.families[name]
+                if not fam["samples"]:
+                    continue
+                full = "%s_%s" % (self.namespace, name)
+                kind = fam["kind"]
+                famname = full
+                if kind == "counter" and not openmetrics:
+                    famname += "_total"
+                lines.append("# HELP %s %s" % (famname, _escape(fam["help"], False)))
+                lines.append("# TYPE %s %s" % (famname, kind))
+                for key in sorted(fam["samples"]):
+                    value = fam["samples"][key]
+                    if kind == "histogram":
+                        lines.extend(_histogram_lines(full, key, fam["bounds"], value))
+                    elif kind == "counter":
+                        lines.append(_line(full + "_total", key, value))
+                    else:
+                        lines.append(_line(full, key, value))
+        if openmetrics:
+            lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """
+        Write metrics to a file for a textfile collector. The file is
+        renamed into place so it's never read half written.
+        """
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "w") as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+    def serve(self, host="", port=0):
+        """
+        Serve metrics at /metrics from a background thread. Return the
+        port used.
+        """
+        self.httpd = _HTTPServer((host, port), _Handler)
+        self.httpd.metrics = self
+        thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        thread.start()
+        return self.httpd.server_address[1]
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+
+def _escape(val, quote=True):
+    val = str(val).replace("\\", "\\\\").replace("\n", "\\n")
+    if quote:
+        val = val.replace('"', '\\"')
+    return val
+
+
+def _labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, _escape(v)) for (k, v) in pairs)
+
+
+def _value(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(value)
+    return str(value)
+
+
+def _line(name, key, value, extra=()):
+    return "%s%s %s" % (name, _labels(key, extra), _value(value))
+
+
+def _histogram_lines(name, key, bounds, value):
+    buckets, total = value
+    lines, cumulative = [], 0
+    for (bound, count) in zip(bounds + [float("inf")], buckets):
+        cumulative += count
+        le = _value(float(bound))
+        lines.append(_line(name + "_bucket", key, cumulative, [("le", le)]))
+    lines.append(_line(name + "_count", key, cumulative))
+    lines.append(_line(name + "_sum", key, float(total)))
+    return lines
+
+
+class _HTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, fmt, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        openmetrics = "application/openmetrics-text" in self.headers.get("Accept", "")
+        body = self.server.metrics.render(openmetrics).encode("utf-8")
+        ctype = OPENMETRICS_CONTENT_TYPE if openmetrics else TEXT_CONTENT_TYPE
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
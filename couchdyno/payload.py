@@ -0,0 +1,263 @@
+"""
+Document and attachment payload models for couchdyno. Document data is
+cut out of a random buffer generated once per cycle, so it only depends
+on the seed, cycle and doc id, and can be written straight into
+_bulk_docs request bodies without JSON encoding each doc.
+
+Example of usage:
+
+  payload = Payload(1000, seed=42, cycle=0, shape="nested")
+  payload.data("cdyno_000000000001")  # {"g0": {"f0": "...", ...}, ...}
+"""
+
+import math
+import time
+import zlib
+import random
+import string
+import statistics
+import couchdb
+
+PAYLOAD_SPREAD = 1 << 16
+DOC_OVERHEAD = 100
+MAX_DOCUMENT_SIZE = 8000000
+SIZE_DISTRIBUTIONS = ["fixed", "uniform", "lognormal"]
+DEFAULT_SIZE_SIGMA = 0.5
+LOGNORMAL_MAX = 8
+DOC_SHAPES = ["flat", "nested"]
+DEFAULT_FIELDS = 32
+NESTED_GROUP = 8
+ENTROPY_BLOCK = 32
+ENTROPY_WORDS = 16
+DEFAULT_ATTACHMENT_SIZE = 65536
+ATTACHMENT_NAME = "data"
+
+
+# Byte translation table mapping any random byte to a lowercase letter
+_LOWERCASE = (string.ascii_lowercase * 10)[:256].encode("ascii")
+
+
+class Payload(object):
+    """
+    Random document data generator. A buffer of random lowercase
+    characters is generated once in bulk, then each document gets a
+    slice of it at an offset derived from its id and a per-cycle salt.
+    Results only depend on the seed, cycle and doc id, so they are
+    reproducible even when batches are built in parallel.
+
+    Document sizes follow `size_dist` with mean `size`. Flat docs have
+    a single data string, nested docs split it in `fields` fields kept
+    in objects of NESTED_GROUP fields. With `entropy` < 1 part of the
+    buffer repeats a few words so the data is compressible.
+    """
+
+    def __init__(
+        self,
+        size,
+        seed=None,
+        cycle=None,
+        spread=PAYLOAD_SPREAD,
+        size_dist="fixed",
+        size_sigma=DEFAULT_SIZE_SIGMA,
+        shape="flat",
+        fields=DEFAULT_FIELDS,
+        entropy=1.0,
+    ):
+        rng = random.Random(seed)
+        self.size = size
+        self.size_dist = size_dist
+        self.size_sigma = size_sigma
+        self.max_size = max_doc_size(size, size_dist)
+        self.raw = _random_text(rng, self.max_size + spread, entropy)
+        self.buf = self.raw.decode("ascii")
+        self.span = spread + 1
+        if seed is None:
+            self.salt = rng.getrandbits(32)
+        else:
+            self.salt = random.Random("%s-%s" % (seed, cycle)).getrandbits(32)
+        self.names = None
+        self.seps = [b'"']
+        self.close = b'"'
+        if shape == "nested":
+            self.names = [
+                ("g%d" % (i // NESTED_GROUP), "f%d" % i) for i in range(fields)
+            ]
+            self.seps = _nested_seps(self.names)
+            self.close = b'"}}'
+
+    @classmethod
+    def from_metadoc(cls, metadoc, cycle):
+        return cls(
+            metadoc["size"],
+            seed=metadoc.get("seed"),
+            cycle=cycle,
+            size_dist=metadoc.get("size_dist", "fixed"),
+            size_sigma=metadoc.get("size_sigma", DEFAULT_SIZE_SIGMA),
+            shape=metadoc.get("doc_shape", "flat"),
+            fields=metadoc.get("fields", DEFAULT_FIELDS),
+            entropy=metadoc.get("entropy", 1.0),
+        )
+
+    def _offset(self, _id):
+        return (zlib.crc32(_id.encode("ascii")) ^ self.salt) % self.span
+
+    def doc_size(self, _id):
+        if self.size_dist == "fixed":
+            return self.size
+        h = zlib.crc32(_id.encode("ascii"), self.salt) & 0xFFFFFFFF
+        u = (h + 0.5) / 4294967296.0
+        if self.size_dist == "uniform":
+            return 1 + int(u * (self.max_size - 1))
+        sigma = self.size_sigma
+        z = statistics.NormalDist().inv_cdf(u)
+        size = int(self.size * math.exp(sigma * z - sigma * sigma / 2))
+        return max(1, min(size, self.max_size))
+
+    def _slices(self, _id):
+        off = self._offset(_id)
+        size = self.doc_size(_id)
+        n = len(self.seps)
+        q, r = divmod(size, n)
+        for i in range(n):
+            end = off + q + (i < r)
+            yield off, end
+            off = end
+
+    def data(self, _id):
+        """
+        Document data, a string for flat docs or a dict for nested ones.
+        """
+        if self.names is None:
+            off = self._offset(_id)
+            return self.buf[off : off + self.doc_size(_id)]
+        data = {}
+        for (group, field), (start, end) in zip(self.names, self._slices(_id)):
+            data.setdefault(group, {})[field] = self.buf[start:end]
+        return data
+
+    def content(self, _id):
+        """
+        Document data as bytes.
+        """
+        off = self._offset(_id)
+        return self.raw[off : off + self.doc_size(_id)]
+
+    def data_parts(self, parts, _id):
+        """
+        Append JSON encoded document data to a list of bytes parts. Data
+        is added as zero-copy views of the bytes buffer.
+        """
+        view = memoryview(self.raw)
+        for sep, (start, end) in zip(self.seps, self._slices(_id)):
+            parts.append(sep)
+            parts.append(view[start:end])
+        parts.append(self.close)
+
+
+class Attachments(object):
+    """
+    Attachment writer. Docs are picked by a hash of their id, so the same
+    `pct` percent of docs get an attachment on each update. Attachment
+    bodies are random data from a payload generator. They are sent as
+    bytes, with a Content-Length, so when couchdb-python retries a request
+    after a connection error the whole body is sent again.
+    """
+
+    def __init__(self, pct, payload):
+        self.pct = pct
+        self.payload = payload
+
+    @classmethod
+    def from_metadoc(cls, metadoc, cycle):
+        pct = metadoc.get("attachment_pct", 0)
+        if pct <= 0:
+            return None
+        payload = Payload(
+            metadoc["attachment_size"],
+            seed=metadoc.get("seed"),
+            cycle=cycle,
+            size_dist=metadoc.get("attachment_size_dist", "fixed"),
+            size_sigma=metadoc.get("size_sigma", DEFAULT_SIZE_SIGMA),
+        )
+        return cls(pct, payload)
+
+    def selected(self, _id):
+        return zlib.crc32(_id.encode("ascii")) % 10000 < self.pct * 100
+
+    def put(self, db, _id, rev):
+        """
+        Write or replace the attachment of a doc. Return the new doc
+        revision and the number of bytes written.
+        """
+        doc = {"_id": _id, "_rev": rev}
+        body = self.payload.content(_id)
+        db.put_attachment(doc, body, ATTACHMENT_NAME, "application/octet-stream")
+        return doc["_rev"], len(body)
+
+
+def put_attachments(db, attachments, newrevs, revcache=None):
+    """
+    Write attachments for the selected docs out of a {doc id: rev} dict
+    of updated docs. Return [count, bytes, dt, errors].
+    """
+    stats = [0, 0, 0.0, 0]
+    for _id, rev in newrevs.items():
+        if not attachments.selected(_id):
+            continue
+        t0 = time.time()
+        try:
+            rev, size = attachments.put(db, _id, rev)
+        except couchdb.http.ResourceConflict:
+            stats[3] += 1
+            continue
+        stats[0] += 1
+        stats[1] += size
+        stats[2] += time.time() - t0
+        if revcache is not None:
+            revcache.put(_id, rev)
+    return stats
+
+
+def max_doc_size(size, size_dist):
+    if size_dist == "uniform":
+        size = 2 * size
+    elif size_dist == "lognormal":
+        size = LOGNORMAL_MAX * size
+    return min(size, MAX_DOCUMENT_SIZE - DOC_OVERHEAD)
+
+
+def _nested_seps(names):
+    """
+    JSON fragments written before each nested doc field value.
+    """
+    seps = []
+    for i, (group, field) in enumerate(names):
+        group, field = group.encode("ascii"), field.encode("ascii")
+        if i == 0:
+            seps.append(b'{"%s":{"%s":"' % (group, field))
+        elif i % NESTED_GROUP == 0:
+            seps.append(b'"},"%s":{"%s":"' % (group, field))
+        else:
+            seps.append(b'","%s":"' % field)
+    return seps
+
+
+def _random_text(rng, n, entropy=1.0):
+    """
+    Generate n random lowercase ASCII bytes. With entropy < 1, that
+    fraction of ENTROPY_BLOCK sized blocks is random and the others
+    are picked from a set of ENTROPY_WORDS blocks.
+    """
+    if entropy >= 1:
+        raw = rng.getrandbits(8 * n).to_bytes(n, "little")
+        return raw.translate(_LOWERCASE)
+    nblocks = -(-n // ENTROPY_BLOCK)
+    nbytes = nblocks * ENTROPY_BLOCK
+    raw = rng.getrandbits(8 * nbytes).to_bytes(nbytes, "little")
+    raw = raw.translate(_LOWERCASE)
+    blocks = [raw[i : i + ENTROPY_BLOCK] for i in range(0, nbytes, ENTROPY_BLOCK)]
+    words = blocks[:ENTROPY_WORDS]
+    rnd = rng.random
+    choice = rng.choice
+    out = [b if rnd() < entropy else choice(words) for b in blocks]
+    return b"".join(out)[:n]
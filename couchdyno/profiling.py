@@ -0,0 +1,290 @@
+"""
+Run profiling shared by couchdyno and rep. PhaseTimers accumulate wall
+clock time spent in named phases of a run and Profiler optionally wraps
+the run in cProfile. Results are written to files starting with a prefix:
+
+  * <prefix>.json : time per phase, for the whole run and per cycle
+  * <prefix>.folded : phases as collapsed stacks
+  * <prefix>.pstats : cProfile stats, if cProfile is enabled
+  * <prefix>.cprofile.folded : cProfile call graph as collapsed stacks
+
+Collapsed stacks files can be rendered with flamegraph.pl or speedscope.
+"""
+
+import os
+import json
+import time
+import pstats
+import cProfile
+import threading
+import collections
+
+CYCLES_MAX = 1000
+STACK_DEPTH_MAX = 64
+
+
+class PhaseTimers(object):
+    """
+    Cumulative time and count per phase. Each thread adds to its own
+    counters, which are only merged when read, so timing doesn't take a
+    lock. Counters of threads which exited are folded into the merged
+    counters, so short lived worker threads don't pile up. Phases are
+    timed as laps: lap(phase) charges the time since the calling thread's
+    previous start() or lap() to phase.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.threads = []
+        self.merged = {}
+
+    def __getstate__(self):
+        return {"merged": self.totals()}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.merged = state["merged"]
+
+    def _counters(self):
+        counters = getattr(self.local, "counters", None)
+        if counters is None:
+            counters = self.local.counters = {}
+            with self.lock:
+                self._fold()
+                self.threads.append((threading.current_thread(), counters))
+        return counters
+
+    def _fold(self):
+        """
+        Merge counters of threads which exited. Called with the lock held.
+        """
+        live = []
+        for (thread, counters) in self.threads:
+            if thread.is_alive():
+                live.append((thread, counters))
+            else:
+                _add_counters(self.merged, list(counters.items()))
+        self.threads = live
+
+    def start(self):
+        self.local.mark = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.add(phase, now - getattr(self.local, "mark", now))
+        self.local.mark = now
+
+    def add(self, phase, dt, count=1):
+        counters = self._counters()
+        counter = counters.get(phase)
+        if counter is None:
+            counters[phase] = [count, dt]
+        else:
+            counter[0] += count
+            counter[1] += dt
+
+    def totals(self):
+        """
+        Return a {phase: [count, seconds]} dict of all threads' counters.
+        """
+        with self.lock:
+            self._fold()
+            res = dict((k, list(v)) for (k, v) in self.merged.items())
+            threads = list(self.threads)
+        for (_, counters) in threads:
+            _add_counters(res, list(counters.items()))
+        return res
+
+    def merge(self, other):
+        """
+        Add counters of another instance, for example one returned by a
+        worker process.
+        """
+        totals = other.totals()
+        with self.lock:
+            _add_counters(self.merged, totals.items())
+
+
+class _NoTimers(object):
+    """
+    PhaseTimers stand-in used when profiling is off.
+    """
+
+    def start(self):
+        pass
+
+    def lap(self, phase):
+        pass
+
+    def add(self, phase, dt, count=1):
+        pass
+
+
+NO_TIMERS = _NoTimers()
+
+
+class Profiler(object):
+    """
+    Profile of a run. Holds phase timers, per cycle breakdowns and an
+    optional cProfile profiler, started right away. cProfile only
+    profiles the thread which created the Profiler instance.
+    """
+
+    def __init__(self, prefix, name, cprofile=False):
+        self.prefix = prefix
+        self.name = name
+        self.timers = PhaseTimers()
+        self.cycles = collections.deque(maxlen=CYCLES_MAX)
+        self.last = {}
+        self.t0 = time.time()
+        self.prof = None
+        if cprofile:
+            self.prof = cProfile.Profile()
+            self.prof.enable()
+
+    @classmethod
+    def open(cls, prefix, name, cprofile=False):
+        if not prefix:
+            return None
+        return cls(prefix, name, cprofile)
+
+    def cycle(self, dt, **info):
+        """
+        Record phase times since the previous cycle, along with extra info
+        fields. Return them as a {phase: {count, sec, pct}} dict where pct
+        is the percent of the cycle's dt seconds.
+        """
+        totals = self.timers.totals()
+        delta = {}
+        for (phase, (count, sec)) in totals.items():
+            count0, sec0 = self.last.get(phase, (0, 0.0))
+            if count > count0:
+                delta[phase] = [count - count0, sec - sec0]
+        self.last = totals
+        phases = _phase_report(delta, dt)
+        self.cycles.append(dict(info, dt=round(dt, 6), phases=phases))
+        return phases
+
+    def write(self):
+        """
+        Write profile files. Can be called after every cycle, files are
+        overwritten with the results so far.
+        """
+        wall = time.time() - self.t0
+        totals = self.timers.totals()
+        report = {
+            "name": self.name,
+            "start": int(self.t0),
+            "wall_sec": round(wall, 6),
+            "phases": _phase_report(totals, wall),
+            "cycles": list(self.cycles),
+        }
+        with open(self.prefix + ".json", "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        stacks = dict(((self.name, phase), sec) for (phase, (_, sec)) in totals.items())
+        _write_folded(self.prefix + ".folded", stacks)
+        if self.prof is not None:
+            self.prof.disable()
+            try:
+                stats = pstats.Stats(self.prof)
+                stats.dump_stats(self.prefix + ".pstats")
+                stacks = _cprofile_stacks(stats.stats, self.name)
+                _write_folded(self.prefix + ".cprofile.folded", stacks)
+            finally:
+                self.prof.enable()
+
+    def stop(self):
+        if self.prof is not None:
+            self.prof.disable()
+        self.write()
+        self.prof = None
+
+
+def format_phases(phases):
+    """
+    Format a phases dict returned by Profiler.cycle() as a list of lines,
+    slowest phase first.
+    """
+    lines = []
+    for phase in sorted(phases, key=lambda p: -phases[p]["sec"]):
+        res = phases[phase]
+        lines.append(
+            "%s (sec/%%/count): %.3f / %.1f / %d"
+            % (phase, res["sec"], res["pct"], res["count"])
+        )
+    return lines
+
+
+def _add_counters(res, items):
+    for (phase, (count, sec)) in items:
+        counter = res.setdefault(phase, [0, 0.0])
+        counter[0] += count
+        counter[1] += sec
+
+
+def _phase_report(totals, wall):
+    """
+    Phases can overlap when run from multiple threads, so their percents
+    of wall time can add up to more than 100.
+    """
+    res = {}
+    for (phase, (count, sec)) in totals.items():
+        pct = 100.0 * sec / wall if wall > 0 else 0.0
+        res[phase] = {"count": count, "sec": round(sec, 6), "pct": round(pct, 2)}
+    return res
+
+
+def _write_folded(path, stacks):
+    """
+    Write a {(frame, ...): seconds} dict in collapsed stacks format, one
+    "frame;frame;... microseconds" line per stack.
+    """
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        for stack in sorted(stacks):
+            usec = int(stacks[stack] * 1e6)
+            if usec > 0:
+                f.write("%s %d\n" % (";".join(stack), usec))
+    os.replace(tmp, path)
+
+
+def _func_label(func):
+    (path, line, name) = func
+    if path == "~":
+        return name.replace(";", ",").replace(" ", "_")
+    return "%s:%s" % (os.path.basename(path), name)
+
+
+def _cprofile_stacks(stats, root):
+    """
+    Build collapsed stacks from pstats stats. cProfile only records caller
+    to callee edges, not whole stacks, so a function's time is split
+    between its callers in proportion to the cumulative time of each
+    edge. Recursive calls are folded into the outermost frame.
+    """
+    callees = collections.defaultdict(list)
+    for (func, (_, _, _, _, callers)) in stats.items():
+        for (caller, edge) in callers.items():
+            callees[caller].append((func, edge[3]))
+    stacks = collections.defaultdict(float)
+
+    def walk(func, stack, share, seen):
+        _, _, tt, ct, _ = stats[func]
+        frac = share / ct if ct > 0 else 0.0
+        stack = stack + (_func_label(func),)
+        stacks[stack] += tt * frac
+        seen = seen | {func}
+        for (callee, edge_ct) in callees.get(func, []):
+            sub = edge_ct * frac
+            if callee in seen or sub < 1e-6:
+                continue
+            if len(stack) >= STACK_DEPTH_MAX:
+                stacks[stack] += sub
+                continue
+            walk(callee, stack, sub, seen)
+
+    for (func, (_, _, _, ct, callers)) in stats.items():
+        if not callers:
+            walk(func, (root,), ct, frozenset())
+    return stacks
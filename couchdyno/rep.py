@@ -6,6 +6,8 @@ import base64
 import couchdb
 
 from .cfg import getcfg, cfghelp, logger
+from .profiling import NO_TIMERS, Profiler, format_phases
+from .metrics import Metrics
 
 # Retry times scheduled passed to CouchDB driver to use
 # in case of connection failures
@@ -13,6 +15,23 @@ RETRY_DELAYS = [1, 3, 10, 20, 30, 90]
 
 CYCLE_DT = 5
 
+METRIC_FAMILIES = [
+    #  name, type, help
+    ("cycles", "counter", "Replication test cycles run"),
+    ("fill_seconds", "gauge", "Time to fill source dbs in the last cycle"),
+    (
+        "replication_seconds",
+        "gauge",
+        "Time from creating replications until they completed in the last cycle",
+    ),
+    (
+        "propagation_seconds",
+        "gauge",
+        "Time until changes were found on the targets in the last cycle",
+    ),
+    ("last_cycle_timestamp_seconds", "gauge", "When the last cycle ended"),
+]
+
 # Export a few top level functions directly so can use them at module level
 # without having to build a Rep class instance.
 
@@ -279,6 +298,12 @@ class Rep(object):
             self.srcsrv = getsrv(cfg.source_url, timeout=timeout)
         self.repsrv = srv
         self.rdb = getrdb(srv=self.repsrv)
+        self.profiler = Profiler.open(cfg.profile, "rep", _2bool(cfg.cprofile))
+        self.metrics = None
+        if cfg.metrics_file:
+            self.metrics = Metrics("couchdyno_rep")
+            for (name, kind, help) in METRIC_FAMILIES:
+                self.metrics.family(name, kind, help)
 
     def __repr__(self):
         return "<Rep %s source = %s target = %s>" % (
@@ -1334,32 +1359,47 @@ class Rep(object):
         method to use. Source fill callback method to use. Whether to use a
         single replicator db per each doc, additional replication and filter
         params.
+
+        If a profile is configured, time spent in each phase (setup, fill,
+        start, propagate, complete) is logged after each cycle. If a metrics
+        file is configured, fill, replication and propagation times are
+        written to it after each cycle.
         """
+        timers = self.profiler.timers if self.profiler else NO_TIMERS
+        timers.start()
         filter_ddoc, rep_params = self._filter_ddoc_and_rep_params(
             filter_params, rep_params
         )
         self._clean_reps()
         self.create_dbs(sr, tr, reset_target=reset_target, reset_source=reset_source)
         self.sync_filter(filter_ddoc, sr)
+        timers.lap("setup")
         if normal:
             for cycle in range(1, cycles + 1):
                 if cycles > 1:
                     logger("  ----- cycle", cycle, "------")
-                t0 = time.time()
+                t0 = tc = time.time()
+                timers.start()
                 fill_callback()
+                timers.lap("fill")
                 dt_fill = time.time() - t0
                 logger(
                     "filled %s num docs %s revs %s branches in %.0f sec"
                     % (num, revs, branches, dt_fill)
                 )
                 self._clean_reps()
+                timers.lap("setup")
                 t0 = time.time()
                 rep_method(
                     sr, tr, normal=True, db_per_doc=db_per_doc, rep_params=rep_params
                 )
+                timers.lap("start")
                 logger("replication started")
+                dt_prop = None
                 if not skip_rev_check:
                     self.wait_till_all_equal(sr, tr, log=False)
+                    timers.lap("propagate")
+                    dt_prop = time.time() - t0
                 else:
                     logger("skipping detailed rev check")
                 if not db_per_doc:
@@ -1370,17 +1410,61 @@ class Rep(object):
                         retry_timeout=self.cycle_timeout,
                         retry_dt=self.cycle_dt,
                     )
+                    timers.lap("complete")
                 dt_rep = time.time() - t0
                 logger("replicated in %.0f sec" % dt_rep)
+                self._profile_cycle(cycle, time.time() - tc)
+                self._record_metrics("normal", dt_fill, dt_prop, dt_rep)
         else:
             rep_method(
                 sr, tr, normal=False, db_per_doc=db_per_doc, rep_params=rep_params
             )
+            timers.lap("start")
             for cycle in range(1, cycles + 1):
                 if cycles > 1:
                     logger("   ------- cycle", cycle, "-------")
+                tc = time.time()
+                timers.start()
                 fill_callback()
+                timers.lap("fill")
+                t0 = time.time()
                 self.wait_till_all_equal(sr, tr, log=False)
+                timers.lap("propagate")
+                dt_prop = time.time() - t0
+                self._profile_cycle(cycle, time.time() - tc)
+                self._record_metrics("continuous", t0 - tc, dt_prop)
+
+    def _record_metrics(self, mode, dt_fill, dt_prop=None, dt_rep=None):
+        """
+        Update metrics with a cycle's times and write them to the metrics
+        file. Propagation time is measured from when replications were
+        started for normal replications and from the end of the fill for
+        continuous ones.
+        """
+        if self.metrics is None:
+            return
+        labels = {"prefix": self.prefix, "mode": mode}
+        self.metrics.inc("cycles", **labels)
+        self.metrics.set("fill_seconds", dt_fill, **labels)
+        if dt_prop is not None:
+            self.metrics.set("propagation_seconds", dt_prop, **labels)
+        if dt_rep is not None:
+            self.metrics.set("replication_seconds", dt_rep, **labels)
+        self.metrics.set("last_cycle_timestamp_seconds", int(time.time()), **labels)
+        self.metrics.write(self.cfg.metrics_file)
+
+    def _profile_cycle(self, cycle, dt):
+        """
+        Log time spent in each phase of the last cycle and update the
+        profile files.
+        """
+        if self.profiler is None:
+            return
+        phases = self.profiler.cycle(dt, cycle=cycle)
+        logger("profile:")
+        for line in format_phases(phases):
+            logger("  ", line)
+        self.profiler.write()
 
     def wait_till_all_equal(self, sr, tr, log=True):
         """
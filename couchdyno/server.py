@@ -0,0 +1,952 @@
+"""
+In-process CouchDB stand-in server. It implements the subset of the CouchDB
+HTTP API used by the couchdyno, rep and cluster modules, so their client side
+code can be run, benchmarked and profiled without a live CouchDB:
+
+  * server: /, _all_dbs, _active_tasks, _up
+  * dbs: create, delete, info, _compact, _ensure_full_commit
+  * docs: get, put, delete, _local and _design docs, attachments
+  * _bulk_docs (including new_edits=false)
+  * _all_docs with key ranges, keys and include_docs
+  * _changes with normal, longpoll and continuous feeds
+  * _replicator: replication docs copy documents between dbs of the same
+    server in-process
+
+Data is kept in memory. Views, Mango queries and replication filters are not
+implemented. Latency can be injected for every request and for every doc
+written, to separate client overhead from server time.
+
+Example of usage:
+
+  with server.running(latency=0.001) as url:
+      db = couchdb.Server(url).create("db1")
+      ...
+
+Or from the command line: couchdyno-server --port 15984
+"""
+
+import json
+import time
+import uuid
+import base64
+import bisect
+import hashlib
+import argparse
+import itertools
+import threading
+import contextlib
+import urllib.parse
+import http.server
+
+VERSION = "3.3.3"
+DEFAULT_PORT = 15984
+REPLICATOR_DB = "_replicator"
+REVS_LIMIT = 1000
+SEQS_SLACK = 1000
+CHANGES_TIMEOUT = 60000
+RESERVED = set(
+    [
+        "_id",
+        "_rev",
+        "_deleted",
+        "_revisions",
+        "_attachments",
+        "_conflicts",
+        "_revs_info",
+    ]
+)
+
+
+class _HTTPError(Exception):
+    def __init__(self, code, error, reason):
+        super(_HTTPError, self).__init__(code, error, reason)
+        self.code = code
+        self.body = {"error": error, "reason": reason}
+
+
+def _not_found(reason="missing"):
+    return _HTTPError(404, "not_found", reason)
+
+
+def _conflict():
+    return _HTTPError(409, "conflict", "Document update conflict.")
+
+
+def _gen(rev):
+    return int(rev.split("-", 1)[0])
+
+
+class _Doc(object):
+    """
+    Revision tree of a document, kept as a dict of leaf revisions. Each
+    leaf has its revision path (newest first, up to REVS_LIMIT ids), body,
+    deleted flag and size.
+    """
+
+    def __init__(self, _id):
+        self.id = _id
+        self.leafs = {}
+        self.seq = 0
+
+    def winner(self):
+        leafs = self.leafs
+        return max(leafs, key=lambda rev: (not leafs[rev][2], _gen(rev), rev))
+
+    def deleted(self):
+        return not self.leafs or self.leafs[self.winner()][2]
+
+    def known(self, rev):
+        gen, rid = rev.split("-", 1)
+        gen = int(gen)
+        for leaf, (path, _, _, _) in self.leafs.items():
+            idx = _gen(leaf) - gen
+            if 0 <= idx < len(path) and path[idx] == rid:
+                return True
+        return False
+
+    def render(self, rev=None, revs=False, conflicts=False, attachments=False):
+        if rev is None:
+            rev = self.winner()
+        path, body, deleted, _ = self.leafs[rev]
+        doc = {"_id": self.id, "_rev": rev}
+        for k, v in body.items():
+            if k == "_attachments":
+                v = _render_attachments(v, attachments)
+            doc[k] = v
+        if deleted:
+            doc["_deleted"] = True
+        if revs:
+            doc["_revisions"] = {"start": _gen(rev), "ids": list(path)}
+        if conflicts:
+            others = [r for r in self.leafs if r != rev and not self.leafs[r][2]]
+            if others:
+                doc["_conflicts"] = sorted(others, key=_gen, reverse=True)
+        return doc
+
+
+def _render_attachments(atts, data):
+    res = {}
+    for name, att in atts.items():
+        att = dict(att)
+        content = att.pop("data")
+        if data:
+            att["data"] = base64.b64encode(content).decode("ascii")
+        else:
+            att["stub"] = True
+        res[name] = att
+    return res
+
+
+def _attachment(content_type, content, revpos):
+    digest = base64.b64encode(hashlib.md5(content).digest()).decode("ascii")
+    return {
+        "content_type": content_type,
+        "data": content,
+        "digest": "md5-" + digest,
+        "length": len(content),
+        "revpos": revpos,
+    }
+
+
+class _Db(object):
+    """
+    In-memory database. Ids are kept sorted for _all_docs. For _changes,
+    update sequences and ids are appended to two lists on each write, so
+    they stay sorted by sequence and are searched with bisect. Entries of
+    docs written again later are skipped when read, and dropped once they
+    are the majority. Doc counts are kept up to date on each write, so
+    the cost of a request doesn't depend on the db size.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.docs = {}
+        self.ids = []
+        self.seqs = []
+        self.seq_ids = []
+        self.local = {}
+        self.seq = 0
+        self.doc_count = 0
+        self.doc_del_count = 0
+        self.file_size = 0
+        self.active_size = 0
+        self.created = time.time()
+
+    def info(self):
+        return {
+            "db_name": self.name,
+            "doc_count": self.doc_count,
+            "doc_del_count": self.doc_del_count,
+            "update_seq": _seq(self.seq),
+            "purge_seq": 0,
+            "compact_running": False,
+            "sizes": {
+                "file": self.file_size,
+                "active": self.active_size,
+                "external": self.active_size,
+            },
+            "instance_start_time": "%d" % (self.created * 1e6),
+        }
+
+    def _store(self, doc, rev, path, body, deleted, replaces):
+        size = len(json.dumps(body, default=_att_size))
+        if doc.leafs:
+            self._count(doc, -1)
+        for old in replaces:
+            self.active_size -= doc.leafs.pop(old)[3]
+        doc.leafs[rev] = (path, body, deleted, size)
+        self._count(doc, 1)
+        self.active_size += size
+        self.file_size += size
+        if doc.id not in self.docs:
+            self.docs[doc.id] = doc
+            bisect.insort(self.ids, doc.id)
+        self.seq += 1
+        doc.seq = self.seq
+        self.seqs.append(doc.seq)
+        self.seq_ids.append(doc.id)
+        if len(self.seqs) > 2 * len(self.docs) + SEQS_SLACK:
+            self._trim_seqs()
+
+    def _count(self, doc, n):
+        if doc.deleted():
+            self.doc_del_count += n
+        else:
+            self.doc_count += n
+
+    def _trim_seqs(self):
+        """
+        Drop sequence entries of docs which were written again since. New
+        lists are built, so changed() generators already running keep
+        reading the old ones.
+        """
+        docs = sorted(self.docs.values(), key=lambda doc: doc.seq)
+        self.seqs = [doc.seq for doc in docs]
+        self.seq_ids = [doc.id for doc in docs]
+
+    def update(self, data, new_edits=True):
+        """
+        Write a document. Return its new revision or raise _HTTPError.
+        """
+        _id = data.get("_id") or uuid.uuid4().hex
+        doc = self.docs.get(_id) or _Doc(_id)
+        deleted = bool(data.get("_deleted", False))
+        if new_edits:
+            rev = data.get("_rev")
+            if not doc.leafs:
+                if rev is not None:
+                    raise _conflict()
+                parent = None
+            elif rev is None:
+                if not doc.deleted():
+                    raise _conflict()
+                parent = doc.winner()
+            elif rev in doc.leafs:
+                parent = rev
+            else:
+                raise _conflict()
+            gen = _gen(parent) + 1 if parent else 1
+            rid = uuid.uuid4().hex
+            path = [rid]
+            if parent:
+                path += doc.leafs[parent][0][: REVS_LIMIT - 1]
+            newrev = "%d-%s" % (gen, rid)
+            replaces = [parent] if parent else []
+        else:
+            revisions = data.get("_revisions")
+            if revisions:
+                gen, path = revisions["start"], list(revisions["ids"])
+            else:
+                gen, rid = data["_rev"].split("-", 1)
+                gen, path = int(gen), [rid]
+            newrev = "%d-%s" % (gen, path[0])
+            if doc.known(newrev):
+                return newrev
+            parent = None
+            ancestors = set("%d-%s" % (gen - i, r) for (i, r) in enumerate(path))
+            replaces = [leaf for leaf in doc.leafs if leaf in ancestors]
+        body = dict((k, v) for (k, v) in data.items() if k not in RESERVED)
+        atts = data.get("_attachments")
+        if atts:
+            body["_attachments"] = self._attachments(doc, atts, gen, parent)
+        self._store(doc, newrev, path, body, deleted, replaces)
+        return newrev
+
+    def _attachments(self, doc, atts, gen, parent):
+        res = {}
+        for name, att in atts.items():
+            if att.get("stub"):
+                old = None
+                for leaf in [parent] if parent else list(doc.leafs):
+                    old = doc.leafs[leaf][1].get("_attachments", {}).get(name)
+                    if old is not None:
+                        break
+                if old is not None:
+                    res[name] = old
+                continue
+            content = base64.b64decode(att.get("data", ""))
+            ctype = att.get("content_type", "application/octet-stream")
+            res[name] = _attachment(ctype, content, gen)
+        return res
+
+    def put_attachment(self, _id, rev, name, content_type, content):
+        doc = self.docs.get(_id)
+        if doc is None or doc.deleted():
+            if rev is not None:
+                raise _conflict()
+            body = {}
+        else:
+            if rev not in doc.leafs:
+                raise _conflict()
+            body = _with_stubs(dict(doc.leafs[rev][1]))
+        data = dict(body, _id=_id)
+        if rev is not None:
+            data["_rev"] = rev
+        newrev = self.update(data)
+        body = self.docs[_id].leafs[newrev][1]
+        atts = body.setdefault("_attachments", {})
+        atts[name] = _attachment(content_type, content, _gen(newrev))
+        return newrev
+
+    def changed(self, since):
+        """
+        Yield docs changed after `since`, in update sequence order.
+        """
+        seqs, seq_ids = self.seqs, self.seq_ids
+        for i in range(bisect.bisect_right(seqs, since), len(seqs)):
+            doc = self.docs[seq_ids[i]]
+            if doc.seq == seqs[i]:
+                yield doc
+
+    def compact(self):
+        self.file_size = self.active_size
+        self._trim_seqs()
+
+
+def _att_size(content):
+    return len(content)
+
+
+def _seq(n):
+    return "%d-standin" % n
+
+
+def _seq_num(seq, current):
+    if seq in (None, ""):
+        return 0
+    if seq == "now":
+        return current
+    return int(str(seq).split("-", 1)[0])
+
+
+def _change_row(db, doc, include_docs):
+    rev = doc.winner()
+    row = {"seq": _seq(doc.seq), "id": doc.id, "changes": [{"rev": rev}]}
+    if doc.leafs[rev][2]:
+        row["deleted"] = True
+    if include_docs:
+        row["doc"] = doc.render(rev)
+    return row
+
+
+class StandIn(object):
+    """
+    In-memory CouchDB stand-in server. `latency` seconds are added to every
+    request and `doc_latency` seconds for every doc written by _bulk_docs.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0, doc_latency=0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.doc_latency = doc_latency
+        self.dbs = {REPLICATOR_DB: _Db(REPLICATOR_DB)}
+        self.cond = threading.Condition()
+        self.jobs = {}
+        self.httpd = None
+        self.stopped = False
+
+    @property
+    def url(self):
+        return "http://%s:%d" % (self.host, self.port)
+
+    def start(self):
+        self.httpd = _HTTPServer((self.host, self.port), _Handler)
+        self.httpd.standin = self
+        self.port = self.httpd.server_address[1]
+        thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    def db(self, name):
+        db = self.dbs.get(name)
+        if db is None:
+            raise _not_found("Database does not exist.")
+        return db
+
+    def written(self, db, docs):
+        """
+        Called with the lock held after docs were written to db.
+        """
+        self.cond.notify_all()
+        if db.name == REPLICATOR_DB or db.name.endswith("/" + REPLICATOR_DB):
+            for doc in docs:
+                self._maybe_replicate(db, doc)
+
+    # Replicator
+
+    def _maybe_replicate(self, repdb, doc):
+        key = (repdb.name, doc.id)
+        if doc.deleted():
+            self.jobs.pop(key, None)
+            return
+        body = doc.leafs[doc.winner()][1]
+        if "_replication_state" in body:
+            return
+        job = object()
+        self.jobs[key] = job
+        args = (repdb, doc.id, job, dict(body))
+        threading.Thread(target=self._replicate, args=args, daemon=True).start()
+
+    def _replicate(self, repdb, doc_id, job, params):
+        """
+        Copy all leaf revisions of changed docs from source to target
+        until done or, for continuous replications, until the replication
+        doc is deleted or changed.
+        """
+        continuous = params.get("continuous", False)
+        since = 0
+        with self.cond:
+            try:
+                src, tgt = self._rep_dbs(params)
+            except _HTTPError as ex:
+                self._rep_state(repdb, doc_id, job, "failed", ex.body["reason"])
+                return
+            doc_ids = params.get("doc_ids")
+            while self.jobs.get((repdb.name, doc_id)) is job and not self.stopped:
+                copied = []
+                for doc in src.changed(since):
+                    if doc_ids is not None and doc.id not in doc_ids:
+                        continue
+                    for rev, (path, body, deleted, _) in list(doc.leafs.items()):
+                        data = dict(body, _id=doc.id)
+                        data["_revisions"] = {"start": _gen(rev), "ids": path}
+                        data["_deleted"] = deleted
+                        tgt.update(_with_stubs(data), new_edits=False)
+                        _copy_attachments(tgt, doc.id, rev, body)
+                    copied.append(tgt.docs[doc.id])
+                since = src.seq
+                if copied:
+                    self.written(tgt, copied)
+                if not continuous:
+                    self._rep_state(repdb, doc_id, job, "completed")
+                    return
+                if since == 0 or copied:
+                    self._rep_state(repdb, doc_id, job, "triggered")
+                self.cond.wait(1.0)
+
+    def _rep_dbs(self, params):
+        src = self.db(_rep_dbname(params.get("source")))
+        tgt_name = _rep_dbname(params.get("target"))
+        if params.get("filter") or params.get("selector"):
+            raise _HTTPError(400, "bad_request", "filters are not supported")
+        if tgt_name not in self.dbs:
+            if not params.get("create_target"):
+                raise _not_found("Database does not exist.")
+            self.dbs[tgt_name] = _Db(tgt_name)
+        return src, self.dbs[tgt_name]
+
+    def _rep_state(self, repdb, doc_id, job, state, reason=None):
+        if self.jobs.get((repdb.name, doc_id)) is not job:
+            return
+        doc = repdb.docs.get(doc_id)
+        if doc is None or doc.deleted():
+            return
+        data = doc.render()
+        if data.get("_replication_state") == state:
+            return
+        data["_replication_state"] = state
+        data["_replication_state_time"] = int(time.time())
+        if reason is not None:
+            data["_replication_state_reason"] = reason
+        repdb.update(_with_stubs(data))
+        self.cond.notify_all()
+        if state != "triggered":
+            self.jobs.pop((repdb.name, doc_id), None)
+
+
+def _with_stubs(data):
+    """
+    Replace stored attachments (with raw bytes) by stubs.
+    """
+    atts = data.get("_attachments")
+    if atts:
+        data["_attachments"] = dict((k, {"stub": True}) for k in atts)
+    return data
+
+
+def _copy_attachments(tgt, _id, rev, body):
+    atts = body.get("_attachments")
+    if not atts:
+        return
+    leaf = tgt.docs[_id].leafs.get(rev)
+    if leaf is not None:
+        leaf[1]["_attachments"] = dict(atts)
+
+
+def _rep_dbname(endpoint):
+    if isinstance(endpoint, dict):
+        endpoint = endpoint.get("url", "")
+    if not isinstance(endpoint, str):
+        raise _HTTPError(400, "bad_request", "invalid endpoint")
+    if "://" in endpoint:
+        endpoint = urllib.parse.urlsplit(endpoint).path
+    return urllib.parse.unquote(endpoint.strip("/"))
+
+
+class _HTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    """
+    Request handler. Paths are split in segments before unquoting, so db
+    names with an encoded "/" are a single segment.
+    """
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    server_version = "couchdyno-standin/" + VERSION
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_HEAD(self):
+        self._handle("HEAD")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+    def _handle(self, method):
+        standin = self.server.standin
+        if standin.latency > 0:
+            time.sleep(standin.latency)
+        split = urllib.parse.urlsplit(self.path)
+        path = [urllib.parse.unquote(p) for p in split.path.split("/") if p]
+        query = urllib.parse.parse_qs(split.query, keep_blank_values=True)
+        self.query = dict((k, _param(v[-1])) for (k, v) in query.items())
+        self.method = method
+        try:
+            body = self._read_body()
+            res = self._route(standin, method, path, body)
+        except _HTTPError as ex:
+            res = (ex.code, ex.body)
+        except (ValueError, KeyError, TypeError) as ex:
+            res = (400, {"error": "bad_request", "reason": str(ex)})
+        if res is not None:
+            self._send_json(*res)
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().strip().split(b";")[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return b"".join(chunks)
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _json_body(self, body):
+        return json.loads(body.decode("utf-8")) if body else {}
+
+    def _send_json(self, code, obj, headers=None):
+        data = json.dumps(obj).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        if self.method != "HEAD":
+            self.wfile.write(data)
+
+    def _route(self, standin, method, path, body):
+        if not path:
+            return 200, {"couchdb": "Welcome", "version": VERSION}
+        if path[0] == "_all_dbs":
+            with standin.cond:
+                return 200, sorted(standin.dbs)
+        if path[0] == "_active_tasks":
+            return 200, []
+        if path[0] == "_up":
+            return 200, {"status": "ok"}
+        if path[0].startswith("_") and path[0] != REPLICATOR_DB:
+            raise _not_found()
+        dbname = path[0]
+        if len(path) == 1:
+            return self._db(standin, method, dbname, body)
+        with standin.cond:
+            db = standin.db(dbname)
+        seg = path[1]
+        if seg == "_bulk_docs" and method == "POST":
+            return self._bulk_docs(standin, db, self._json_body(body))
+        if seg == "_all_docs":
+            return self._all_docs(standin, db, self._json_body(body))
+        if seg == "_changes":
+            return self._changes(standin, db)
+        if seg == "_compact" and method == "POST":
+            with standin.cond:
+                db.compact()
+            return 202, {"ok": True}
+        if seg == "_ensure_full_commit" and method == "POST":
+            return 201, {"ok": True, "instance_start_time": "0"}
+        if seg == "_local" and len(path) == 3:
+            return self._local(standin, db, method, path[2], body)
+        if seg == "_design" and len(path) >= 3:
+            if len(path) > 3 and path[3].startswith("_"):
+                raise _HTTPError(501, "not_implemented", "views are not supported")
+            return self._doc(standin, db, method, "/".join(path[1:3]), path[3:], body)
+        if seg.startswith("_"):
+            raise _HTTPError(501, "not_implemented", "%s is not supported" % seg)
+        return self._doc(standin, db, method, seg, path[2:], body)
+
+    def _db(self, standin, method, dbname, body):
+        with standin.cond:
+            if method == "PUT":
+                if dbname in standin.dbs:
+                    raise _HTTPError(412, "file_exists", "The database exists.")
+                standin.dbs[dbname] = _Db(dbname)
+                return 201, {"ok": True}
+            if method == "DELETE":
+                standin.db(dbname)
+                del standin.dbs[dbname]
+                standin.cond.notify_all()
+                return 200, {"ok": True}
+            db = standin.db(dbname)
+            if method == "POST":
+                rev = db.update(self._json_body(body))
+                _id = db.seq_ids[-1]
+                standin.written(db, [db.docs[_id]])
+                return 201, {"ok": True, "id": _id, "rev": rev}
+            return 200, db.info()
+
+    def _bulk_docs(self, standin, db, req):
+        docs = req.get("docs", [])
+        new_edits = req.get("new_edits", True)
+        if standin.doc_latency > 0:
+            time.sleep(standin.doc_latency * len(docs))
+        results, written = [], []
+        with standin.cond:
+            for data in docs:
+                _id = data.get("_id")
+                try:
+                    rev = db.update(data, new_edits=new_edits)
+                except _HTTPError as ex:
+                    results.append(dict(ex.body, id=_id))
+                    continue
+                _id = _id or db.seq_ids[-1]
+                written.append(db.docs[_id])
+                if new_edits:
+                    results.append({"ok": True, "id": _id, "rev": rev})
+            standin.written(db, written)
+        return 201, results
+
+    def _all_docs(self, standin, db, req):
+        q = self.query
+        include_docs = q.get("include_docs", False)
+        keys = req.get("keys", q.get("keys"))
+        rows = []
+        with standin.cond:
+            if keys is not None:
+                for key in keys:
+                    doc = db.docs.get(key)
+                    if doc is None:
+                        rows.append({"key": key, "error": "not_found"})
+                        continue
+                    row = {"id": key, "key": key, "value": {"rev": doc.winner()}}
+                    if doc.deleted():
+                        row["value"]["deleted"] = True
+                        row["doc"] = None
+                    elif include_docs:
+                        row["doc"] = doc.render()
+                    rows.append(row)
+                total = db.doc_count
+                return 200, {"total_rows": total, "offset": 0, "rows": rows}
+            skip, limit = int(q.get("skip", 0)), q.get("limit")
+            for i in _key_range(db.ids, q):
+                _id = db.ids[i]
+                doc = db.docs[_id]
+                if doc.deleted():
+                    continue
+                if skip > 0:
+                    skip -= 1
+                    continue
+                if limit is not None and len(rows) >= int(limit):
+                    break
+                row = {"id": _id, "key": _id, "value": {"rev": doc.winner()}}
+                if include_docs:
+                    row["doc"] = doc.render()
+                rows.append(row)
+            total = db.doc_count
+        return 200, {"total_rows": total, "offset": 0, "rows": rows}
+
+    def _changes(self, standin, db):
+        q = self.query
+        feed = q.get("feed", "normal")
+        include_docs = q.get("include_docs", False)
+        limit = q.get("limit")
+        timeout = int(q.get("timeout", CHANGES_TIMEOUT)) / 1000.0
+        heartbeat = q.get("heartbeat")
+        if heartbeat is True:
+            heartbeat = CHANGES_TIMEOUT
+        with standin.cond:
+            since = _seq_num(q.get("since"), db.seq)
+        if feed == "continuous":
+            return self._continuous(
+                standin, db, since, include_docs, timeout, heartbeat
+            )
+        till = time.time() + timeout
+        with standin.cond:
+            while True:
+                changed = db.changed(since)
+                if limit is not None:
+                    changed = itertools.islice(changed, int(limit))
+                rows = [_change_row(db, d, include_docs) for d in changed]
+                left = till - time.time()
+                if rows or feed != "longpoll" or left <= 0 or standin.stopped:
+                    break
+                standin.cond.wait(left)
+            last_seq = rows[-1]["seq"] if rows else _seq(since)
+        return 200, {"results": rows, "last_seq": last_seq, "pending": 0}
+
+    def _continuous(self, standin, db, since, include_docs, timeout, heartbeat):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        wait = timeout if not heartbeat else int(heartbeat) / 1000.0
+        idle_since = time.time()
+        try:
+            while True:
+                with standin.cond:
+                    rows = [_change_row(db, d, include_docs) for d in db.changed(since)]
+                    if not rows and not standin.stopped:
+                        standin.cond.wait(wait)
+                        rows = [
+                            _change_row(db, d, include_docs) for d in db.changed(since)
+                        ]
+                    stopped = standin.stopped or standin.dbs.get(db.name) is not db
+                if rows:
+                    data = "".join(json.dumps(r) + "\n" for r in rows)
+                    self._chunk(data.encode("utf-8"))
+                    since = _seq_num(rows[-1]["seq"], 0)
+                    idle_since = time.time()
+                elif heartbeat:
+                    self._chunk(b"\n")
+                if stopped or not heartbeat and time.time() - idle_since >= timeout:
+                    last = json.dumps({"last_seq": _seq(since)}) + "\n"
+                    self._chunk(last.encode("utf-8"))
+                    self._chunk(b"")
+                    return None
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+            return None
+
+    def _chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def _local(self, standin, db, method, name, body):
+        _id = "_local/" + name
+        with standin.cond:
+            cur = db.local.get(_id)
+            if method == "GET":
+                if cur is None:
+                    raise _not_found()
+                return 200, cur
+            data = self._json_body(body) if method == "PUT" else {}
+            rev = data.get("_rev", self.query.get("rev"))
+            if cur is not None and rev != cur["_rev"]:
+                raise _conflict()
+            if method == "DELETE":
+                if cur is None:
+                    raise _not_found()
+                del db.local[_id]
+                return 200, {"ok": True, "id": _id, "rev": "0-0"}
+            gen = int(cur["_rev"].split("-")[1]) + 1 if cur else 1
+            newrev = "0-%d" % gen
+            db.local[_id] = dict(data, _id=_id, _rev=newrev)
+            return 201, {"ok": True, "id": _id, "rev": newrev}
+
+    def _doc(self, standin, db, method, _id, att, body):
+        q = self.query
+        if att:
+            return self._attachment(standin, db, method, _id, "/".join(att), body)
+        with standin.cond:
+            doc = db.docs.get(_id)
+            if method in ("GET", "HEAD"):
+                rev = q.get("rev")
+                if doc is None or (rev is None and doc.deleted()):
+                    raise _not_found("deleted" if doc else "missing")
+                if rev is not None and rev not in doc.leafs:
+                    raise _not_found()
+                res = doc.render(
+                    rev,
+                    revs=q.get("revs", False),
+                    conflicts=q.get("conflicts", False),
+                    attachments=q.get("attachments", False),
+                )
+                return 200, res, {"ETag": '"%s"' % res["_rev"]}
+            if method == "PUT":
+                data = self._json_body(body)
+                data["_id"] = _id
+                if "rev" in q:
+                    data.setdefault("_rev", q["rev"])
+                new_edits = q.get("new_edits", True)
+            elif method == "DELETE":
+                data = {"_id": _id, "_rev": q.get("rev"), "_deleted": True}
+                new_edits = True
+            else:
+                raise _HTTPError(405, "method_not_allowed", method)
+            rev = db.update(data, new_edits=new_edits)
+            standin.written(db, [db.docs[_id]])
+            code = 200 if method == "DELETE" else 201
+            return code, {"ok": True, "id": _id, "rev": rev}
+
+    def _attachment(self, standin, db, method, _id, name, body):
+        with standin.cond:
+            if method in ("GET", "HEAD"):
+                doc = db.docs.get(_id)
+                if doc is None or doc.deleted():
+                    raise _not_found()
+                atts = doc.leafs[self.query.get("rev") or doc.winner()][1]
+                att = atts.get("_attachments", {}).get(name)
+                if att is None:
+                    raise _not_found()
+                self.send_response(200)
+                self.send_header("Content-Type", att["content_type"])
+                self.send_header("Content-Length", str(att["length"]))
+                self.end_headers()
+                if method == "GET":
+                    self.wfile.write(att["data"])
+                return None
+            if method != "PUT":
+                raise _HTTPError(405, "method_not_allowed", method)
+            ctype = self.headers.get("Content-Type", "application/octet-stream")
+            rev = self.query.get("rev")
+            newrev = db.put_attachment(_id, rev, name, ctype, body)
+            standin.written(db, [db.docs[_id]])
+            return 201, {"ok": True, "id": _id, "rev": newrev}
+
+
+def _param(val):
+    """
+    Query parameters are JSON encoded by clients, but some, like since=now
+    or rev=1-abc, are plain strings. couchdb-python sends booleans as
+    True/False.
+    """
+    if val in ("True", "False"):
+        return val == "True"
+    try:
+        return json.loads(val)
+    except ValueError:
+        return val
+
+
+def _key_range(ids, q):
+    """
+    Return the range of indices of sorted ids selected by _all_docs range
+    parameters, in the order rows are returned. Ranges are lazy, so
+    queries with a limit don't copy the rest of the ids.
+    """
+    descending = q.get("descending", False)
+    startkey = q.get("startkey", q.get("start_key"))
+    endkey = q.get("endkey", q.get("end_key"))
+    inclusive_end = q.get("inclusive_end", True)
+    if "key" in q:
+        startkey = endkey = q["key"]
+    if not descending:
+        lo = 0 if startkey is None else bisect.bisect_left(ids, startkey)
+        if endkey is None:
+            hi = len(ids)
+        elif inclusive_end:
+            hi = bisect.bisect_right(ids, endkey)
+        else:
+            hi = bisect.bisect_left(ids, endkey)
+        return range(lo, hi)
+    hi = len(ids) if startkey is None else bisect.bisect_right(ids, startkey)
+    if endkey is None:
+        lo = 0
+    elif inclusive_end:
+        lo = bisect.bisect_left(ids, endkey)
+    else:
+        lo = bisect.bisect_right(ids, endkey)
+    return range(hi - 1, lo - 1, -1)
+
+
+@contextlib.contextmanager
+def running(host="127.0.0.1", port=0, latency=0, doc_latency=0):
+    """
+    Context manager which runs a stand-in server in background threads
+    and yields its URL. By default it listens on a random free port.
+    """
+    standin = StandIn(host, port, latency, doc_latency).start()
+    try:
+        yield standin.url
+    finally:
+        standin.stop()
+
+
+def main():
+    """
+    Script endpoint. Run a stand-in server until interrupted.
+    """
+    p = argparse.ArgumentParser(description="In-memory CouchDB stand-in server")
+    p.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    p.add_argument("--port", type=int, default=DEFAULT_PORT, help="Port to use")
+    p.add_argument(
+        "--latency",
+        type=float,
+        default=0,
+        help="Seconds of latency to add to every request",
+    )
+    p.add_argument(
+        "--doc-latency",
+        type=float,
+        default=0,
+        help="Seconds of latency to add for every doc written by _bulk_docs",
+    )
+    args = p.parse_args()
+    standin = StandIn(args.host, args.port, args.latency, args.doc_latency)
+    standin.start()
+    print("CouchDB stand-in listening on", standin.url)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        standin.stop()
@@ -0,0 +1,118 @@
+"""
+Helpers shared by couchdyno modules.
+"""
+
+import time
+import threading
+import urllib.parse
+import couchdb
+
+
+class PicklableLock(object):
+    """
+    Mixin for objects guarded by a threading.Lock kept in their `lock`
+    attribute. Locks can't be pickled, so the lock is left out when the
+    object is sent to another process, which creates a new one.
+    """
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+def server_resource(db):
+    """
+    Resource for the server of a db, sharing the db session and credentials.
+    """
+    sres = urllib.parse.urlsplit(db.resource.url)
+    srvurl = urllib.parse.urlunsplit(sres._replace(path="", query=""))
+    res = couchdb.http.Resource(srvurl, db.resource.session)
+    res.credentials = db.resource.credentials
+    return res
+
+
+def db_tasks(db, types):
+    """
+    Return _active_tasks of the given types running on db. In a cluster
+    tasks are reported per shard, as shards/<range>/<dbname>.<suffix>.
+    """
+    _, _, tasks = server_resource(db).get_json("_active_tasks")
+    found = []
+    for task in tasks:
+        dbname = task.get("database", "")
+        if dbname.startswith("shards/"):
+            dbname = dbname.split("/")[-1].rsplit(".", 1)[0]
+        if task.get("type") in types and dbname == db.name:
+            found.append(task)
+    return found
+
+
+def seq_num(seq):
+    """
+    Numeric part of an update sequence. Clustered sequences are opaque
+    strings starting with the sum of shard sequences.
+    """
+    return int(str(seq).split("-")[0])
+
+
+def is_timeout(ex):
+    ex_args = ex.args[0]
+    return (
+        isinstance(ex_args, tuple)
+        and len(ex_args) == 2
+        and ex_args[0] == 500
+        and isinstance(ex_args[1], tuple)
+        and ex_args[1][0] == "timeout"
+    )
+
+
+def retry_timeout(fun, maxwait):
+    """
+    Call fun, retrying while it fails with a server timeout, which is how
+    index queries fail when the index takes a long time to build.
+    """
+    till = time.time() + maxwait
+    while True:
+        try:
+            return fun()
+        except couchdb.http.ServerError as ex:
+            if not is_timeout(ex) or time.time() > till:
+                raise
+
+
+def db_sizes(db):
+    """
+    Return file, active and external sizes in bytes, doc counts and the
+    numeric update sequence from the db info. CouchDB 1.x only reports
+    disk_size and data_size, and missing values are left out.
+    """
+    info = db.info()
+    sizes = info.get("sizes") or {
+        "file": info.get("disk_size"),
+        "active": info.get("data_size"),
+    }
+    res = dict(
+        file_bytes=sizes.get("file"),
+        active_bytes=sizes.get("active"),
+        external_bytes=sizes.get("external"),
+        doc_count=info.get("doc_count"),
+        doc_del_count=info.get("doc_del_count"),
+        update_seq=seq_num(info.get("update_seq", 0)),
+    )
+    return dict((k, v) for (k, v) in res.items() if v is not None)
+
+
+def has_sizes(sizes):
+    return sizes is not None and "file_bytes" in sizes and "active_bytes" in sizes
+
+
+def fragmentation_pct(sizes):
+    file_size = sizes["file_bytes"]
+    if file_size <= 0:
+        return 0.0
+    return 100.0 * (file_size - sizes["active_bytes"]) / file_size
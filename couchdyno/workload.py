@@ -0,0 +1,93 @@
+"""
+YCSB style mixed workloads for couchdyno. A workload is a set of op
+ratios, like read=50,update=50. Each operation is a single request on
+one doc, or a short _all_docs range for scans.
+
+Example of usage:
+
+  workload = parse_workload("read=95,update=5")
+  for (op, idx) in workload_ops(workload, total, pick, 1000, rng):
+      run_op(db, op, IDPAT % idx, ts, payload)
+"""
+
+import time
+import argparse
+import couchdb
+
+WORKLOAD_OPS = ["read", "scan", "insert", "update", "delete"]
+SCAN_LENGTH = 100
+READ_OPS = ["read", "scan"]
+
+
+def parse_workload(spec):
+    """
+    Parse a op=ratio,... workload spec into a {op: ratio} dict.
+    """
+    workload = {}
+    for item in spec.split(","):
+        op, _, ratio = item.strip().partition("=")
+        if op not in WORKLOAD_OPS:
+            raise argparse.ArgumentTypeError("Invalid workload op %r" % op)
+        try:
+            workload[op] = float(ratio)
+        except ValueError:
+            raise argparse.ArgumentTypeError("Invalid ratio for %s: %r" % (op, ratio))
+    if sum(workload.values()) <= 0:
+        raise argparse.ArgumentTypeError("Workload ratios must add up to > 0")
+    return workload
+
+
+def workload_ops(workload, total, pick, count, rng):
+    """
+    Generate a list of (op, doc index) pairs for a mixed workload cycle
+    of `count` ops. Inserts get new doc indices starting at `total`, other
+    ops pick existing docs by calling `pick`.
+    """
+    names = sorted(workload)
+    ops = []
+    insert_idx = total
+    for op in rng.choices(names, [workload[n] for n in names], k=count):
+        if op == "insert":
+            ops.append((op, insert_idx))
+            insert_idx += 1
+        else:
+            ops.append((op, pick()))
+    return ops
+
+
+def run_op(db, op, _id, ts, payload):
+    """
+    Run a single workload operation. Return True if it succeeded. Reads
+    of missing (deleted) docs still count as successful, while HTTP and
+    connection errors count as failed ops.
+    """
+    try:
+        if op == "read":
+            db.get(_id)
+        elif op == "scan":
+            rows = db.view(
+                "_all_docs", startkey=_id, limit=SCAN_LENGTH, include_docs=True
+            )
+            list(rows)
+        elif op == "insert":
+            doc = dict(_id=_id, ts=ts, ts_ms=int(time.time() * 1000))
+            doc["data"] = payload.data(_id)
+            db.save(doc)
+        elif op == "update":
+            doc = dict(_id=_id, ts=ts, ts_ms=int(time.time() * 1000))
+            doc["data"] = payload.data(_id)
+            current = db.get(_id)
+            if current is not None:
+                doc["_rev"] = current["_rev"]
+            db.save(doc)
+        elif op == "delete":
+            current = db.get(_id)
+            if current is not None:
+                db.delete(current)
+    except (couchdb.http.HTTPError, OSError):
+        return False
+    return True
+
+
+def format_workload(workload):
+    return ",".join("%s=%g" % (op, workload[op]) for op in sorted(workload))
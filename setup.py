@@ -14,6 +14,7 @@ setup(
             "couchdyno-setup=couchdyno.couchdyno:setup",
             "couchdyno-execute=couchdyno.couchdyno:execute",
             "rep=couchdyno.rep:_interactive",
+            "couchdyno-server=couchdyno.server:main",
         ]
     },
 )
@@ -0,0 +1,35 @@
+import random
+from couchdyno import couchdyno
+from couchdyno.couchdyno import IDPAT
+
+
+def test_blind_gen():
+    total, writes = 17, 0
+    counts = [0] * total
+    rng = random.Random(42)
+    for _ in range(50):
+        updates = rng.randint(1, 40)
+        for interval in couchdyno._intervals(writes % total, updates, total):
+            for idx in interval:
+                gen = couchdyno._blind_gen(writes, total, IDPAT % idx)
+                assert gen == counts[idx] + 1
+        for interval in couchdyno._intervals(writes % total, updates, total):
+            for idx in interval:
+                counts[idx] += 1
+        writes += min(updates, total)
+
+
+def test_blind_revisions():
+    _id = IDPAT % 3
+    revid = couchdyno._revid
+    assert couchdyno._blind_revisions(_id, 1) == {
+        "start": 1,
+        "ids": [revid(_id, 1)],
+    }
+    revs = couchdyno._blind_revisions(_id, 5)
+    assert revs["ids"] == [revid(_id, 5), revid(_id, 4)]
+    revs = couchdyno._blind_revisions(_id, 5, since=2)
+    assert revs["ids"] == [revid(_id, g) for g in (5, 4, 3, 2)]
+    revs = couchdyno._blind_revisions(_id, 5000, since=1)
+    assert len(revs["ids"]) == couchdyno.BLIND_REVS_MAX
+    assert revs["ids"][-1] == revid(_id, 5000 - couchdyno.BLIND_REVS_MAX + 1)
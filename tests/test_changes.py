@@ -0,0 +1,37 @@
+import pytest
+import couchdb
+from couchdyno import server
+from couchdyno.changes import ChangesConsumers, CHANGES_FEEDS
+from couchdyno.util import seq_num
+
+
+@pytest.fixture(scope="module")
+def srv():
+    with server.running() as url:
+        yield couchdb.Server(url)
+
+
+@pytest.fixture
+def db(srv):
+    name = "couchdyno_changes_test_db"
+    if name in srv:
+        del srv[name]
+    yield srv.create(name)
+    del srv[name]
+
+
+@pytest.mark.parametrize("feed", CHANGES_FEEDS)
+def test_consumers_catch_up(db, feed):
+    db.save({"_id": "before"})
+    assert ChangesConsumers.start(db, 0, feed) is None
+    consumers = ChangesConsumers.start(db, 2, feed)
+    for i in range(0, 3000, 500):
+        db.update([{"_id": "d%04d" % j, "ts_ms": 1} for j in range(i, i + 500)])
+    db.save({"_id": "other"})
+    seq = seq_num(db.info()["update_seq"])
+    latencies, received, errors, behind = consumers.collect(seq)
+    assert (received, errors, behind) == (2 * 3001, 0, 0)
+    assert latencies.count == 2 * 3000
+    # Updates never written are reported as missing after the grace period
+    latencies, received, errors, behind = consumers.collect(seq + 10, grace=0.2)
+    assert (received, behind) == (0, 10)
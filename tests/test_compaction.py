@@ -0,0 +1,57 @@
+import pytest
+import couchdb
+from couchdyno import server
+from couchdyno.compaction import Compactor
+from couchdyno.util import db_sizes, fragmentation_pct
+
+
+@pytest.fixture(scope="module")
+def srv():
+    with server.running() as url:
+        yield couchdb.Server(url)
+
+
+@pytest.fixture
+def db(srv):
+    name = "couchdyno_compaction_test_db"
+    if name in srv:
+        del srv[name]
+    db = srv.create(name)
+    db.update([{"_id": "d%02d" % i, "data": "x" * 100} for i in range(10)])
+    yield db
+    del srv[name]
+
+
+def _rewrite(db):
+    docs = [r.doc for r in db.view("_all_docs", include_docs=True)]
+    db.update(docs)
+
+
+def test_compact_every(db):
+    assert Compactor.open(db, 0, 0, True) is None
+    compactor = Compactor.open(db, 2, 0, True)
+    metadoc = {"cycles": 0}
+    assert compactor.start(metadoc) is None
+    assert compactor.collect() is None
+    metadoc["cycles"] = 1
+    assert compactor.start(metadoc) == "every 2 cycles"
+    assert metadoc["compacted_cycle"] == 2
+    res = compactor.collect()
+    assert res["reason"] == "every 2 cycles"
+    assert res["writes"] == 0 and res["views_reclaimed"] == 0
+    metadoc["cycles"] = 2
+    assert compactor.start(metadoc) is None
+
+
+def test_compact_fragmentation(db):
+    compactor = Compactor.open(db, 0, 40, True)
+    assert compactor.start({}) is None
+    _rewrite(db)
+    file_bytes = db_sizes(db)["file_bytes"]
+    assert fragmentation_pct(db_sizes(db)) == pytest.approx(50, abs=1)
+    assert compactor.start({}) == "fragmentation 50.0%"
+    res = compactor.collect()
+    assert res["frag"] == pytest.approx(50, abs=1)
+    assert res["reclaimed"] == file_bytes // 2
+    assert fragmentation_pct(db_sizes(db)) == 0.0
+    assert compactor.start({}) is None
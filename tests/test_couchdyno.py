@@ -0,0 +1,274 @@
+import sys
+import random
+import socket
+import struct
+import threading
+import pytest
+import couchdb
+from couchdyno import server
+from couchdyno import couchdyno
+from couchdyno.couchdyno import IDPAT
+from couchdyno.payload import Payload, Attachments
+
+
+DBNAME = "couchdyno_test_db"
+
+
+@pytest.fixture(scope="module")
+def srv():
+    with server.running() as url:
+        yield couchdb.Server(url)
+
+
+@pytest.fixture
+def dburl(srv):
+    if DBNAME in srv:
+        del srv[DBNAME]
+    yield srv.resource.url + "/" + DBNAME
+    if DBNAME in srv:
+        del srv[DBNAME]
+
+
+def _run(monkeypatch, endpoint, *args):
+    monkeypatch.setattr(sys, "argv", [endpoint.__name__] + [str(a) for a in args])
+    with pytest.raises(SystemExit) as exc:
+        endpoint()
+    return exc.value.code
+
+
+def _setup(monkeypatch, dburl, *args):
+    return _run(monkeypatch, couchdyno.setup, dburl, *args)
+
+
+def _execute(monkeypatch, dburl, *args):
+    return _run(monkeypatch, couchdyno.execute, dburl, *args)
+
+
+def _docs(srv):
+    db = srv[DBNAME]
+    rows = db.view("_all_docs", startkey="cdyno_", endkey="cdyno_\ufff0")
+    return {r.id: int(r.value["rev"].split("-")[0]) for r in rows}
+
+
+def _metadoc(srv):
+    return couchdyno.MetaDoc().load(srv[DBNAME])
+
+
+def test_setup_and_execute(monkeypatch, srv, dburl):
+    assert _setup(monkeypatch, dburl, "-t", 100, "-s", 100, "-u", 80, "-w") == 0
+    assert _docs(srv) == {couchdyno.IDPAT % i: 1 for i in range(100)}
+    assert _metadoc(srv)["start"] == 0
+    assert _execute(monkeypatch, dburl) == 0
+    assert _metadoc(srv)["start"] == 80
+    # Second run wraps around: docs 80..99 and 0..59
+    assert _execute(monkeypatch, dburl) == 0
+    metadoc = _metadoc(srv)
+    assert metadoc["start"] == 60
+    assert metadoc["writes"] == 260
+    docs = _docs(srv)
+    gens = [docs[couchdyno.IDPAT % i] for i in (0, 59, 60, 79, 80, 99)]
+    assert gens == [3, 3, 2, 2, 2, 2]
+    assert metadoc["cycles"] == 3
+    assert len(metadoc.history(srv[DBNAME])) == 3
+
+
+def test_setup_existing_db(monkeypatch, srv, dburl):
+    assert _setup(monkeypatch, dburl, "-t", 10) == 0
+    assert _setup(monkeypatch, dburl, "-t", 10) == 1
+    assert _setup(monkeypatch, dburl, "-t", 20, "-f") == 0
+    assert _metadoc(srv)["total"] == 20
+
+
+def test_execute_missing_db(monkeypatch, dburl):
+    assert _execute(monkeypatch, dburl) == 3
+
+
+def test_execute_processes(monkeypatch, capsys, srv, dburl):
+    assert _setup(monkeypatch, dburl, "-t", 50, "-u", 40, "-w") == 0
+    capsys.readouterr()
+    assert _execute(monkeypatch, dburl, "-p", 3, "--concurrency", 2) == 0
+    assert "WARNING: progress isn't saved" in capsys.readouterr().out
+    assert _execute(monkeypatch, dburl, "-p", 3, "--checkpoint-every", 0) == 0
+    assert "WARNING" not in capsys.readouterr().out
+    docs = _docs(srv)
+    assert sorted(docs.values()) == [2] * 20 + [3] * 30
+    assert _metadoc(srv)["start"] == 30
+
+
+def test_execute_blind_writes(monkeypatch, srv, dburl):
+    assert _setup(monkeypatch, dburl, "-t", 30, "-u", 20, "-b", "-w") == 0
+    assert _execute(monkeypatch, dburl) == 0
+    assert _execute(monkeypatch, dburl) == 0
+    docs = _docs(srv)
+    assert sorted(docs.values()) == [2] * 20 + [3] * 10
+    db = srv[DBNAME]
+    assert not any("_conflicts" in db.get(_id, conflicts=True) for _id in docs)
+
+
+def test_execute_rev_cache(monkeypatch, tmp_path, srv, dburl):
+    revs = str(tmp_path / "revs")
+    assert _setup(monkeypatch, dburl, "-t", 40, "-u", 40, "-w", "-r", revs) == 0
+    assert _execute(monkeypatch, dburl, "-r", revs) == 0
+    assert _execute(monkeypatch, dburl, "-r", revs) == 0
+    assert set(_docs(srv).values()) == {3}
+
+
+def test_execute_workload(monkeypatch, srv, dburl):
+    workload = "read=40,update=40,insert=20"
+    assert _setup(monkeypatch, dburl, "-t", 20, "-u", 50, "-m", workload, "-w") == 0
+    assert _execute(monkeypatch, dburl) == 0
+    metadoc = _metadoc(srv)
+    assert metadoc["last_errors"] == 0
+    assert len(_docs(srv)) == metadoc["total"]
+    assert metadoc["total"] > 20
+
+
+def _pipe(src, dst):
+    try:
+        while True:
+            data = src.recv(65536)
+            if not data:
+                break
+            dst.sendall(data)
+    except OSError:
+        pass
+    finally:
+        for sock in (src, dst):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+def _resetting_proxy(url, after):
+    """
+    Proxy to url which resets the first connection after receiving `after`
+    bytes, and forwards the others.
+    """
+    upstream = ("127.0.0.1", int(url.rsplit(":", 1)[1]))
+    lsock = socket.create_server(("127.0.0.1", 0))
+
+    def serve():
+        cli, _ = lsock.accept()
+        got = 0
+        while got < after:
+            got += len(cli.recv(65536))
+        cli.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        cli.close()
+        while True:
+            cli, _ = lsock.accept()
+            up = socket.create_connection(upstream)
+            threading.Thread(target=_pipe, args=(cli, up), daemon=True).start()
+            threading.Thread(target=_pipe, args=(up, cli), daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return "http://127.0.0.1:%d" % lsock.getsockname()[1]
+
+
+def test_attachment_retry(srv, dburl):
+    db = srv.create(DBNAME)
+    rev = db.save({"_id": "x"})[1]
+    # Larger than socket buffers, so the reset interrupts sending the body
+    payload = Payload(7900000, seed=1)
+    attachments = Attachments(100, payload)
+    pdb = couchdb.Database(_resetting_proxy(srv.resource.url, 100000) + "/" + DBNAME)
+    _, size = attachments.put(pdb, "x", rev)
+    assert size == 7900000
+    assert db.get_attachment("x", "data").read() == payload.content("x")
+
+
+def test_execute_workload_options(monkeypatch, srv, dburl):
+    workload = "read=50,update=50"
+    assert _setup(monkeypatch, dburl, "-m", workload, "--attachment-pct", 10) == 1
+    assert _setup(monkeypatch, dburl, "-t", 40, "-u", 40, "-m", workload, "-w") == 0
+    assert _execute(monkeypatch, dburl, "-p", 2) == 1
+    assert _execute(monkeypatch, dburl, "-r", "revs") == 1
+    assert _execute(monkeypatch, dburl) == 0
+    metadoc = _metadoc(srv)
+    history = metadoc.history(srv[DBNAME])
+    ops = history[-1][5]["ops"]
+    assert history[-1][3] == metadoc["last_updates"] == ops["update"][0]
+    assert ops["read"][0] + ops["update"][0] == 40
+    assert metadoc["writes"] == 40 + 40
+
+
+def test_execute_resume_random(monkeypatch, srv, dburl):
+    args = ["-t", 100, "-u", 60, "--distribution", "uniform", "-w"]
+    assert _setup(monkeypatch, dburl, *args) == 0
+    monkeypatch.setattr(couchdyno, "_batch_size", lambda docsize: 5)
+    post_bulk_docs = couchdyno._post_bulk_docs
+    calls = []
+
+    def crashing(*args, **kw):
+        calls.append(1)
+        if len(calls) > 4:
+            raise RuntimeError("crash")
+        return post_bulk_docs(*args, **kw)
+
+    monkeypatch.setattr(couchdyno, "_post_bulk_docs", crashing)
+    with pytest.raises(RuntimeError):
+        _execute(monkeypatch, dburl, "--checkpoint-every", 1)
+    monkeypatch.setattr(couchdyno, "_post_bulk_docs", post_bulk_docs)
+    metadoc = _metadoc(srv)
+    key_seed = srv[DBNAME]["_local/couchdyno_progress"]["key_seed"]
+    keys = couchdyno._Keys(metadoc, 60, random.Random(key_seed))
+    keys = sorted(idx for chunk in keys for idx in chunk)
+    assert _execute(monkeypatch, dburl, "--checkpoint-every", 1, "--resume") == 0
+    # The resumed cycle updated the rest of the same docs
+    docs = _docs(srv)
+    assert sorted(_id for _id in docs if docs[_id] == 2) == [IDPAT % i for i in keys]
+    assert _metadoc(srv)["last_updates"] == len(keys)
+
+
+def test_execute_conflicts_max(monkeypatch, capsys, tmp_path, srv, dburl):
+    revs = str(tmp_path / "revs")
+    assert _setup(monkeypatch, dburl, "-t", 20, "-u", 20, "-w", "-r", revs) == 0
+    cache = couchdyno._RevCache.open(revs)
+    for i in range(20):
+        cache.put(IDPAT % i, "1-%032x" % 0)
+    monkeypatch.setattr(couchdyno, "CONFLICTS_MAX", 5)
+    capsys.readouterr()
+    assert _execute(monkeypatch, dburl, "-r", revs) == 0
+    assert "(!)conflicts not retried: 15" in capsys.readouterr().out
+    assert _metadoc(srv)["last_errors"] == 15
+
+
+@pytest.fixture
+def tenants(srv):
+    names = ["couchdyno_test_t%s" % s for s in ["a", "b", "10"]]
+    for name in names:
+        if name in srv:
+            del srv[name]
+        srv.create(name)
+    yield names
+    for name in names:
+        del srv[name]
+
+
+def test_get_dbs(tmp_path, srv, tenants):
+    def names(pattern, dbs_file=None):
+        dbs = couchdyno._get_dbs(srv.resource.url + "/" + pattern, dbs_file)
+        return None if dbs is None else [db.name for db in dbs]
+
+    assert names("couchdyno_test_t*") == sorted(tenants)
+    assert names("couchdyno_test_t?") == tenants[:2]
+    assert names("couchdyno_test_t[b1]*") == [tenants[2], tenants[1]]
+    assert names(tenants[0]) is None
+    dbs_file = tmp_path / "dbs"
+    dbs_file.write_text("%s\n\n%s\n" % (tenants[1], tenants[0]))
+    assert names("", str(dbs_file)) == [tenants[1], tenants[0]]
+
+
+def test_execute_dbs(monkeypatch, capsys, srv, tenants):
+    for name in tenants[:2]:
+        dburl = srv.resource.url + "/" + name
+        assert _setup(monkeypatch, dburl, "-t", 50, "-u", 50, "-w", "-f") == 0
+    capsys.readouterr()
+    pattern = srv.resource.url + "/couchdyno_test_t?"
+    assert _execute(monkeypatch, pattern, "-n", 2, "--db-concurrency", 2) == 0
+    out = capsys.readouterr().out
+    assert "dbs: 2" in out
+    assert "all_dbs:\n  dbs: 2\n  updates: 100\n" in out
+    for name in tenants[:2]:
+        assert "\n%s: after:\n%s:   updates: 50\n" % (name, name) in out
+        assert couchdyno.MetaDoc().load(srv[name])["writes"] == 100
@@ -0,0 +1,349 @@
+import io
+import json
+import math
+import pickle
+import random
+import threading
+import collections
+import pytest
+import couchdb
+from couchdyno import couchdyno
+from couchdyno.couchdyno import IDPAT
+from couchdyno.payload import Payload
+from couchdyno.util import db_sizes, fragmentation_pct
+
+
+def _flat(intervals):
+    return [i for interval in intervals for i in interval]
+
+
+@pytest.mark.parametrize(
+    "start,updates,total", [(0, 10, 100), (95, 10, 100), (30, 100, 100), (5, 7, 7)]
+)
+def test_intervals_wrap_around(start, updates, total):
+    idxs = _flat(couchdyno._intervals(start, updates, total))
+    assert idxs == [(start + i) % total for i in range(min(updates, total))]
+
+
+@pytest.mark.parametrize("n", [1, 2, 3, 7, 16, 100])
+@pytest.mark.parametrize("start,updates,total", [(0, 10, 100), (95, 10, 100)])
+def test_shards_match_single_process(n, start, updates, total):
+    intervals = couchdyno._intervals(start, updates, total)
+    shards = couchdyno._shards(intervals, n)
+    assert 0 < len(shards) <= n
+    assert _flat(_flat(shards)) == _flat(intervals)
+    per = -(-updates // n)
+    assert [len(_flat(shard)) for shard in shards[:-1]] == [per] * (len(shards) - 1)
+
+
+def test_shards_empty():
+    assert couchdyno._shards([range(0, 0), range(0, 0)], 4) == []
+
+
+class _Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_rate_limiter_pacing(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(couchdyno.time, "time", clock.time)
+    monkeypatch.setattr(couchdyno.time, "sleep", clock.sleep)
+    assert couchdyno._RateLimiter.open(0) is None
+    limiter = couchdyno._RateLimiter.open(100)
+    assert [limiter.acquire(10) for _ in range(3)] == [1000.0, 1000.1, 1000.2]
+    assert clock.now == pytest.approx(1000.2)
+    # A slow request doesn't move the schedule, the backlog is sent at once
+    clock.now += 1
+    assert limiter.acquire(10) == pytest.approx(1000.3)
+    assert clock.now == pytest.approx(1001.2)
+    couchdyno._sleep(limiter, 5)
+    assert limiter.acquire(10) == pytest.approx(1005.4)
+    # Workers share the rate and carry the schedule over after unpickling
+    shard = pickle.loads(pickle.dumps(limiter.split(4)))
+    assert shard.rate == 25
+    assert shard.acquire(10) == pytest.approx(1005.5)
+    assert shard.acquire(10) == pytest.approx(1005.9)
+
+
+class _BulkDb(object):
+    """
+    Records _bulk_docs request bodies and answers with a conflict for
+    docs whose revision starts with "0-".
+    """
+
+    def __init__(self):
+        self.resource = self
+        self.bodies = []
+
+    def post(self, path, body, headers):
+        assert path == "_bulk_docs"
+        docs = json.loads(body)["docs"]
+        self.bodies.append(docs)
+        res = []
+        for doc in docs:
+            if doc.get("_rev", "").startswith("0-"):
+                res.append({"id": doc["_id"], "error": "conflict"})
+            else:
+                res.append({"id": doc["_id"], "rev": "1-x"})
+        return 201, {}, io.BytesIO(json.dumps(res).encode("utf-8"))
+
+
+@pytest.mark.parametrize("shape", ["flat", "nested"])
+def test_bulk_update_body(shape):
+    db = _BulkDb()
+    payload = Payload(50, seed=1, shape=shape, fields=10)
+    docids = [IDPAT % i for i in range(3)]
+    docrevs = {docids[0]: "0-a", docids[2]: "2-b"}
+    newrevs = {}
+    ok, conflicts, nbytes = couchdyno._bulk_update(
+        db, docrevs, payload, 123, docids, newrevs=newrevs
+    )
+    assert (ok, conflicts) == (2, [docids[0]])
+    assert newrevs == {docids[1]: "1-x", docids[2]: "1-x"}
+    docs = db.bodies[0]
+    assert [d["_id"] for d in docs] == docids
+    assert [d.get("_rev") for d in docs] == ["0-a", None, "2-b"]
+    assert [d["data"] for d in docs] == [payload.data(_id) for _id in docids]
+    assert all(d["ts"] == 123 and d["ts_ms"] > 0 for d in docs)
+    assert nbytes == len(json.dumps({"docs": docs}, separators=(",", ":")))
+
+
+@pytest.mark.parametrize("distribution", ["uniform", "zipf", "hotspot"])
+def test_keys_chunks(monkeypatch, distribution):
+    monkeypatch.setattr(couchdyno, "REVS_CHUNK", 100)
+    metadoc = {"total": 1000, "distribution": distribution}
+    keys = couchdyno._Keys(metadoc, 950, random.Random(1))
+    chunks = list(keys)
+    assert len(chunks) == 10
+    flat = _flat(chunks)
+    assert all(chunk == sorted(chunk) for chunk in chunks)
+    assert len(set(flat)) == len(flat) == keys.count
+    assert all(0 <= idx < 1000 for idx in flat)
+    # Skipped indices are the same prefix the full run picked first
+    keys = couchdyno._Keys(metadoc, 950, random.Random(1), skip=150)
+    assert _flat(keys) == flat[150:]
+    assert keys.count == len(flat)
+
+
+def test_worker_pool_reuse():
+    pool = couchdyno._WorkerPool(2)
+    dbs = [couchdb.Database("http://127.0.0.1:1/db%d" % i) for i in range(2)]
+
+    def fun(wdb, batch):
+        return batch, threading.get_ident(), wdb.resource.url, wdb.resource.session
+
+    res = [list(pool.map(db, fun, range(20))) for db in dbs + dbs]
+    pool.close()
+    sessions = {}
+    for (i, results) in enumerate(res):
+        assert [r[0] for r in results] == list(range(20))
+        for (_, thread, url, session) in results:
+            assert url == dbs[i % 2].resource.url
+            assert sessions.setdefault(thread, session) is session
+    assert len(sessions) <= 2
+
+
+@pytest.mark.parametrize("per_doc", [0.001, 0.0001])
+def test_batch_sizer_converges(per_doc):
+    sizer = couchdyno._BatchSizer(1000, target_latency=0.1)
+    for _ in range(40):
+        n = sizer.next()
+        sizer.observe(n, n * per_doc, n * 1100)
+    assert abs(sizer.next() - min(0.1 / per_doc, sizer.max_size)) <= 2
+    assert sizer.stats()[2] <= sizer.max_size
+
+
+def test_batch_sizer_steps():
+    sizer = couchdyno._BatchSizer(1000, target_latency=1.0)
+    n = sizer.next()
+    sizer.observe(n, 100.0, n * 1100)
+    assert sizer.next() >= n // 2
+    n = sizer.next()
+    sizer.observe(n, 0.001, n * 1100)
+    assert sizer.next() <= 2 * n
+
+
+def test_batch_sizer_request_size():
+    sizer = couchdyno._BatchSizer(1000, max_request_size=100000)
+    assert sizer.next() == 100000 // sizer.docbytes
+    sizer.observe(10, 0.1, 10 * 10000)
+    assert sizer.next() == 10
+    fixed = couchdyno._BatchSizer(1000)
+    fixed.observe(fixed.next(), 1.0, fixed.next() * 1100)
+    assert fixed.next() == couchdyno._batch_size(1000)
+
+
+@pytest.mark.parametrize("n,skew", [(50, 0.99), (50, 1.0), (1000, 1.5), (10, 0.5)])
+def test_zipf_frequencies(n, skew):
+    rng = random.Random(42)
+    zipf = couchdyno._Zipf(n, skew)
+    samples = 100000
+    counts = collections.Counter(zipf.sample(rng) for _ in range(samples))
+    assert min(counts) >= 1 and max(counts) <= n
+    norm = sum(1.0 / k**skew for k in range(1, n + 1))
+    for k in range(1, 6):
+        expected = samples / k**skew / norm
+        assert abs(counts[k] - expected) < 5 * math.sqrt(expected) + 10
+
+
+def test_picker_hotspot():
+    metadoc = {
+        "total": 1000,
+        "distribution": "hotspot",
+        "hot_ops_pct": 80,
+        "hot_keys_pct": 10,
+    }
+    pick = couchdyno._picker(metadoc, random.Random(1))
+    idxs = [pick() for _ in range(20000)]
+    assert 0 <= min(idxs) and max(idxs) < 1000
+    hot = sum(1 for idx in idxs if idx < 100)
+    assert abs(hot / 20000.0 - 0.8) < 0.02
+
+
+@pytest.mark.parametrize("distribution", ["sequential", "uniform", "zipf"])
+def test_picker_range(distribution):
+    metadoc = {"total": 100, "distribution": distribution}
+    pick = couchdyno._picker(metadoc, random.Random(1))
+    idxs = collections.Counter(pick() for _ in range(20000))
+    assert 0 <= min(idxs) and max(idxs) < 100
+    if distribution == "zipf":
+        assert idxs.most_common(1)[0][0] == 0
+    else:
+        assert len(idxs) == 100 and max(idxs.values()) < 2 * min(idxs.values())
+
+
+def test_picker_unknown():
+    with pytest.raises(ValueError):
+        couchdyno._picker({"total": 10, "distribution": "bogus"}, random.Random())
+
+
+def _sizes(file_mb, active_mb, deleted=0):
+    return {
+        "file_bytes": int(file_mb * 1e6),
+        "active_bytes": int(active_mb * 1e6),
+        "external_bytes": int(active_mb * 1e6 * 0.8),
+        "doc_del_count": deleted,
+    }
+
+
+def test_info_db_sizes(capsys):
+    history = [
+        [0, 0, 0, 10, 0, {"db": _sizes(10, 5)}],
+        [1800, 0, 0, 10, 0, {}],
+        [3600, 0, 0, 10, 0, {"db": {"file_bytes": 1}}],
+        [3600, 0, 0, 10, 0, {"db": _sizes(20, 8, 2)}],
+        [7200, 0, 0, 10, 0, {"db": _sizes(30, 9, 5)}],
+    ]
+    couchdyno._info_db_sizes(history)
+    assert capsys.readouterr().out.splitlines() == [
+        "db_size_trend (MB):",
+        "  1970-01-01T00:00:00 runs: 1 file: 10.0 active: 5.0 external: 4.0"
+        " frag (%): 50.0",
+        "    growth file/active (MB/hour): 0.0 / 0.0 deleted docs: 0",
+        "  1970-01-01T01:00:00 runs: 1 file: 20.0 active: 8.0 external: 6.4"
+        " frag (%): 60.0",
+        "    growth file/active (MB/hour): 10.0 / 3.0 deleted docs: 2",
+        "  1970-01-01T02:00:00 runs: 1 file: 30.0 active: 9.0 external: 7.2"
+        " frag (%): 70.0",
+        "    growth file/active (MB/hour): 10.0 / 1.0 deleted docs: 5",
+        "  overall growth file/active (MB/hour): 10.0 / 2.0",
+    ]
+
+
+def test_info_db_sizes_chunks(capsys, monkeypatch):
+    monkeypatch.setattr(couchdyno, "TREND_ROWS", 2)
+    history = [[3600 * i, 60, 0, 10, 0, {"db": _sizes(10 + i, 5)}] for i in range(5)]
+    couchdyno._info_db_sizes(history)
+    lines = capsys.readouterr().out.splitlines()
+    assert [line.split(" file:")[0] for line in lines if "runs:" in line] == [
+        "  1970-01-01T02:00:00 runs: 3",
+        "  1970-01-01T04:00:00 runs: 2",
+    ]
+    assert lines[-1] == "  overall growth file/active (MB/hour): 1.0 / 0.0"
+
+
+def test_info_db_sizes_without_sizes(capsys):
+    couchdyno._info_db_sizes([[0, 0, 0, 10, 0], [1, 0, 0, 10, 0, {"lat": []}]])
+    assert capsys.readouterr().out == ""
+
+
+class _InfoDb(object):
+    def __init__(self, info):
+        self._info = info
+
+    def info(self):
+        return self._info
+
+
+def test_db_sizes():
+    info = {
+        "sizes": {"file": 300, "active": 200, "external": 150},
+        "doc_count": 10,
+        "doc_del_count": 1,
+        "update_seq": "12-g1AAAA",
+    }
+    assert db_sizes(_InfoDb(info)) == {
+        "file_bytes": 300,
+        "active_bytes": 200,
+        "external_bytes": 150,
+        "doc_count": 10,
+        "doc_del_count": 1,
+        "update_seq": 12,
+    }
+    old = {"disk_size": 300, "data_size": 100, "doc_count": 10, "update_seq": 12}
+    sizes = db_sizes(_InfoDb(old))
+    assert sizes == {
+        "file_bytes": 300,
+        "active_bytes": 100,
+        "doc_count": 10,
+        "update_seq": 12,
+    }
+    assert fragmentation_pct(sizes) == pytest.approx(66.667, abs=0.001)
+    assert fragmentation_pct({"file_bytes": 0, "active_bytes": 0}) == 0.0
+
+
+class _FakeView(object):
+    def __init__(self, name, rows):
+        self.name = name
+        self.rows = rows
+        self.opts = None
+
+    def __call__(self, db, **opts):
+        self.opts = opts
+        return [couchdb.client.Row(key=k, value=v) for (k, v) in self.rows]
+
+
+def test_info_days(monkeypatch, capsys):
+    days = _FakeView("days", [("2024-01-01", 3), ("2024-01-03", 7)])
+    updates = _FakeView("updates", [("2024-01-02", 100), ("2024-01-03", 50)])
+    synced, waited = [], []
+    monkeypatch.setattr(couchdyno, "_days_view", lambda: days)
+    monkeypatch.setattr(couchdyno, "_updates_view", lambda: updates)
+    monkeypatch.setattr(
+        couchdyno.ViewDefinition, "sync_many", lambda db, views: synced.extend(views)
+    )
+    monkeypatch.setattr(couchdyno, "_wait_for_view", lambda db, v: waited.append(v))
+    couchdyno._info_days(None)
+    assert synced == waited == [days, updates]
+    assert days.opts == updates.opts == {"group": True}
+    assert capsys.readouterr().out.splitlines()[2:] == [
+        " -> 2024-01-01 docs: 3 updates: 0",
+        " -> 2024-01-02 docs: 0 updates: 100",
+        " -> 2024-01-03 docs: 7 updates: 50",
+    ]
+
+
+def test_census_views():
+    days, updates = couchdyno._days_view(), couchdyno._updates_view()
+    assert days.design == updates.design == "couchdyno_census"
+    assert (days.reduce_fun, updates.reduce_fun) == ("_count", "_sum")
+    assert '"%s"' % IDPAT.split("%")[0] in days.map_fun
+    assert '"%s"' % couchdyno.HISTORY_PREFIX in updates.map_fun
+    assert "doc.updates" in updates.map_fun
@@ -0,0 +1,37 @@
+import pickle
+import random
+import pytest
+from couchdyno.histogram import Histogram
+
+
+def test_histogram_percentiles():
+    hist = Histogram()
+    assert hist.stats() == [0.0, 0.0, 0.0, 0.0]
+    values = [i / 1e4 for i in range(1, 10001)]
+    random.Random(1).shuffle(values)
+    for v in values:
+        hist.record(v)
+    for pct in (1, 50, 90, 99, 100):
+        assert hist.percentile(pct) == pytest.approx(pct / 100.0, rel=0.07)
+    assert hist.stats()[-1] == 1.0
+    assert hist.count == len(values)
+
+
+def test_histogram_small_values():
+    hist = Histogram()
+    for us in (3, 3, 7, 15):
+        hist.record(us / 1e6)
+    assert hist.percentile(50) == 3e-6
+    assert hist.percentile(75) == 7e-6
+    assert hist.percentile(100) == 15e-6
+
+
+def test_histogram_merge():
+    h1, h2, h = Histogram(), Histogram(), Histogram()
+    for i in range(1, 1000):
+        (h1 if i % 2 else h2).record(i / 1e3)
+        h.record(i / 1e3)
+    h1 = pickle.loads(pickle.dumps(h1))
+    h1.merge(h2)
+    assert h1.stats() == h.stats()
+    assert h1.buckets([0.1, 0.5]) == h.buckets([0.1, 0.5])
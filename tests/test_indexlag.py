@@ -0,0 +1,73 @@
+import time
+import threading
+from couchdyno import indexlag
+from couchdyno.indexlag import IndexLag
+
+
+class _Row(object):
+    def __init__(self, key):
+        self.key = key
+
+
+class _Rows(list):
+    update_seq = None
+
+
+class _LagDb(object):
+    """
+    Db with a ts_ms view, a Mango index and an extra view, which only
+    see docs once they are indexed.
+    """
+
+    def __init__(self, seq):
+        self.resource = self
+        self.seq = seq
+        self.indexed = []
+        self.indexed_seq = 0
+
+    def index(self, ts_ms, seq):
+        self.indexed.append(ts_ms)
+        self.indexed_seq = seq
+
+    def info(self):
+        return {"update_seq": "%d-g1AAAA" % self.seq}
+
+    def view(self, name, **options):
+        if name == "%s/ts_ms" % indexlag.LAG_DDOC:
+            assert options["descending"] and options["limit"] == 1
+            return _Rows([_Row(k) for k in sorted(self.indexed)[-1:]])
+        rows = _Rows()
+        rows.update_seq = "%d-g1AAAA" % self.indexed_seq
+        return rows
+
+    def post_json(self, path, body):
+        assert path == "_find"
+        ts_ms = body["selector"]["ts_ms"]["$gte"]
+        return 200, {}, {"docs": [{} for v in self.indexed if v >= ts_ms]}
+
+
+def test_index_lag(monkeypatch):
+    tasks = [{"type": "indexer", "changes_done": 1, "total_changes": 2}]
+    monkeypatch.setattr(indexlag, "db_tasks", lambda db, types: tasks)
+    db = _LagDb(seq=10)
+    # The previous cycle ran in the same second
+    t0 = time.time()
+    db.index(int(t0 * 1000) - 1, 5)
+    lag = IndexLag(db, True, ["ddoc/view"], timeout=5)
+    timer = threading.Timer(0.3, db.index, args=(int(t0 * 1000), 10))
+    timer.start()
+    lags, indexer = lag.measure(int(t0 * 1000), t0)
+    timer.join()
+    assert sorted(lags) == ["ddoc/view", "mango", "view"]
+    assert all(0.3 <= v < 2 for v in lags.values())
+    assert indexer[0] >= 1 and indexer[1] == 1
+
+
+def test_index_lag_timeout(monkeypatch):
+    monkeypatch.setattr(indexlag, "db_tasks", lambda db, types: [])
+    db = _LagDb(seq=10)
+    t0 = time.time()
+    db.index(int(t0 * 1000) - 1, 9)
+    lag = IndexLag(db, True, ["ddoc/view"], timeout=0.3)
+    lags, _ = lag.measure(int(t0 * 1000), t0)
+    assert lags == {"view": None, "mango": None, "ddoc/view": None}
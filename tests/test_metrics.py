@@ -0,0 +1,90 @@
+import urllib.error
+import urllib.request
+import pytest
+from couchdyno.metrics import Metrics, OPENMETRICS_CONTENT_TYPE, TEXT_CONTENT_TYPE
+
+
+@pytest.fixture
+def metrics():
+    metrics = Metrics("cdy")
+    metrics.family("updates", "counter", "Documents updated")
+    metrics.family("rate", "gauge", 'Update "rate"\nper second')
+    metrics.family("latency", "histogram", "Latency", bounds=[0.1, 1])
+    metrics.family("unused", "gauge", "Never set")
+    yield metrics
+    metrics.stop()
+
+
+def test_render_text(metrics):
+    metrics.inc("updates", 10, db="db1")
+    metrics.inc("updates", 5, db="db1")
+    metrics.inc("updates", db='d"b\\2')
+    metrics.set("rate", 12.5)
+    metrics.observe("latency", [1, 2, 3], 7.5, db="db1")
+    metrics.observe("latency", [1, 0, 0], 0.05, db="db1")
+    assert metrics.render() == "\n".join(
+        [
+            "# HELP cdy_latency Latency",
+            "# TYPE cdy_latency histogram",
+            'cdy_latency_bucket{db="db1",le="0.1"} 2',
+            'cdy_latency_bucket{db="db1",le="1.0"} 4',
+            'cdy_latency_bucket{db="db1",le="+Inf"} 7',
+            'cdy_latency_count{db="db1"} 7',
+            'cdy_latency_sum{db="db1"} 7.55',
+            '# HELP cdy_rate Update "rate"\\nper second',
+            "# TYPE cdy_rate gauge",
+            "cdy_rate 12.5",
+            "# HELP cdy_updates_total Documents updated",
+            "# TYPE cdy_updates_total counter",
+            'cdy_updates_total{db="d\\"b\\\\2"} 1',
+            'cdy_updates_total{db="db1"} 15',
+            "",
+        ]
+    )
+
+
+def test_render_openmetrics(metrics):
+    metrics.inc("updates", 3, db="db1")
+    assert metrics.render(openmetrics=True) == "\n".join(
+        [
+            "# HELP cdy_updates Documents updated",
+            "# TYPE cdy_updates counter",
+            'cdy_updates_total{db="db1"} 3',
+            "# EOF",
+            "",
+        ]
+    )
+
+
+def test_invalid_updates(metrics):
+    with pytest.raises(ValueError):
+        metrics.family("bad", "summary", "Not supported")
+    with pytest.raises(ValueError):
+        metrics.set("updates", 1)
+    with pytest.raises(ValueError):
+        metrics.observe("latency", [1, 2], 1.0)
+
+
+def test_write(tmp_path, metrics):
+    metrics.set("rate", 1)
+    path = tmp_path / "cdy.prom"
+    metrics.write(str(path))
+    assert path.read_text() == metrics.render()
+    assert [p.name for p in tmp_path.iterdir()] == ["cdy.prom"]
+
+
+def test_serve(metrics):
+    metrics.inc("updates", 2)
+    url = "http://127.0.0.1:%d" % metrics.serve("127.0.0.1")
+    with urllib.request.urlopen(url + "/metrics") as resp:
+        assert resp.headers["Content-Type"] == TEXT_CONTENT_TYPE
+        assert resp.read().decode() == metrics.render()
+    req = urllib.request.Request(
+        url + "/metrics", headers={"Accept": "application/openmetrics-text"}
+    )
+    with urllib.request.urlopen(req) as resp:
+        assert resp.headers["Content-Type"] == OPENMETRICS_CONTENT_TYPE
+        assert resp.read().decode().endswith("# EOF\n")
+    with pytest.raises(urllib.error.HTTPError) as exc:
+        urllib.request.urlopen(url + "/other")
+    assert exc.value.code == 404
@@ -0,0 +1,65 @@
+import zlib
+import json
+import statistics
+import pytest
+from couchdyno.couchdyno import IDPAT
+from couchdyno.payload import Payload, NESTED_GROUP
+
+
+IDS = [IDPAT % i for i in range(200)]
+
+
+def _decoded(payload, _id):
+    parts = []
+    payload.data_parts(parts, _id)
+    return json.loads(b"".join(parts))
+
+
+@pytest.mark.parametrize("shape", ["flat", "nested"])
+@pytest.mark.parametrize("size_dist", ["fixed", "uniform", "lognormal"])
+def test_data_parts_match_data(shape, size_dist):
+    payload = Payload(300, seed=1, shape=shape, size_dist=size_dist, fields=20)
+    for _id in IDS[:20]:
+        assert _decoded(payload, _id) == payload.data(_id)
+
+
+def test_nested_shape():
+    payload = Payload(100, seed=1, shape="nested", fields=20)
+    data = payload.data(IDS[0])
+    assert sorted(data) == ["g0", "g1", "g2"]
+    assert [len(data[g]) for g in ("g0", "g1", "g2")] == [NESTED_GROUP] * 2 + [4]
+    values = [v for group in data.values() for v in group.values()]
+    assert sum(len(v) for v in values) == 100
+    assert max(map(len, values)) - min(map(len, values)) <= 1
+
+
+@pytest.mark.parametrize("size_dist", ["uniform", "lognormal"])
+def test_size_distributions(size_dist):
+    payload = Payload(1000, seed=1, size_dist=size_dist)
+    sizes = [payload.doc_size(IDPAT % i) for i in range(5000)]
+    assert statistics.mean(sizes) == pytest.approx(1000, rel=0.05)
+    assert 1 <= min(sizes) and max(sizes) <= payload.max_size
+    assert len(set(sizes)) > 100
+    assert [len(payload.data(_id)) for _id in IDS] == list(map(payload.doc_size, IDS))
+
+
+def test_entropy():
+    full = Payload(100000, seed=1, spread=0).content(IDS[0])
+    half = Payload(100000, seed=1, spread=0, entropy=0.5).content(IDS[0])
+    assert len(half) == len(full) == 100000
+    assert set(half) <= set(b"abcdefghijklmnopqrstuvwxyz")
+    ratio = len(zlib.compress(half)) / float(len(zlib.compress(full)))
+    assert 0.4 < ratio < 0.65
+
+
+def test_reproducible():
+    p1, p2 = Payload(500, seed=7, cycle=3), Payload(500, seed=7, cycle=3)
+    assert [p1.data(_id) for _id in IDS] == [p2.data(_id) for _id in IDS]
+    other = Payload(500, seed=7, cycle=4)
+    assert [p1.data(_id) for _id in IDS] != [other.data(_id) for _id in IDS]
+    assert Payload(500).data(IDS[0]) != Payload(500).data(IDS[0])
+    content = p1.content(IDS[0])
+    assert content.decode("ascii") == p1.data(IDS[0])
+    assert content.isalpha() and content.islower()
+    # Docs get different slices of the buffer
+    assert len(set(p1.data(_id) for _id in IDS)) == len(IDS)
@@ -0,0 +1,97 @@
+import json
+import pickle
+import threading
+import pytest
+from couchdyno import profiling
+from couchdyno.profiling import PhaseTimers, Profiler, format_phases
+
+
+def test_phase_timers_threads():
+    timers = PhaseTimers()
+
+    def work():
+        for _ in range(10):
+            timers.add("write", 0.5)
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # counters of exited threads are folded when a new thread shows up
+    timers.add("read", 1.0, count=3)
+    assert len(timers.threads) == 1
+    assert timers.totals() == {"write": [40, 20.0], "read": [3, 1.0]}
+
+
+def test_phase_timers_lap_and_merge():
+    timers = PhaseTimers()
+    timers.start()
+    timers.lap("a")
+    timers.lap("a")
+    other = pickle.loads(pickle.dumps(timers))
+    assert other.totals()["a"][0] == 2
+    other.add("b", 2.0)
+    timers.merge(other)
+    totals = timers.totals()
+    assert totals["a"][0] == 4
+    assert totals["b"] == [1, 2.0]
+
+
+def test_profiler_cycles_and_files(tmp_path):
+    prefix = str(tmp_path / "prof")
+    assert Profiler.open(None, "execute") is None
+    profiler = Profiler.open(prefix, "execute")
+    profiler.timers.add("write", 1.0, count=2)
+    phases = profiler.cycle(4.0, updates=10)
+    assert phases == {"write": {"count": 2, "sec": 1.0, "pct": 25.0}}
+    profiler.timers.add("write", 3.0)
+    profiler.timers.add("revs", 0.5)
+    phases = profiler.cycle(4.0)
+    assert phases["write"] == {"count": 1, "sec": 3.0, "pct": 75.0}
+    assert format_phases(phases) == [
+        "write (sec/%/count): 3.000 / 75.0 / 1",
+        "revs (sec/%/count): 0.500 / 12.5 / 1",
+    ]
+    profiler.stop()
+    with open(prefix + ".json") as f:
+        report = json.load(f)
+    assert report["name"] == "execute"
+    assert report["phases"]["write"]["count"] == 3
+    assert [c["dt"] for c in report["cycles"]] == [4.0, 4.0]
+    assert report["cycles"][0]["updates"] == 10
+    with open(prefix + ".folded") as f:
+        lines = sorted(f.read().splitlines())
+    assert lines == ["execute;revs 500000", "execute;write 4000000"]
+
+
+def test_profiler_cprofile(tmp_path):
+    prefix = str(tmp_path / "prof")
+    profiler = Profiler.open(prefix, "setup", cprofile=True)
+    sum(i * i for i in range(100000))
+    profiler.stop()
+    assert (tmp_path / "prof.pstats").exists()
+    with open(prefix + ".cprofile.folded") as f:
+        lines = f.read().splitlines()
+    assert lines
+    for line in lines:
+        stack, usec = line.rsplit(" ", 1)
+        assert stack.startswith("setup;")
+        assert int(usec) > 0
+
+
+def test_cprofile_stacks():
+    a = ("/src/a.py", 1, "a")
+    b = ("/src/b.py", 1, "b")
+    c = ("~", 0, "<built-in method sum>")
+    stats = {
+        a: (1, 1, 1.0, 4.0, {}),
+        b: (2, 2, 1.0, 3.0, {a: (2, 2, 1.0, 3.0), b: (1, 1, 0.0, 1.0)}),
+        c: (1, 1, 2.0, 2.0, {b: (1, 1, 2.0, 2.0)}),
+    }
+    stacks = profiling._cprofile_stacks(stats, "run")
+    assert stacks[("run", "a.py:a")] == pytest.approx(1.0)
+    assert stacks[("run", "a.py:a", "b.py:b")] == pytest.approx(1.0)
+    builtin = ("run", "a.py:a", "b.py:b", "<built-in_method_sum>")
+    assert stacks[builtin] == pytest.approx(2.0)
+    assert len(stacks) == 3
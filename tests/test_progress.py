@@ -0,0 +1,59 @@
+import pytest
+import couchdb
+from couchdyno import server
+from couchdyno import couchdyno
+
+
+@pytest.fixture(scope="module")
+def srv():
+    with server.running() as url:
+        yield couchdb.Server(url)
+
+
+@pytest.fixture
+def db(srv):
+    name = "couchdyno_progress_test_db"
+    if name in srv:
+        del srv[name]
+    yield srv.create(name)
+    del srv[name]
+
+
+def _flat(intervals):
+    return [i for interval in intervals for i in interval]
+
+
+def test_skip():
+    intervals = [range(95, 100), range(0, 5)]
+    assert couchdyno._skip(intervals, 0) == intervals
+    assert couchdyno._skip(intervals, 3) == [range(98, 100), range(0, 5)]
+    assert couchdyno._skip(intervals, 5) == [range(0, 5)]
+    assert couchdyno._skip(intervals, 7) == [range(2, 5)]
+    assert couchdyno._skip(intervals, 10) == []
+
+
+def test_skip_resumes_cycle():
+    intervals = couchdyno._intervals(90, 20, 100)
+    for done in range(21):
+        assert _flat(couchdyno._skip(intervals, done)) == _flat(intervals)[done:]
+
+
+def test_progress_round_trip(db):
+    assert couchdyno._Progress.open(db, 0) is None
+    metadoc = {"writes": 100}
+    progress = couchdyno._Progress.open(db, 2)
+    assert progress.saved(metadoc, False) is None
+    progress.begin(metadoc, False, 10, 50, 1234, key_seed="abc")
+    for _ in range(3):
+        progress.ack(10, 9)
+    # Only every second batch is saved
+    saved = couchdyno._Progress(db, 2).saved(metadoc, False)
+    assert (saved["start"], saved["updates"], saved["ts"]) == (10, 50, 1234)
+    assert (saved["done"], saved["ok"], saved["key_seed"]) == (20, 18, "abc")
+    assert couchdyno._Progress(db, 2).saved(metadoc, True) is None
+    assert couchdyno._Progress(db, 2).saved({"writes": 150}, False) is None
+    # A resumed cycle carries on counting from the saved progress
+    progress = couchdyno._Progress(db, 1)
+    progress.begin(metadoc, False, 10, 50, 1234, 20, 18, "abc")
+    progress.ack(10, 10)
+    assert couchdyno._Progress(db, 1).saved(metadoc, False)["done"] == 30
@@ -0,0 +1,27 @@
+import pickle
+from couchdyno import couchdyno
+from couchdyno.couchdyno import IDPAT
+
+
+def test_rev_cache(tmp_path):
+    path = str(tmp_path / "revs")
+    assert couchdyno._RevCache.open(None) is None
+    cache = couchdyno._RevCache.open(path)
+    revs = {IDPAT % i: "%d-%032x" % (i + 1, i) for i in (0, 1, 2, 5, 1000)}
+    for (_id, rev) in revs.items():
+        cache.put(_id, rev)
+    ids = [IDPAT % i for i in range(7)]
+    assert cache.get(ids) == {_id: revs[_id] for _id in ids if _id in revs}
+    # Scattered ids are read one at a time
+    ids = [IDPAT % 0, IDPAT % 1000]
+    assert cache.get(ids) == {_id: revs[_id] for _id in ids}
+    assert cache.get([]) == {}
+    assert cache.get([IDPAT % 2000]) == {}
+    # A shorter revision overwrites the whole record
+    cache.put(IDPAT % 1, "10-abc")
+    assert cache.get([IDPAT % 1]) == {IDPAT % 1: "10-abc"}
+    # Workers reopen the file after unpickling
+    cache = pickle.loads(pickle.dumps(cache))
+    assert cache.get([IDPAT % 5]) == {IDPAT % 5: revs[IDPAT % 5]}
+    cache = couchdyno._RevCache.open(path, reset=True)
+    assert cache.get([IDPAT % 5]) == {}
@@ -0,0 +1,172 @@
+import time
+import threading
+import pytest
+import couchdb
+from couchdyno import server
+
+
+@pytest.fixture(scope="module")
+def srv():
+    with server.running() as url:
+        yield couchdb.Server(url)
+
+
+@pytest.fixture
+def db(srv):
+    name = "standin_test_db"
+    if name in srv:
+        del srv[name]
+    yield srv.create(name)
+    del srv[name]
+
+
+def _ids(rows):
+    return [r.id for r in rows]
+
+
+def test_server_info(srv):
+    assert srv.version() == server.VERSION
+    assert "_replicator" in list(srv)
+
+
+def test_bulk_docs(db):
+    res = db.update([{"_id": "a"}, {"_id": "b", "x": 1}])
+    assert [(ok, _id) for (ok, _id, _) in res] == [(True, "a"), (True, "b")]
+    doc = db["b"]
+    doc["x"] = 2
+    db.save(doc)
+    res = db.update([{"_id": "b", "_rev": res[1][2], "x": 3}])
+    assert isinstance(res[0][2], couchdb.ResourceConflict)
+    assert db["b"]["x"] == 2
+    assert db.info()["doc_count"] == 2
+
+
+def test_bulk_docs_new_edits_false(db):
+    doc = {"_id": "a", "_revisions": {"start": 1, "ids": ["r1"]}, "x": 1}
+    assert db.update([doc], new_edits=False) == []
+    assert db["a"]["_rev"] == "1-r1"
+    doc = {"_id": "a", "_revisions": {"start": 3, "ids": ["r3", "r2", "r1"]}, "x": 3}
+    db.update([doc], new_edits=False)
+    assert db["a"]["_rev"] == "3-r3"
+    assert db["a"]["x"] == 3
+    # A path not sharing any revision with the current one adds a conflict
+    doc = {"_id": "a", "_revisions": {"start": 2, "ids": ["o2", "o1"]}, "x": 2}
+    db.update([doc], new_edits=False)
+    assert db["a"]["_rev"] == "3-r3"
+    assert db.get("a", conflicts=True)["_conflicts"] == ["2-o2"]
+    # Writing the same revision again is a no-op
+    db.update([doc], new_edits=False)
+    assert db.info()["doc_count"] == 1
+
+
+def test_db_counts_and_changes():
+    db = server._Db("db")
+    for i in range(3):
+        db.update({"_id": "d%d" % i})
+    db.update({"_id": "d0", "_rev": db.docs["d0"].winner(), "_deleted": True})
+    assert (db.doc_count, db.doc_del_count) == (2, 1)
+    db.update({"_id": "d0"})
+    assert (db.doc_count, db.doc_del_count) == (3, 0)
+    for _ in range(2 * server.SEQS_SLACK):
+        db.update({"_id": "d1", "_rev": db.docs["d1"].winner()})
+    # Entries of docs written again are dropped once they pile up
+    assert len(db.seqs) <= 2 * len(db.docs) + server.SEQS_SLACK
+    assert [d.id for d in db.changed(0)] == ["d2", "d0", "d1"]
+    assert [d.id for d in db.changed(db.docs["d0"].seq)] == ["d1"]
+    assert list(db.changed(db.seq)) == []
+    db.compact()
+    assert db.seqs == [db.docs[_id].seq for _id in ("d2", "d0", "d1")]
+
+
+def test_all_docs_ranges(db):
+    db.update([{"_id": "d%02d" % i} for i in range(10)])
+    all_docs = db.view("_all_docs")
+    assert _ids(all_docs) == ["d%02d" % i for i in range(10)]
+    assert all_docs.total_rows == 10
+    rows = db.view("_all_docs", startkey="d03", endkey="d05")
+    assert _ids(rows) == ["d03", "d04", "d05"]
+    rows = db.view("_all_docs", startkey="d03", endkey="d05", inclusive_end=False)
+    assert _ids(rows) == ["d03", "d04"]
+    rows = db.view("_all_docs", startkey="d05", endkey="d03", descending=True)
+    assert _ids(rows) == ["d05", "d04", "d03"]
+    rows = db.view("_all_docs", startkey="d02", skip=1, limit=2)
+    assert _ids(rows) == ["d03", "d04"]
+    rows = db.view("_all_docs", key="d07", include_docs=True)
+    assert [r.doc["_id"] for r in rows] == ["d07"]
+
+
+def test_all_docs_keys(db):
+    db.update([{"_id": "d%02d" % i} for i in range(10)])
+    del db["d02"]
+    rows = list(db.view("_all_docs", keys=["d05", "d01", "missing", "d02"]))
+    assert [r.key for r in rows] == ["d05", "d01", "missing", "d02"]
+    assert rows[0].value["rev"] == db["d05"]["_rev"]
+    assert rows[2].id is None
+    assert rows[3].value["deleted"] is True
+
+
+def test_changes_normal(db):
+    db.update([{"_id": "a"}, {"_id": "b"}])
+    res = db.changes()
+    assert [c["id"] for c in res["results"]] == ["a", "b"]
+    res = db.changes(since=res["results"][0]["seq"], include_docs=True)
+    assert [c["doc"]["_id"] for c in res["results"]] == ["b"]
+    assert db.changes(since=res["last_seq"])["results"] == []
+
+
+def test_changes_longpoll(db):
+    since = db.changes()["last_seq"]
+    t0 = time.time()
+    res = db.changes(feed="longpoll", since=since, timeout=200)
+    assert res["results"] == []
+    assert time.time() - t0 >= 0.2
+    timer = threading.Timer(0.2, lambda: db.save({"_id": "a"}))
+    timer.start()
+    res = db.changes(feed="longpoll", since=since, timeout=10000)
+    timer.join()
+    assert [c["id"] for c in res["results"]] == ["a"]
+
+
+def test_changes_continuous(db):
+    db.save({"_id": "a"})
+    timer = threading.Timer(0.2, lambda: db.save({"_id": "b"}))
+    timer.start()
+    feed = db.changes(feed="continuous", timeout=1000)
+    changes = list(feed)
+    timer.join()
+    assert [c["id"] for c in changes[:-1]] == ["a", "b"]
+    assert changes[-1]["last_seq"] == changes[-2]["seq"]
+
+
+def _wait_state(repdb, doc_id, timeout=10):
+    till = time.time() + timeout
+    while time.time() < till:
+        state = repdb[doc_id].get("_replication_state")
+        if state in ("completed", "failed"):
+            return state
+        time.sleep(0.05)
+    return None
+
+
+def test_replicator(srv, db):
+    db.update([{"_id": "d%02d" % i, "x": i} for i in range(10)])
+    db.put_attachment(db["d00"], b"abc", "att", "text/plain")
+    tgt_name = "standin_test_tgt"
+    if tgt_name in srv:
+        del srv[tgt_name]
+    repdb = srv["_replicator"]
+    doc = {"source": db.name, "target": tgt_name, "create_target": True}
+    doc_id, _ = repdb.save(doc)
+    assert _wait_state(repdb, doc_id) == "completed"
+    tgt = srv[tgt_name]
+    assert [(r.id, r.value) for r in tgt.view("_all_docs")] == [
+        (r.id, r.value) for r in db.view("_all_docs")
+    ]
+    assert tgt.get_attachment("d00", "att").read() == b"abc"
+    del srv[tgt_name]
+
+
+def test_replicator_missing_source(srv):
+    repdb = srv["_replicator"]
+    doc_id, _ = repdb.save({"source": "standin_no_such_db", "target": "x"})
+    assert _wait_state(repdb, doc_id) == "failed"
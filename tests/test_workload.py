@@ -0,0 +1,27 @@
+import random
+import argparse
+import collections
+import pytest
+from couchdyno.workload import parse_workload, format_workload, workload_ops
+
+
+def test_parse_workload():
+    workload = parse_workload("read=50, update=45,insert=5")
+    assert workload == {"read": 50.0, "update": 45.0, "insert": 5.0}
+    assert format_workload(workload) == "insert=5,read=50,update=45"
+    assert parse_workload(format_workload(workload)) == workload
+    for spec in ("read=50,write=50", "read=x", "read=0,update=0"):
+        with pytest.raises(argparse.ArgumentTypeError):
+            parse_workload(spec)
+
+
+def test_workload_ops():
+    rng = random.Random(1)
+    workload = {"read": 60, "insert": 10, "delete": 30}
+    ops = workload_ops(workload, 100, lambda: rng.randrange(100), 10000, rng)
+    counts = collections.Counter(op for (op, _) in ops)
+    for (op, ratio) in workload.items():
+        assert counts[op] == pytest.approx(ratio * 100, rel=0.1)
+    inserts = [idx for (op, idx) in ops if op == "insert"]
+    assert inserts == list(range(100, 100 + len(inserts)))
+    assert all(idx < 100 for (op, idx) in ops if op != "insert")